@@ -0,0 +1,211 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from cima import Cima  # noqa: E402
+from cima_api import CimaApiClient, api_search_params  # noqa: E402
+from drivers import DriverManager, create_chrome_driver  # noqa: E402
+from medicines import MedicineDetails, MedicinesSearch  # noqa: E402
+from results import Measurement, latency_metrics, save_result  # noqa: E402
+from scheduler import RequestScheduler  # noqa: E402
+from stub_server import add_server_args, server_from_args  # noqa: E402
+from waits import AdaptiveWaiter  # noqa: E402
+from writers import open_writer  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# Tipo de petición de la descarga de una página de detalle (navegador o API)
+_PETICION_DETALLE = "detalle"
+
+
+class RecordingScheduler(RequestScheduler):
+    # Planificador que además guarda la latencia de cada petición para calcular percentiles
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.latencies = defaultdict(list)
+        self._samples_lock = threading.Lock()
+
+    def _on_success(self, name: str, latency: float):
+        with self._samples_lock:
+            self.latencies[name].append(latency)
+        super()._on_success(name, latency)
+
+
+def parser_args():
+    parser = argparse.ArgumentParser(
+        description="Mide el rendimiento del scraping completo (búsqueda, páginas de detalle\
+            y escritura del CSV) contra un servidor local que simula la web de CIMA."
+    )
+    parser.add_argument(
+        "--num-medicamentos",
+        type=int,
+        default=100,
+        help="Número de medicamentos a scrapear (-1 para todos los del servidor).",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="selenium",
+        choices=["selenium", "http"],
+        help="Motor para las páginas de detalle.",
+    )
+    parser.add_argument(
+        "--id-source",
+        type=str,
+        default="browser",
+        choices=["browser", "api"],
+        help="Origen de los números de registro (con 'api' y el motor http no se necesita\
+            navegador).",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Nº de workers.")
+    parser.add_argument(
+        "--parser",
+        type=str,
+        default="bs4",
+        choices=MedicineDetails.PARSERS,
+        help="Parser de las páginas de detalle.",
+    )
+    parser.add_argument(
+        "--sleep-time", type=float, default=3, help="Espera máxima de cada página."
+    )
+    parser.add_argument(
+        "--scroll-sleep-time",
+        type=float,
+        default=0.5,
+        help="Espera máxima tras cada scroll de la lista.",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=20, help="Timeout de las peticiones."
+    )
+    parser.add_argument(
+        "--max-retries", type=int, default=2, help="Reintentos por medicamento."
+    )
+    parser.add_argument(
+        "--chromedriver",
+        type=str,
+        default=None,
+        help="Ruta al ejecutable de chromedriver.",
+    )
+    parser.add_argument(
+        "--name",
+        type=str,
+        default="e2e",
+        help="Nombre del benchmark; los resultados se guardan en results/<name>.jsonl.",
+    )
+    parser.add_argument(
+        "--no-save",
+        action="store_true",
+        help="No guardar el resultado.",
+    )
+    add_server_args(parser)
+    return parser.parse_args()
+
+
+def run(args, base_url: str, out: str, scheduler: RequestScheduler) -> int:
+    # Mismo recorrido que scraper.py: búsqueda en la web (o listado de la API), páginas de
+    # detalle y escritura del CSV
+    drivers = DriverManager(
+        partial(create_chrome_driver, driver_path=args.chromedriver)
+    )
+    waiter = AdaptiveWaiter()
+    engine = None
+    listing = None
+    try:
+        if args.engine == "http":
+            engine = CimaApiClient(
+                base_url,
+                timeout=args.timeout,
+                pool_size=args.workers,
+                scheduler=scheduler,
+            )
+        id_source = None
+        if args.id_source == "api":
+            listing = engine or CimaApiClient(
+                base_url, timeout=args.timeout, scheduler=scheduler
+            )
+            id_source = partial(
+                listing.iter_medicines_id_numbers, api_search_params("*", [])
+            )
+            search = MedicinesSearch(
+                drivers.new_driver() if engine is None else None,
+                sleep_time=args.sleep_time,
+                timeout=args.timeout,
+                base_url=base_url,
+                parser=args.parser,
+                waiter=waiter,
+                scheduler=scheduler,
+                driver_manager=drivers,
+            )
+        else:
+            search = Cima(
+                drivers.new_driver(),
+                args.sleep_time,
+                args.timeout,
+                base_url=base_url,
+                parser=args.parser,
+                waiter=waiter,
+                scheduler=scheduler,
+                driver_manager=drivers,
+            ).search_medicines(
+                search="*", search_filters=[], remove_default_filters=False
+            )
+        with open_writer(out, "csv") as writer:
+            search.scrape_medicines(
+                num_medicines=args.num_medicamentos,
+                scroll_sleep_time=args.scroll_sleep_time,
+                workers=args.workers,
+                driver_factory=drivers.new_driver,
+                max_retries=args.max_retries,
+                engine=engine,
+                id_source=id_source,
+                on_result=lambda med_id_number, row: writer.write(row),
+            )
+        return writer.rows_written
+    finally:
+        if engine is not None:
+            engine.close()
+        if listing is not None and listing is not engine:
+            listing.close()
+        drivers.close()
+
+
+def main():
+    args = parser_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    scheduler = RecordingScheduler(max_concurrency=args.workers)
+    with server_from_args(args) as server, tempfile.TemporaryDirectory() as tmp:
+        logger.info(f"Servidor local con {len(server.store.ids)} medicamentos")
+        with Measurement() as measurement:
+            num_rows = run(args, server.url, os.path.join(tmp, "out.csv"), scheduler)
+        server_requests, server_errors = server.requests, server.errors
+
+    detail_latencies = scheduler.latencies[_PETICION_DETALLE]
+    metrics = {
+        "pages": num_rows,
+        "pages_per_s": round(num_rows / measurement.wall, 2),
+        **latency_metrics(detail_latencies),
+        **measurement.metrics(),
+        "server_requests": server_requests,
+        "server_errors": server_errors,
+        "scheduler_errors": scheduler.errors,
+    }
+    for key, value in metrics.items():
+        logger.info(f"{key:>22}: {value}")
+    if not args.no_save:
+        params = {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("name", "no_save", "chromedriver")
+        }
+        save_result(args.name, params, metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import gzip
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from medicines import MedicineDetails  # noqa: E402
+from results import Measurement, latency_metrics, save_result  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def parser_args():
+    parser = argparse.ArgumentParser(
+        description="Compara la velocidad (páginas/s) de los parsers de las páginas de detalle\
+            y comprueba que todos producen las mismas filas que el parser de referencia (bs4)."
+    )
+    parser.add_argument(
+        "corpus",
+        type=str,
+        help="Directorio con páginas de detalle guardadas (*.html o *.html.gz).",
+    )
+    parser.add_argument(
+        "--parsers",
+        type=str,
+        nargs="+",
+        default=MedicineDetails.PARSERS,
+        choices=MedicineDetails.PARSERS,
+        help="Parsers a comparar.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Número de pasadas por el corpus para cada parser (se toma la más rápida).",
+    )
+    parser.add_argument(
+        "--name",
+        type=str,
+        default="parsers",
+        help="Nombre del benchmark; los resultados se guardan en results/<name>.jsonl.",
+    )
+    parser.add_argument(
+        "--no-save",
+        action="store_true",
+        help="No guardar el resultado.",
+    )
+    return parser.parse_args()
+
+
+def load_corpus(corpus_dir: str) -> list:
+    pages = []
+    for path in sorted(Path(corpus_dir).iterdir()):
+        if path.name.endswith(".html.gz"):
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                pages.append(f.read())
+        elif path.name.endswith(".html"):
+            pages.append(path.read_text(encoding="utf-8"))
+    return pages
+
+
+def bench_parser(pages: list, parser: str, repeat: int):
+    # Devuelve las filas, el tiempo de la pasada más rápida y el tiempo de cada página en
+    # esa pasada
+    rows = None
+    best = float("inf")
+    best_times = []
+    for _ in range(max(1, repeat)):
+        rows = []
+        times = []
+        start = time.perf_counter()
+        for html in pages:
+            page_start = time.perf_counter()
+            rows.append(MedicineDetails(html, parser=parser).scrape_data())
+            times.append(time.perf_counter() - page_start)
+        elapsed = time.perf_counter() - start
+        if elapsed < best:
+            best, best_times = elapsed, times
+    return rows, best, best_times
+
+
+def main():
+    args = parser_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    pages = load_corpus(args.corpus)
+    if not pages:
+        raise ValueError(f"No se ha encontrado ninguna página en {args.corpus}")
+    logger.info(f"Corpus: {len(pages)} páginas")
+
+    reference, _, _ = bench_parser(pages, "bs4", repeat=1)
+    for parser in args.parsers:
+        try:
+            with Measurement() as measurement:
+                rows, elapsed, times = bench_parser(pages, parser, args.repeat)
+        except ImportError as err:
+            logger.warning(f"{parser:>10}: omitido ({err})")
+            continue
+        diferencias = sum(1 for a, b in zip(reference, rows) if a != b)
+        latencies = latency_metrics(times)
+        logger.info(
+            f"{parser:>10}: {len(pages) / elapsed:8.1f} páginas/s "
+            f"(p50 {latencies['p50_ms']:.2f} ms, p99 {latencies['p99_ms']:.2f} ms) - "
+            f"{diferencias} filas distintas a bs4"
+        )
+        if not args.no_save:
+            save_result(
+                args.name,
+                {
+                    "corpus": os.path.abspath(args.corpus),
+                    "pages": len(pages),
+                    "parser": parser,
+                    "repeat": args.repeat,
+                },
+                {
+                    "pages_per_s": round(len(pages) / elapsed, 2),
+                    **latencies,
+                    # CPU y memoria de todas las pasadas
+                    **measurement.metrics(),
+                    "diferencias": diferencias,
+                },
+            )
+
+
+if __name__ == "__main__":
+    main()
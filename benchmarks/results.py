@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+# Métricas en las que un valor mayor es mejor (en el resto, un valor menor es mejor)
+_MAYOR_ES_MEJOR = {"pages_per_s"}
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    # Percentil por interpolación lineal (q entre 0 y 100)
+    if not samples:
+        return None
+    samples = sorted(samples)
+    k = (len(samples) - 1) * q / 100
+    lower = int(k)
+    upper = min(lower + 1, len(samples) - 1)
+    return samples[lower] + (samples[upper] - samples[lower]) * (k - lower)
+
+
+def _cpu_time() -> float:
+    # Tiempo de CPU del proceso y de los procesos hijos que ya han terminado
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _max_rss_self() -> int:
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Measurement:
+    # Mide el tiempo total, el tiempo de CPU y el pico de memoria de un bloque de código.
+    # Con psutil se muestrea además la memoria y la CPU de los procesos hijos que siguen vivos
+    # (chromedriver y Chrome), que getrusage no incluye hasta que terminan
+    def __init__(self, sample_interval: float = 0.2) -> None:
+        self._interval = sample_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._children_cpu = {}
+        self.peak_rss_children = 0
+        self.wall = None
+        self.cpu = None
+
+    def __enter__(self):
+        self._start_wall = time.perf_counter()
+        self._start_cpu = _cpu_time()
+        try:
+            import psutil
+
+            self._process = psutil.Process()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        except ImportError:
+            logger.warning(
+                "Sin psutil (pip install psutil) no se mide la memoria ni la CPU de los"
+                " navegadores"
+            )
+        return self
+
+    def _sample(self):
+        import psutil
+
+        while not self._stop.is_set():
+            rss = 0
+            try:
+                for child in self._process.children(recursive=True):
+                    try:
+                        rss += child.memory_info().rss
+                        times = child.cpu_times()
+                        self._children_cpu[child.pid] = times.user + times.system
+                    except psutil.Error:
+                        pass
+            except psutil.Error:
+                pass
+            self.peak_rss_children = max(self.peak_rss_children, rss)
+            self._stop.wait(self._interval)
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.wall = time.perf_counter() - self._start_wall
+        # Los hijos ya terminados están incluidos en getrusage; se suma solo lo muestreado
+        # de los que seguían vivos al final, que es una cota inferior de su CPU
+        self.cpu = _cpu_time() - self._start_cpu
+        try:
+            import psutil
+
+            alive = {p.pid for p in psutil.Process().children(recursive=True)}
+            self.cpu += sum(t for pid, t in self._children_cpu.items() if pid in alive)
+        except ImportError:
+            pass
+
+    def metrics(self) -> dict:
+        return {
+            "wall_s": round(self.wall, 3),
+            "cpu_s": round(self.cpu, 3),
+            "peak_rss_mb": round(_max_rss_self() / 2**20, 1),
+            "peak_rss_children_mb": round(self.peak_rss_children / 2**20, 1),
+        }
+
+
+def latency_metrics(samples: List[float]) -> dict:
+    return {
+        "p50_ms": _ms(percentile(samples, 50)),
+        "p99_ms": _ms(percentile(samples, 99)),
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_result(
+    name: str, params: dict, metrics: dict, results_dir: str = RESULTS_DIR
+) -> dict:
+    # Añade el resultado a 'results/<name>.jsonl' y lo compara con la última ejecución
+    # anterior con los mismos parámetros
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"{name}.jsonl")
+    previous = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    if result.get("params") == params:
+                        previous = result
+    result = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "params": params,
+        "metrics": metrics,
+    }
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    logger.info(f"Resultado guardado en {path}")
+    if previous is not None:
+        _log_comparison(previous, metrics)
+    return result
+
+
+def _log_comparison(previous: dict, metrics: dict):
+    logger.info(
+        f"Comparación con la ejecución anterior ({previous['timestamp']}, "
+        f"commit {previous['commit']}):"
+    )
+    for key, value in metrics.items():
+        before = previous["metrics"].get(key)
+        if not isinstance(value, (int, float)) or not isinstance(before, (int, float)):
+            continue
+        if not before:
+            continue
+        change = (value - before) / before * 100
+        better = change > 0 if key in _MAYOR_ES_MEJOR else change < 0
+        logger.info(
+            f"  {key:>22}: {before} -> {value} ({change:+.1f} %"
+            f"{', mejor' if better and abs(change) >= 1 else ''})"
+        )
@@ -0,0 +1,410 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from cache import PageCache  # noqa: E402
+from cima import Cima  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# Tamaño de página del listado, igual que la web de CIMA
+_PAGE_SIZE = 25
+# Filtros que aparecen activados por defecto en la página de inicio
+_DEFAULT_FILTERS = ["filtroAutorizado", "filtroComercializadoSi"]
+
+# Página de inicio con el buscador, los filtros y la lista de resultados con scroll infinito.
+# Reproduce la estructura que utilizan Cima y MedicinesSearch: #inputbuscadorsimple,
+# checkboxes con su label, #numResultados y #resultlist > div > div[onclick=medicamentoOnSelect]
+_HOME_HTML = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>CIMA (local)</title>
+<style>#resultlist > div { height: 60px; }</style></head>
+<body>
+<input id="inputbuscadorsimple" type="text">
+<div id="filtros">__FILTROS__</div>
+<span id="numResultados"></span>
+<div id="resultlist"></div>
+<script>
+var pagina = 0, total = 0, cargando = false, busqueda = null;
+function medicamentoOnSelect(nregistro) {
+    window.location = "/cima/publico/detalle.html?nregistro=" + nregistro;
+}
+function cargar(reset) {
+    if (cargando || (!reset && pagina * __PAGE_SIZE__ >= total)) { return; }
+    cargando = true;
+    var siguiente = reset ? 1 : pagina + 1;
+    var xhr = new XMLHttpRequest();
+    xhr.open("GET", "/cima/rest/medicamentos?pagina=" + siguiente + "&nombre=" + encodeURIComponent(busqueda));
+    xhr.onload = function () {
+        var data = JSON.parse(xhr.responseText);
+        var lista = document.getElementById("resultlist");
+        if (reset) {
+            // Se genera una lista nueva: los elementos anteriores dejan de estar en el DOM
+            var nueva = lista.cloneNode(false);
+            lista.parentNode.replaceChild(nueva, lista);
+            lista = nueva;
+        }
+        data.resultados.forEach(function (med) {
+            var bloque = document.createElement("div");
+            var item = document.createElement("div");
+            item.setAttribute("onclick", "medicamentoOnSelect('" + med.nregistro + "')");
+            item.textContent = med.nombre;
+            bloque.appendChild(item);
+            lista.appendChild(bloque);
+        });
+        pagina = siguiente;
+        total = data.totalFilas;
+        document.getElementById("numResultados").textContent = total;
+        cargando = false;
+    };
+    xhr.onerror = function () { cargando = false; };
+    xhr.send();
+}
+function buscar(texto) {
+    busqueda = texto;
+    // La búsqueda se guarda en la URL para restaurar la lista al volver atrás
+    history.replaceState(null, "", "#q=" + encodeURIComponent(texto));
+    cargar(true);
+}
+document.getElementById("inputbuscadorsimple").addEventListener("keydown", function (e) {
+    if (e.key === "Enter") { buscar(this.value); }
+});
+document.querySelectorAll("#filtros input").forEach(function (checkbox) {
+    checkbox.addEventListener("change", function () {
+        if (busqueda !== null) { cargar(true); }
+    });
+});
+window.addEventListener("scroll", function () {
+    if (busqueda !== null &&
+        window.innerHeight + window.scrollY >= document.body.scrollHeight - 100) {
+        cargar(false);
+    }
+});
+if (window.location.hash.indexOf("#q=") === 0) {
+    buscar(decodeURIComponent(window.location.hash.substring(3)));
+}
+</script>
+</body></html>
+"""
+
+
+def synthetic_detail_html(nregistro: str) -> str:
+    # Página de detalle con la misma estructura que la de CIMA, para cuando no se dispone de
+    # páginas guardadas
+    n = int(nregistro)
+    formatos = "".join(
+        f'<div class="row"><h6>CAJA {i} comprimidos</h6>'
+        f"<h6> National code: 6{n}{i} </h6></div>"
+        for i in range(n % 4)
+    )
+    return f"""<!DOCTYPE html><html><head><meta charset="utf-8">
+<title>MEDICAMENTO {n}</title></head><body>
+<h1>MEDICAMENTO {n} 500 mg comprimidos</h1>
+<div id="nombrelabXS">LABORATORIO {n % 7} S.A.</div>
+<span id="nregistroId">{n}</span>
+<h2 id="estadoXS">Autorizado ( 01/02/2003 )</h2>
+<h2 id="estadoXSsec">{'Suspendido ( 04/05/2006 )' if n % 3 == 0 else ''}</h2>
+{'<h3 id="estadocomercXS">Comercializado</h3>' if n % 2 == 0 else ''}
+<div id="viasadministracion"><ul><li>VÍA ORAL</li></ul></div>
+<div id="dosis"><ul><li>500 mg</li></ul></div>
+<div id="formas"><ul><li>COMPRIMIDO</li></ul></div>
+<div id="pactivosList"><ul><li>PARACETAMOL</li></ul></div>
+<div id="excipientesList"><ul><li>ALMIDÓN</li><li>LACTOSA MONOHIDRATO</li></ul></div>
+<div id="caracteristicasList"><ul></ul></div>
+<div id="atcList"><ul><li>N02BE01 - PARACETAMOL</li></ul></div>
+<div id="bodyFormatos">{formatos}</div>
+<button onclick='compartirMedicamento()'>Compartir</button>
+</body></html>"""
+
+
+def synthetic_detail_json(nregistro: str) -> str:
+    # Los mismos datos que synthetic_detail_html, como los devuelve la API
+    n = int(nregistro)
+    return json.dumps(
+        {
+            "nregistro": nregistro,
+            "nombre": f"MEDICAMENTO {n} 500 mg comprimidos",
+            "labtitular": f"LABORATORIO {n % 7} S.A.",
+            "estado": {
+                "aut": 1044057600000,
+                **({"susp": 1146700800000} if n % 3 == 0 else {}),
+            },
+            "comerc": n % 2 == 0,
+            "viasAdministracion": [{"nombre": "VÍA ORAL"}],
+            "dosis": "500 mg",
+            "formaFarmaceutica": {"nombre": "COMPRIMIDO"},
+            "principiosActivos": [{"nombre": "PARACETAMOL"}],
+            "excipientes": [{"nombre": "ALMIDÓN"}, {"nombre": "LACTOSA MONOHIDRATO"}],
+            "atcs": [{"codigo": "N02BE01", "nombre": "PARACETAMOL"}],
+            "presentaciones": [
+                {"nombre": f"CAJA {i} comprimidos", "cn": f"6{n}{i}"}
+                for i in range(n % 4)
+            ],
+        },
+        ensure_ascii=False,
+    )
+
+
+class PageStore:
+    # Páginas servidas por el servidor: un directorio con '<nregistro>.html' (o .html.gz) y,
+    # opcionalmente, '<nregistro>.json', una caché de --cache-dir o páginas sintéticas
+    def __init__(self, pages_dir: str = None, cache_dir: str = None, synthetic=0):
+        self._html = {}
+        self._json = {}
+        self._cache = None
+        if pages_dir:
+            for path in sorted(Path(pages_dir).iterdir()):
+                nregistro = path.name.split(".")[0]
+                if path.name.endswith(".html.gz"):
+                    with gzip.open(path, "rt", encoding="utf-8") as f:
+                        self._html[nregistro] = f.read()
+                elif path.name.endswith(".html"):
+                    self._html[nregistro] = path.read_text(encoding="utf-8")
+                elif path.name.endswith(".json"):
+                    self._json[nregistro] = path.read_text(encoding="utf-8")
+            self.ids = sorted(set(self._html) | set(self._json), key=_sort_key)
+        elif cache_dir:
+            self._cache = PageCache(cache_dir)
+            self.ids = sorted(
+                {
+                    m
+                    for formato in ("html", "json")
+                    for m, _ in self._cache.items(formato)
+                },
+                key=_sort_key,
+            )
+        else:
+            self.ids = [str(60000 + i) for i in range(synthetic)]
+        self._synthetic = not pages_dir and not cache_dir
+        self._id_set = set(self.ids)
+
+    def html(self, nregistro: str):
+        if self._synthetic:
+            return (
+                synthetic_detail_html(nregistro) if nregistro in self._id_set else None
+            )
+        if self._cache is not None:
+            return self._cache.get(nregistro, "html")
+        return self._html.get(nregistro)
+
+    def json(self, nregistro: str):
+        if self._synthetic:
+            return (
+                synthetic_detail_json(nregistro) if nregistro in self._id_set else None
+            )
+        if self._cache is not None:
+            return self._cache.get(nregistro, "json")
+        return self._json.get(nregistro)
+
+
+def _sort_key(nregistro: str):
+    return (0, int(nregistro)) if nregistro.isdigit() else (1, nregistro)
+
+
+class StubCimaServer:
+    # Servidor HTTP local que sustituye a cima.aemps.es en los benchmarks. Sirve la página
+    # de inicio con la lista de resultados, las páginas de detalle y los endpoints REST
+    # utilizados por el scraper, con una latencia y una tasa de errores configurables
+    def __init__(
+        self,
+        store: PageStore,
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = None,
+    ) -> None:
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def start(self) -> "StubCimaServer":
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, name="stub-cima", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _delay_and_fail(self) -> bool:
+        # Latencia simulada y error aleatorio (503) de las páginas de detalle y de la API
+        with self._random_lock:
+            self.requests += 1
+            delay = max(0.0, self._random.gauss(self.latency, self.jitter))
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        time.sleep(delay)
+        return fail
+
+    def _handler(self):
+        server = self
+        home = _HOME_HTML.replace("__PAGE_SIZE__", str(_PAGE_SIZE)).replace(
+            "__FILTROS__",
+            "".join(
+                f'<input type="checkbox" id="{f}"{" checked" if f in _DEFAULT_FILTERS else ""}>'
+                f'<label for="{f}">{descripcion}</label>'
+                for f, descripcion in Cima._FILTROS_BUSQUEDA.items()
+            ),
+        )
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: str, content_type: str):
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path in ("/", "/cima/publico/home.html"):
+                    return self._send(200, home, "text/html")
+                if url.path == "/cima/rest/medicamentos":
+                    return self._listing(int(query.get("pagina", ["1"])[0]))
+                nregistro = query.get("nregistro", [""])[0]
+                if url.path == "/cima/publico/detalle.html":
+                    return self._detail(server.store.html(nregistro), "text/html")
+                if url.path == "/cima/rest/medicamento":
+                    return self._detail(
+                        server.store.json(nregistro), "application/json"
+                    )
+                self._send(404, "No encontrado", "text/plain")
+
+            def _listing(self, pagina: int):
+                if server._delay_and_fail():
+                    return self._send(503, "Servicio no disponible", "text/plain")
+                ids = server.store.ids
+                page = ids[(pagina - 1) * _PAGE_SIZE : pagina * _PAGE_SIZE]
+                body = {
+                    "totalFilas": len(ids),
+                    "pagina": pagina,
+                    "tamanioPagina": _PAGE_SIZE,
+                    "resultados": [
+                        {"nregistro": m, "nombre": f"MEDICAMENTO {m}"} for m in page
+                    ],
+                }
+                self._send(200, json.dumps(body), "application/json")
+
+            def _detail(self, content, content_type: str):
+                if server._delay_and_fail():
+                    return self._send(503, "Servicio no disponible", "text/plain")
+                if content is None:
+                    return self._send(404, "No encontrado", "text/plain")
+                self._send(200, content, content_type)
+
+        return Handler
+
+
+def add_server_args(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group("servidor local")
+    group.add_argument(
+        "--pages",
+        type=str,
+        default=None,
+        help="Directorio con páginas de detalle guardadas (<nregistro>.html, .html.gz o .json).",
+    )
+    group.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Caché del scraper (--cache-dir) de la que servir las páginas guardadas.",
+    )
+    group.add_argument(
+        "--synthetic",
+        type=int,
+        default=500,
+        help="Nº de medicamentos sintéticos si no se indica --pages ni --cache-dir.",
+    )
+    group.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="Latencia media (en segundos) de las páginas de detalle y de la API.",
+    )
+    group.add_argument(
+        "--jitter",
+        type=float,
+        default=0.01,
+        help="Desviación típica (en segundos) de la latencia.",
+    )
+    group.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fracción de peticiones que responden con un error 503.",
+    )
+    group.add_argument("--seed", type=int, default=0, help="Semilla aleatoria.")
+
+
+def server_from_args(args, port: int = 0) -> StubCimaServer:
+    return StubCimaServer(
+        PageStore(args.pages, args.cache_dir, args.synthetic),
+        port=port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Servidor local que simula la web de CIMA para medir el rendimiento del\
+            scraper sin acceder a la web real (usar con --cima-url)."
+    )
+    parser.add_argument("--port", type=int, default=8000, help="Puerto del servidor.")
+    add_server_args(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    server = server_from_args(args, port=args.port)
+    logger.info(
+        f"Sirviendo {len(server.store.ids)} medicamentos en {server.url} "
+        "(Ctrl+C para terminar)"
+    )
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PageCache:
+    # Caché en disco del contenido en bruto de las páginas de detalle (html con el motor
+    # selenium o json con el motor http). El contenido se guarda comprimido en ficheros
+    # cuyo nombre es su hash (content-addressed), y un índice sqlite relaciona cada número
+    # de registro con su contenido, su fecha de descarga y su último acceso. El índice
+    # guarda también los resultados de las búsquedas (ver SearchSession)
+    def __init__(
+        self,
+        directory: str,
+        ttl: Optional[float] = None,
+        max_size: Optional[int] = None,
+        search_ttl: Optional[float] = None,
+    ) -> None:
+        self._directory = directory
+        self._objects_dir = os.path.join(directory, "objects")
+        os.makedirs(self._objects_dir, exist_ok=True)
+        # Antigüedad máxima (en segundos) de una entrada y tamaño máximo (en bytes) de la caché
+        self._ttl = ttl
+        self._max_size = max_size
+        # Los resultados de una búsqueda cambian con las altas y bajas de medicamentos, así
+        # que tienen su propia antigüedad máxima (en segundos)
+        self._search_ttl = search_ttl
+        # Suma de los tamaños de las entradas, mantenida en memoria para no recorrer el
+        # índice en cada put (se calcula la primera vez que hace falta)
+        self._size = None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(directory, "index.sqlite"), check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS paginas ("
+            " nregistro TEXT NOT NULL,"
+            " formato TEXT NOT NULL,"
+            " digest TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL,"
+            " PRIMARY KEY (nregistro, formato))"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS paginas_accessed ON paginas (accessed)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS busquedas ("
+            " clave TEXT PRIMARY KEY,"
+            " datos TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self._objects_dir, digest[:2], digest + ".gz")
+
+    def _is_expired(self, created: float) -> bool:
+        return self._ttl is not None and time.time() - created > self._ttl
+
+    def get(self, nregistro: str, formato: str = "html") -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest, created FROM paginas WHERE nregistro = ? AND formato = ?",
+                (str(nregistro), formato),
+            ).fetchone()
+            if row is None:
+                return None
+            digest, created = row
+            if self._is_expired(created):
+                self._delete(str(nregistro), formato)
+                self._db.commit()
+                return None
+            try:
+                with gzip.open(self._object_path(digest), "rt", encoding="utf-8") as f:
+                    content = f.read()
+            except FileNotFoundError:
+                logger.warning(
+                    f"La entrada de la caché para {nregistro} no tiene contenido. Se descarta."
+                )
+                self._delete(str(nregistro), formato)
+                self._db.commit()
+                return None
+            self._db.execute(
+                "UPDATE paginas SET accessed = ? WHERE nregistro = ? AND formato = ?",
+                (time.time(), str(nregistro), formato),
+            )
+            self._db.commit()
+            return content
+
+    def put(self, nregistro: str, content: str, formato: str = "html"):
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            # Escritura atómica: se escribe en un fichero temporal y después se renombra
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(gzip.compress(data))
+            os.replace(tmp_path, path)
+        now = time.time()
+        with self._lock:
+            previous = self._db.execute(
+                "SELECT digest, size FROM paginas WHERE nregistro = ? AND formato = ?",
+                (str(nregistro), formato),
+            ).fetchone()
+            size = os.path.getsize(path)
+            self._db.execute(
+                "INSERT OR REPLACE INTO paginas VALUES (?, ?, ?, ?, ?, ?)",
+                (str(nregistro), formato, digest, size, now, now),
+            )
+            self._add_size(size - (previous[1] if previous is not None else 0))
+            if previous is not None and previous[0] != digest:
+                self._remove_object_if_unused(previous[0])
+            self._evict()
+            self._db.commit()
+
+    def age(self, nregistro: str, formato: str = "html") -> Optional[float]:
+        # Segundos desde que se descargó la página, o None si no está en la caché
+        with self._lock:
+            row = self._db.execute(
+                "SELECT created FROM paginas WHERE nregistro = ? AND formato = ?",
+                (str(nregistro), formato),
+            ).fetchone()
+        return time.time() - row[0] if row is not None else None
+
+    def delete(self, nregistro: str, formato: str = "html"):
+        with self._lock:
+            self._delete(str(nregistro), formato)
+            self._db.commit()
+
+    def _delete(self, nregistro: str, formato: str):
+        row = self._db.execute(
+            "SELECT digest, size FROM paginas WHERE nregistro = ? AND formato = ?",
+            (nregistro, formato),
+        ).fetchone()
+        if row is None:
+            return
+        self._db.execute(
+            "DELETE FROM paginas WHERE nregistro = ? AND formato = ?",
+            (nregistro, formato),
+        )
+        self._add_size(-row[1])
+        self._remove_object_if_unused(row[0])
+
+    def _add_size(self, delta: int):
+        if self._size is not None:
+            self._size += delta
+
+    def _remove_object_if_unused(self, digest: str):
+        # Varias entradas pueden apuntar al mismo contenido
+        (uses,) = self._db.execute(
+            "SELECT COUNT(*) FROM paginas WHERE digest = ?", (digest,)
+        ).fetchone()
+        if uses == 0:
+            try:
+                os.remove(self._object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        # Se eliminan las entradas usadas hace más tiempo (LRU) hasta quedar por debajo del
+        # tamaño máximo
+        if self._max_size is None:
+            return
+        if self._size is not None and self._size <= self._max_size:
+            return
+        # El índice se puede compartir con otros procesos (p.ej. el servicio y un scraping):
+        # antes de eliminar nada se vuelve a calcular el tamaño real
+        (self._size,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM paginas"
+        ).fetchone()
+        if self._size <= self._max_size:
+            return
+        for nregistro, formato in self._db.execute(
+            "SELECT nregistro, formato FROM paginas ORDER BY accessed"
+        ).fetchall():
+            self._delete(nregistro, formato)
+            if self._size <= self._max_size:
+                break
+        logger.debug(f"Caché reducida a {self._size} bytes")
+
+    def get_search(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT datos, created FROM busquedas WHERE clave = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            datos, created = row
+            if (
+                self._search_ttl is not None
+                and time.time() - created > self._search_ttl
+            ):
+                self._db.execute("DELETE FROM busquedas WHERE clave = ?", (key,))
+                self._db.commit()
+                return None
+        return json.loads(datos)
+
+    def put_search(self, key: str, datos: dict):
+        with self._lock:
+            # Al ampliar los resultados de una búsqueda se conserva su fecha original, para
+            # que la antigüedad máxima cuente desde la primera vez que se hizo
+            self._db.execute(
+                "INSERT INTO busquedas VALUES (?, ?, ?)"
+                " ON CONFLICT (clave) DO UPDATE SET datos = excluded.datos",
+                (key, json.dumps(datos), time.time()),
+            )
+            self._db.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM paginas").fetchone()[0]
+
+    def items(self, formato: str = "html") -> Iterator[Tuple[str, str]]:
+        # Recorre (número de registro, contenido) de todas las entradas vigentes, ordenadas
+        # por número de registro
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT nregistro, digest, created FROM paginas WHERE formato = ?"
+                " ORDER BY CAST(nregistro AS INTEGER), nregistro",
+                (formato,),
+            ).fetchall()
+        for nregistro, digest, created in rows:
+            if self._is_expired(created):
+                continue
+            try:
+                with gzip.open(self._object_path(digest), "rt", encoding="utf-8") as f:
+                    yield nregistro, f.read()
+            except FileNotFoundError:
+                continue
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def search_key(base_url: str, search: str, filters: list, remove_default: bool) -> str:
+    # Identifica una búsqueda de la web: el orden en el que se activan los filtros no cambia
+    # los resultados
+    return json.dumps(
+        {
+            "url": base_url.rstrip("/"),
+            "busqueda": search,
+            "filtros": sorted(filters or []),
+            "sin_filtros_por_defecto": bool(remove_default),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+
+
+class SearchSession:
+    # Resultados de una búsqueda de la web (texto y filtros): nº total de medicamentos, nº de
+    # elementos de la lista inicial y los números de registro obtenidos hasta el momento, en
+    # el orden de la lista. Se guardan en la caché (si la hay) para que las búsquedas
+    # repetidas, en la misma ejecución o en las siguientes, no tengan que volver a aplicar
+    # los filtros ni hacer scroll por la lista
+    def __init__(
+        self,
+        key: str,
+        cache: PageCache = None,
+        total: Optional[int] = None,
+        initial: Optional[int] = None,
+        ids: List[str] = None,
+        complete: bool = False,
+    ) -> None:
+        self.key = key
+        self._cache = cache
+        self.total = total
+        self.initial = initial
+        self.ids = list(ids or [])
+        # La lista completa puede tener menos elementos que el total que indica la web
+        self.complete = complete
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, key: str, cache: PageCache = None) -> "SearchSession":
+        datos = cache.get_search(key) if cache is not None else None
+        return cls(key, cache, **datos) if datos else cls(key, cache)
+
+    def ids_for(self, num_medicines: int) -> Optional[List[str]]:
+        # Números de registro para --num-medicamentos (mismo criterio: -1 son todos y si no
+        # se especifica, los de la lista inicial), o None si no se conocen todavía
+        with self._lock:
+            if num_medicines == -1:
+                return list(self.ids) if self.complete else None
+            if not num_medicines:
+                if self.initial is None or len(self.ids) < self.initial:
+                    return None
+                return self.ids[: self.initial]
+            if len(self.ids) >= num_medicines or self.complete:
+                return self.ids[:num_medicines]
+            return None
+
+    def update(
+        self,
+        ids: List[str] = (),
+        total: Optional[int] = None,
+        initial: Optional[int] = None,
+        complete: bool = False,
+    ):
+        # Todas las listas de una misma búsqueda empiezan igual: se guarda la más larga
+        with self._lock:
+            if len(ids) > len(self.ids):
+                self.ids = list(ids)
+            if total is not None:
+                self.total = total
+            if initial is not None:
+                self.initial = initial
+            self.complete = (
+                self.complete
+                or complete
+                or (self.total is not None and len(self.ids) >= self.total)
+            )
+            datos = {
+                "total": self.total,
+                "initial": self.initial,
+                "ids": self.ids,
+                "complete": self.complete,
+            }
+        if self._cache is not None:
+            self._cache.put_search(self.key, datos)
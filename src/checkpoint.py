@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import List, Optional
+
+from records import MedicineColumns
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_INTERVAL = 50
+_DEFAULT_MIN_SECONDS = 30
+
+
+class CrawlCheckpoint:
+    # Estado de un scraping en curso para poder reanudarlo si se interrumpe. Se guarda en dos
+    # ficheros:
+    #  - '<path>': json con la lista de identificadores, los completados y el nº de filas
+    #    confirmadas. Se reescribe de forma atómica (fichero temporal + rename).
+    #  - '<path>.rows.jsonl': las filas ya scrapeadas, una por línea. Solo se añaden líneas al
+    #    final, así que cada checkpoint no tiene que reescribir todas las filas anteriores.
+    #    Las líneas posteriores a las confirmadas en el json se descartan al reanudar.
+    def __init__(
+        self,
+        path: str,
+        fingerprint: dict = None,
+        interval: int = _DEFAULT_INTERVAL,
+        min_seconds: float = _DEFAULT_MIN_SECONDS,
+    ) -> None:
+        self._path = path
+        self._rows_path = path + ".rows.jsonl"
+        # Parámetros de la búsqueda: solo se puede reanudar un checkpoint de la misma búsqueda
+        self._fingerprint = fingerprint or {}
+        # Se guarda cada 'interval' medicamentos, pero no más a menudo que cada
+        # 'min_seconds' segundos
+        self._interval = max(1, interval)
+        self._min_seconds = max(0, min_seconds)
+        self._lock = threading.Lock()
+        self._rows_file = None
+        self._pending = 0
+        self._rows_written = 0
+        self._last_save = time.monotonic()
+        self.ids = []
+        self.completed = set()
+        self.rows_committed = 0
+        # Se marca si el scraping se interrumpe, para conservar el checkpoint
+        self.interrupted = False
+
+    def load(self) -> bool:
+        # Carga el estado de un checkpoint anterior. Devuelve False si no existe
+        if not os.path.exists(self._path):
+            return False
+        with open(self._path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("fingerprint", {}) != self._fingerprint:
+            raise ValueError(
+                f"El checkpoint {self._path} corresponde a otra búsqueda "
+                f"({state.get('fingerprint')}). Elimínelo o ejecute sin --resume."
+            )
+        self.ids = state["ids"]
+        self.completed = set(state["completed"])
+        self.rows_committed = state["rows_committed"]
+        self._rows_written = self.rows_committed
+        logger.info(
+            f"Reanudando desde el checkpoint {self._path}: "
+            f"{len(self.completed)} de {len(self.ids)} medicamentos completados."
+        )
+        return True
+
+    def rows(self) -> MedicineColumns:
+        # Filas confirmadas en el último checkpoint
+        rows = MedicineColumns()
+        if not os.path.exists(self._rows_path):
+            return rows
+        with open(self._rows_path, encoding="utf-8") as f:
+            for line in f:
+                if len(rows) >= self.rows_committed:
+                    break
+                rows.append(json.loads(line))
+        return rows
+
+    def start(self, ids: Optional[List[str]] = None):
+        if ids is not None:
+            self.ids = list(ids)
+        # Se descarta lo que se hubiese escrito después del último checkpoint
+        rows = self.rows()
+        with open(self._rows_path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._rows_written = len(rows)
+        self._rows_file = open(self._rows_path, "a", encoding="utf-8")
+        self.save()
+
+    def record(self, nregistro: str, row: dict):
+        # Se puede llamar desde varios hilos a la vez (workers)
+        with self._lock:
+            self._rows_file.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self._rows_written += 1
+            self.completed.add(str(nregistro))
+            self._pending += 1
+            if (
+                self._pending >= self._interval
+                and time.monotonic() - self._last_save >= self._min_seconds
+            ):
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if self._rows_file is not None:
+            self._rows_file.flush()
+            os.fsync(self._rows_file.fileno())
+        state = {
+            "fingerprint": self._fingerprint,
+            "ids": self.ids,
+            "completed": sorted(self.completed),
+            # Líneas de '<path>.rows.jsonl' (un medicamento repetido en la lista de
+            # identificadores se escribe más de una vez)
+            "rows_committed": self._rows_written,
+        }
+        directory = os.path.dirname(os.path.abspath(self._path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp:
+            json.dump(state, tmp, ensure_ascii=False)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_path, self._path)
+        self.rows_committed = state["rows_committed"]
+        self._pending = 0
+        self._last_save = time.monotonic()
+        logger.debug(
+            f"Checkpoint guardado: {len(self.completed)} de {len(self.ids)} medicamentos."
+        )
+
+    def close(self):
+        if self._rows_file is not None:
+            self.save()
+            self._rows_file.close()
+            self._rows_file = None
+
+    def remove(self):
+        # Se eliminan los ficheros una vez el scraping ha terminado correctamente
+        self.close()
+        for path in (self._path, self._rows_path):
+            if os.path.exists(path):
+                os.remove(path)
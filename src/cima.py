@@ -1,17 +1,58 @@
 import logging
-from time import sleep
+from functools import partial
+from typing import Dict, Optional
 
-from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium import webdriver
 
-from medicines import MedicinesSearch
+from cache import PageCache, SearchSession, search_key
+from drivers import DriverManager
+from medicines import CIMA_URL, MedicinesSearch
+from metrics import Metrics
+from retries import RetryPolicy
+from scheduler import RequestScheduler
+from shards import filter_state
+from waits import AdaptiveWaiter, network_idle
 
 logger = logging.getLogger(__name__)
 
+# Lee el estado de todos los filtros de búsqueda (arguments[0]) y pulsa la etiqueta de los
+# que no están en el estado pedido (arguments[1], {id: activado}), todo en una única
+# llamada. Devuelve también el primer resultado de la lista antes de los cambios, para
+# esperar a que la lista se vuelva a generar
+_JS_FILTROS = """
+var pedido = arguments[1];
+var estado = {};
+var pulsados = [];
+var primero = document.querySelector("#resultlist > div");
+for (var i = 0; i < arguments[0].length; i++) {
+    var id = arguments[0][i];
+    var checkbox = document.getElementById(id);
+    var etiqueta = document.querySelector("label[for='" + id + "']");
+    if (checkbox === null || etiqueta === null) {
+        estado[id] = null;
+        continue;
+    }
+    estado[id] = checkbox.checked;
+    if (pedido.hasOwnProperty(id) && pedido[id] !== checkbox.checked) {
+        etiqueta.click();
+        pulsados.push(id);
+    }
+}
+return {estado: estado, pulsados: pulsados, primero: primero};
+"""
+
+
+def _results_ready(driver) -> bool:
+    # La lista de resultados se actualiza por AJAX al buscar o al cambiar los filtros
+    return (
+        network_idle(driver)
+        and driver.find_element(By.ID, "numResultados").text.strip() != ""
+    )
+
 
 class Cima:
     _FILTROS_BUSQUEDA = {
@@ -35,87 +76,208 @@ class Cima:
         "filtroApRespiratorio": "filtro de los medicamentos por vía respiratoria",
     }
 
-    def __init__(self, driver: webdriver, sleep_time: float, timeout: float) -> None:
+    def __init__(
+        self,
+        driver: webdriver,
+        sleep_time: float,
+        timeout: float,
+        base_url: str = CIMA_URL,
+        parser: str = "bs4",
+        cache: PageCache = None,
+        waiter: AdaptiveWaiter = None,
+        scheduler: RequestScheduler = None,
+        driver_manager: DriverManager = None,
+        metrics: Metrics = None,
+        retry_policy: RetryPolicy = None,
+    ) -> None:
         self._driver = driver
+        self._base_url = base_url.rstrip("/")
+        self._parser = parser
+        self._cache = cache
         self._sleep_time = sleep_time
         self._timeout = timeout
+        self._waiter = waiter or AdaptiveWaiter()
+        self._scheduler = scheduler or RequestScheduler()
+        self._driver_manager = driver_manager
+        self._metrics = metrics or Metrics()
+        self._retry_policy = retry_policy
         self._wait = WebDriverWait(driver, self._timeout)
+        # Búsquedas hechas en esta ejecución, búsqueda que muestra el navegador (y su URL) y
+        # estado por defecto de los filtros en la página de búsqueda
+        self._sessions = {}
+        self._current = None
+        self._default_filters = None
 
     def get_home(self):
-        self._driver.get("https://cima.aemps.es/cima/publico/home.html")
+        with self._scheduler.request("inicio"):
+            self._driver.get(f"{self._base_url}/cima/publico/home.html")
+
+    def open_search_page(self):
+        # Carga la página de búsqueda y lee el estado por defecto de los filtros, de forma
+        # que las siguientes búsquedas la pueden reutilizar sin volver a cargarla
+        self.get_home()
+        self._default_filters = self.get_search_filters_state()
 
     def search_medicines(
         self, search: str, search_filters: list, remove_default_filters: bool,
     ) -> MedicinesSearch:
-        self.get_home()
+        key = search_key(self._base_url, search, search_filters, remove_default_filters)
+        session = self._sessions.get(key)
+        if session is None:
+            session = SearchSession.load(key, self._cache)
+            self._sessions[key] = session
+        open_search = partial(
+            self._search, session, search, search_filters, remove_default_filters
+        )
+        if session.total is None:
+            open_search()
+            open_search = None
+        else:
+            # Búsqueda repetida (en esta ejecución o en una anterior): la búsqueda solo se
+            # hace en el navegador si se necesitan más resultados de los que ya se conocen
+            logger.info(
+                f"Búsqueda '{search}' obtenida de la caché de búsquedas: {session.total}"
+                f" medicamentos ({len(session.ids)} números de registro conocidos)"
+            )
+            if self._showing(session):
+                open_search = None
+        return MedicinesSearch(
+            self._driver,
+            sleep_time=self._sleep_time,
+            timeout=self._timeout,
+            base_url=self._base_url,
+            parser=self._parser,
+            cache=self._cache,
+            waiter=self._waiter,
+            scheduler=self._scheduler,
+            driver_manager=self._driver_manager,
+            metrics=self._metrics,
+            retry_policy=self._retry_policy,
+            session=session,
+            open_search=open_search,
+        )
+
+    def _search(
+        self,
+        session: SearchSession,
+        search: str,
+        search_filters: list,
+        remove_default_filters: bool,
+    ):
+        if self._showing(session):
+            logger.info(
+                f"Reutilizando la lista de resultados de la búsqueda '{search}'"
+            )
+            return
+        # Si el navegador ya está en la página de búsqueda no hace falta volver a cargarla:
+        # basta con escribir la nueva búsqueda y dejar los filtros en su estado por defecto
+        reload = self._default_filters is None or not self._on_search_page()
+        previous_result = None
+        if reload:
+            self.get_home()
+        else:
+            previous_result = self._first_result()
         logger.debug(f"Finding {search} ...")
         buscador = self._driver.find_element(By.ID, "inputbuscadorsimple")
         buscador.clear()
         buscador.send_keys(search)
-        buscador.send_keys(Keys.ENTER)
-        sleep(self._sleep_time)
+        with self._scheduler.request("búsqueda"):
+            buscador.send_keys(Keys.ENTER)
+            self._wait_for_results("búsqueda", previous_result)
         self._wait.until(
             EC.presence_of_all_elements_located((By.XPATH, "//*[@id='resultlist']/div"))
         )
         logger.debug(f"Navigated to: '{self._driver.title}'")
         if remove_default_filters:
-            self.deselect_all_search_filters()
+            logger.info("Desactivando todos los filtros activos...")
+            state = dict.fromkeys(self._FILTROS_BUSQUEDA, False)
+        elif reload:
+            state = {}
+        else:
+            state = {f: v for f, v in self._default_filters.items() if v is not None}
         if search_filters:
-            self.select_search_filters(search_filters)
+            logger.info(
+                f"Activando los siguientes filtros: {' ,'.join(search_filters)}"
+            )
+            state.update(filter_state(search_filters))
+        previous_state = self.set_search_filters(state)
+        if reload:
+            # Recién cargada la página, los filtros están en su estado por defecto
+            self._default_filters = previous_state
         num_elements = int(self._driver.find_element(By.ID, "numResultados").text)
         if num_elements == 0:
             raise ValueError("No se ha encontrado ningun resultado para esta búsqueda!")
         logger.info(
             f"Se han encontrado {num_elements} medicamentos para la búsqueda '{search}'"
         )
-        return MedicinesSearch(
-            self._driver, sleep_time=self._sleep_time, timeout=self._timeout,
+        session.update(total=num_elements)
+        self._current = (session.key, self._driver.current_url)
+
+    def _on_search_page(self) -> bool:
+        return self._driver.current_url.startswith(
+            f"{self._base_url}/cima/publico/home.html"
+        ) and bool(self._driver.find_elements(By.ID, "inputbuscadorsimple"))
+
+    def _showing(self, session: SearchSession) -> bool:
+        # El navegador sigue en la lista de resultados de esta búsqueda (no ha navegado a
+        # otra página ni hecho otra búsqueda desde entonces)
+        return (
+            self._current is not None
+            and self._current == (session.key, self._driver.current_url)
+            and self._first_result() is not None
         )
 
-    def deselect_all_search_filters(self):
-        logger.info("Desactivando todos los filtros activos...")
-        for i, v in self._FILTROS_BUSQUEDA.items():
-            try:
-                # Nos aseguramos de que el código se pueda ejecutar si salta algún error
-                if self._driver.find_element(By.ID, i).is_selected():
-                    checkbox = self._driver.find_element(
-                        By.CSS_SELECTOR, "label[for={}]".format(i)
-                    )
-                    self._driver.execute_script("arguments[0].click();", checkbox)
-            except NoSuchElementException:
-                # Identificamos el error correspondiente al de los elementos que identifican los checkbox
+    def get_search_filters_state(self) -> Dict[str, Optional[bool]]:
+        # Estado (activado o no) de todos los filtros, leído con una única llamada. None si
+        # el filtro no existe en la página
+        return self.set_search_filters({})
+
+    def set_search_filters(self, state: Dict[str, bool]) -> Dict[str, Optional[bool]]:
+        # Deja los filtros indicados ({id: activado}) en el estado pedido con una única
+        # llamada al navegador, que lee todos los checkbox y pulsa solo los que tienen que
+        # cambiar, y una única espera a que se actualice la lista de resultados. Devuelve el
+        # estado que tenían todos los filtros antes del cambio
+        filters = list(dict.fromkeys([*self._FILTROS_BUSQUEDA, *state]))
+        with self._scheduler.request("filtros"):
+            result = self._driver.execute_script(_JS_FILTROS, filters, state)
+            if result["pulsados"]:
+                # Cada cambio de filtro lanza una nueva búsqueda en la web: se espera a que
+                # la lista se haya generado después del último
+                self._wait_for_results("filtros", result["primero"])
+        for i in state:
+            if result["estado"].get(i) is None:
                 logger.warning(
                     "El {} ya no existe en la página web o su id en el html ha cambiado de nombre".format(
-                        v
+                        self._FILTROS_BUSQUEDA.get(i, i)
                     )
                 )
-            except:
-                logger.error("Ha ocurrido un error para el {}".format(v))
-                raise
-        sleep(self._sleep_time)
+        if result["pulsados"]:
+            logger.info(f"Filtros cambiados: {', '.join(result['pulsados'])}")
+        return result["estado"]
+
+    def deselect_all_search_filters(self):
+        logger.info("Desactivando todos los filtros activos...")
+        self.set_search_filters(dict.fromkeys(self._FILTROS_BUSQUEDA, False))
         logger.info("Hecho!")
 
     def select_search_filters(self, filters: list):
         logger.info(f"Activando los siguientes filtros: {' ,'.join(filters)}")
-        for i in filters:
-            try:
-                # Nos aseguramos de que el código se pueda ejecutar si salta algún error
-                if not self._driver.find_element(By.ID, i).is_selected():
-                    checkbox = self._driver.find_element(
-                        By.CSS_SELECTOR, "label[for={}]".format(i)
-                    )
-                    self._driver.execute_script("arguments[0].click();", checkbox)
-            except NoSuchElementException:
-                # Identificamos el error correspondiente al de los elementos que identifican los checkbox
-                logger.warning(
-                    "El {} ya no existe en la página web o su id en el html ha cambiado de nombre".format(
-                        self._FILTROS_BUSQUEDA[i]
-                    )
-                )
-            except:
-                logger.error(
-                    "Ha ocurrido un error para el {}".format(self._FILTROS_BUSQUEDA[i])
-                )
-                raise
-        sleep(self._sleep_time)
+        self.set_search_filters(dict.fromkeys(filters, True))
         logger.info("Hecho!")
+
+    def _first_result(self):
+        results = self._driver.find_elements(By.XPATH, "//*[@id='resultlist']/div")
+        return results[0] if results else None
+
+    def _wait_for_results(self, name: str, previous_result=None):
+        # Espera a que la lista de resultados se haya actualizado, como mucho 'sleep_time'.
+        # Si ya había resultados, la lista se ha vuelto a generar cuando el primero de ellos
+        # deja de estar en el DOM
+        def updated(driver):
+            if previous_result is not None and not EC.staleness_of(previous_result)(
+                driver
+            ):
+                return False
+            return _results_ready(driver)
+
+        self._waiter.until(self._driver, name, updated, max_wait=self._sleep_time)
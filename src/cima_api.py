@@ -0,0 +1,274 @@
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Callable, Iterator, List
+from zoneinfo import ZoneInfo
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import PageCache
+from metrics import Metrics
+from pool import WorkerPool
+from records import MedicineColumns, MedicineRecord
+from retries import RetryPolicy, classify_error, is_transient
+from scheduler import RequestScheduler
+
+logger = logging.getLogger(__name__)
+
+_CIMA_TIMEZONE = ZoneInfo("Europe/Madrid")
+
+# Equivalencia entre los filtros de la búsqueda de la web y los parámetros del listado
+# paginado de la API (/cima/rest/medicamentos). El resto de filtros no tienen equivalente
+_FILTROS_API = {
+    "filtroRecetaSi": ("receta", 1),
+    "filtroRecetaNo": ("receta", 0),
+    "filtroTrianguloSi": ("triangulo", 1),
+    "filtroTrianguloNo": ("triangulo", 0),
+    "filtroHuerfanoSi": ("huerfano", 1),
+    "filtroHuerfanoNo": ("huerfano", 0),
+    "filtroBiosimilarSi": ("biosimilar", 1),
+    "filtroBiosimilarNo": ("biosimilar", 0),
+    "filtroComercializadoSi": ("comerc", 1),
+    "filtroComercializadoNo": ("comerc", 0),
+    "filtroAutorizado": ("autorizados", 1),
+}
+
+
+def api_search_params(search: str, search_filters: List[str]) -> dict:
+    unsupported = [f for f in search_filters if f not in _FILTROS_API]
+    if unsupported:
+        raise ValueError(
+            f"Los filtros {', '.join(unsupported)} no están disponibles en el listado de la API"
+        )
+    params = dict(_FILTROS_API[f] for f in search_filters)
+    if search and search != "*":
+        params["nombre"] = search
+    return params
+
+
+def parse_medicine_json(payload: str) -> dict:
+    # Función a nivel de módulo para que se pueda enviar a otros procesos
+    return MedicineJsonDetails(payload).scrape_data()
+
+
+class MedicineJsonDetails:
+    def __init__(self, payload: str) -> None:
+        self._payload = payload
+
+    @staticmethod
+    def _format_date(timestamp: int):
+        # La API devuelve las fechas como timestamps en milisegundos. Las convertimos al
+        # mismo formato "dd/mm/aaaa" que se muestra en la página de detalle
+        if timestamp is None:
+            return None
+        return datetime.fromtimestamp(timestamp / 1000, tz=_CIMA_TIMEZONE).strftime(
+            "%d/%m/%Y"
+        )
+
+    def scrape_data(self) -> dict:
+        data = json.loads(self._payload)
+
+        # El estado de la página de detalle sale del campo 'estado': fecha de autorización,
+        # de suspensión y de revocación (un medicamento revocado conserva la fecha en la
+        # que se autorizó, pero ya no aparece como autorizado)
+        estado = data.get("estado") or {}
+        autorizado_bool = estado.get("aut") is not None and estado.get("rev") is None
+        autorizado_fecha = (
+            self._format_date(estado.get("aut")) if autorizado_bool else None
+        )
+        suspendido_fecha = self._format_date(estado.get("susp"))
+
+        forma_farmaceutica = data.get("formaFarmaceutica") or {}
+
+        # Mismo formato de fila que MedicineDetails.scrape_data
+        nueva_fila = {
+            "Número de registro": data["nregistro"],
+            "Medicamento": data.get("nombre"),
+            "Laboratorio": data.get("labtitular"),
+            "Autorizado": autorizado_bool,
+            "Fecha autorización": autorizado_fecha,
+            "Suspendido": suspendido_fecha is not None,
+            "Fecha suspensión": suspendido_fecha,
+            "Comercializado": bool(data.get("comerc")),
+            "Vías administración": [
+                va["nombre"] for va in data.get("viasAdministracion") or []
+            ],
+            "Dosis": [data["dosis"]] if data.get("dosis") else [],
+            "Formas farmacéuticas": (
+                [forma_farmaceutica["nombre"]]
+                if forma_farmaceutica.get("nombre")
+                else []
+            ),
+            "Principios activos": [
+                pa["nombre"] for pa in data.get("principiosActivos") or []
+            ],
+            "Excipientes": [e["nombre"] for e in data.get("excipientes") or []],
+            # Las etiquetas de características de la página no están en la API (sus campos
+            # booleanos no se corresponden con ellas), así que la columna queda vacía
+            "Características": [],
+            "Códigos ATC": [
+                f"{atc['codigo']} - {atc['nombre']}" for atc in data.get("atcs") or []
+            ],
+            "Formatos": [
+                {"Titulo": p.get("nombre"), "Codigo Nacional": p.get("cn")}
+                for p in data.get("presentaciones") or []
+            ],
+        }
+
+        return nueva_fila
+
+
+class CimaApiClient:
+    def __init__(
+        self,
+        base_url: str,
+        timeout: float,
+        pool_size: int = 10,
+        cache: PageCache = None,
+        scheduler: RequestScheduler = None,
+        metrics: Metrics = None,
+        retry_policy: RetryPolicy = None,
+        max_retries: int = 2,
+    ) -> None:
+        self._base_url = base_url.rstrip("/")
+        self._timeout = timeout
+        self._max_retries = max(0, max_retries)
+        self._cache = cache
+        self._scheduler = scheduler or RequestScheduler()
+        self._metrics = metrics or Metrics()
+        # Espera entre reintentos y fichero de medicamentos fallidos
+        self._retry_policy = retry_policy or RetryPolicy()
+        # Una única sesión con keep-alive: las conexiones TCP/TLS se reutilizan entre
+        # peticiones y entre hilos en lugar de abrir una nueva para cada medicamento
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers.update({"Accept": "application/json"})
+
+    def close(self):
+        self._session.close()
+
+    def get_medicine_json(self, med_id_number) -> str:
+        if self._cache is not None:
+            payload = self._cache.get(med_id_number, formato="json")
+            if payload is not None:
+                self._metrics.inc("cache_hits_total")
+                return payload
+        with self._scheduler.request("detalle"), self._metrics.timer("peticion http"):
+            response = self._session.get(
+                f"{self._base_url}/cima/rest/medicamento",
+                params={"nregistro": med_id_number},
+                timeout=self._timeout,
+            )
+            response.raise_for_status()
+        if self._cache is not None:
+            self._cache.put(med_id_number, response.text, formato="json")
+        return response.text
+
+    def get_medicines_page(self, params: dict, page: int) -> dict:
+        # Una página del listado que falla no se puede apartar para más tarde como un
+        # medicamento (el resto del recorrido depende de ella), así que se reintenta aquí
+        # mismo con la espera de la política de reintentos
+        attempt = 0
+        while True:
+            try:
+                with self._scheduler.request("listado"):
+                    response = self._session.get(
+                        f"{self._base_url}/cima/rest/medicamentos",
+                        params={**params, "pagina": page},
+                        timeout=self._timeout,
+                    )
+                    response.raise_for_status()
+                return response.json()
+            except Exception as err:
+                attempt += 1
+                if attempt > self._max_retries or not is_transient(err):
+                    raise
+                delay = self._retry_policy.delay(attempt)
+                logger.warning(
+                    f"Página {page} del listado - Intento {attempt}/{self._max_retries + 1} "
+                    f"fallido ({type(err).__name__}). Reintentando en {delay:.1f}s"
+                )
+                self._metrics.inc("retries_total", tipo=classify_error(err))
+                time.sleep(delay)
+
+    def count_medicines(self, params: dict) -> int:
+        return self.get_medicines_page(params, 1)["totalFilas"]
+
+    def iter_medicines_id_numbers(
+        self, params: dict, max_elements: int = -1
+    ) -> Iterator[str]:
+        # Recorre el listado paginado de la búsqueda (el mismo que usa la lista de resultados
+        # de la web) y devuelve los números de registro a medida que llega cada página, sin
+        # navegador. Con -1 se recorren todos los resultados
+        n_yielded = 0
+        page = 1
+        while max_elements == -1 or n_yielded < max_elements:
+            data = self.get_medicines_page(params, page)
+            resultados = data.get("resultados") or []
+            for med in resultados:
+                yield str(med["nregistro"])
+                n_yielded += 1
+                if n_yielded == max_elements:
+                    return
+            if not resultados or n_yielded >= data.get("totalFilas", 0):
+                return
+            logger.debug(
+                f"Página {page} del listado: {n_yielded} de {data.get('totalFilas')} medicamentos"
+            )
+            page += 1
+
+    def scrape_medicine_by_id_number(self, med_id_number) -> dict:
+        with self._metrics.profile(med_id_number):
+            payload = self.get_medicine_json(med_id_number)
+            with self._metrics.timer("parseo"):
+                try:
+                    return MedicineJsonDetails(payload).scrape_data()
+                except Exception:
+                    # Al reintentarlo, el json se vuelve a descargar en lugar de leerse de
+                    # la caché
+                    if self._cache is not None:
+                        self._cache.delete(med_id_number, formato="json")
+                    raise
+
+    def scrape_medicines_by_id_numbers(
+        self,
+        meds_id_numbers: list,
+        workers: int,
+        max_retries: int,
+        on_result: Callable[[str, dict], None] = None,
+        on_discard: Callable[[str], None] = None,
+        keep_rows: bool = True,
+    ) -> MedicineColumns:
+        # Con 'keep_rows' a False las filas solo se entregan a 'on_result' y no se
+        # acumulan en memoria (se devuelve un resultado vacío)
+        logger.info(
+            f"Scraping {len(meds_id_numbers)} medicamentos por HTTP con {workers} peticiones concurrentes..."
+        )
+
+        def scrape(client, med_id_number):
+            med_data = client.scrape_medicine_by_id_number(med_id_number)
+            logger.debug(
+                f"Id medicamento: {med_id_number} - '{med_data['Medicamento']}'"
+            )
+            if on_result is not None:
+                on_result(med_id_number, med_data)
+            if not keep_rows:
+                return None
+            # Mientras terminan el resto de medicamentos se guarda en formato compacto
+            return MedicineRecord.from_row(med_data)
+
+        # Todos los workers comparten el mismo cliente (y por tanto el mismo pool de conexiones)
+        pool = WorkerPool(
+            worker_factory=lambda: self,
+            num_workers=workers,
+            max_retries=max_retries,
+            metrics=self._metrics,
+            retry_policy=self._retry_policy,
+            on_discard=on_discard,
+        )
+        results = pool.map(scrape, meds_id_numbers)
+        return MedicineColumns(record for record in results if record is not None)
@@ -0,0 +1,207 @@
+import importlib.util
+import json
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
+
+logger = logging.getLogger(__name__)
+
+_DRIVER_PATH_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "medicinescraper", "chromedriver.json"
+)
+# Recursos que se pueden bloquear y patrones de las URLs correspondientes
+_RECURSOS = {
+    "images": ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.ico", "*.webp"],
+    "fonts": ["*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot"],
+    "css": ["*.css"],
+}
+# El reemplazo de un navegador se empieza a preparar al llegar a esta fracción del límite
+_PREWARM_FRACTION = 0.9
+# El consumo de memoria se comprueba cada este nº de páginas
+_RSS_CHECK_INTERVAL = 10
+
+_driver_path = None
+_driver_path_lock = threading.Lock()
+
+
+def resolve_driver_path(cache_file: str = _DRIVER_PATH_CACHE) -> str:
+    # ChromeDriverManager().install() consulta en internet la última versión del driver cada
+    # vez que se llama. La ruta se guarda en memoria y en disco para que los siguientes
+    # navegadores (y las siguientes ejecuciones) arranquen sin acceder a la red
+    global _driver_path
+    with _driver_path_lock:
+        if _driver_path is not None:
+            return _driver_path
+        try:
+            with open(cache_file, encoding="utf-8") as f:
+                path = json.load(f)["path"]
+            if os.path.exists(path):
+                _driver_path = path
+                return path
+        except (OSError, ValueError, KeyError):
+            pass
+        from webdriver_manager.chrome import ChromeDriverManager
+
+        path = ChromeDriverManager().install()
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(cache_file, "w", encoding="utf-8") as f:
+                json.dump({"path": path}, f)
+        except OSError as err:
+            logger.warning(f"No se ha podido guardar la ruta del driver: {err}")
+        _driver_path = path
+        return path
+
+
+def create_chrome_driver(
+    driver_path: Optional[str] = None,
+    block_resources: List[str] = None,
+    page_load_strategy: str = "eager",
+) -> webdriver:
+    chrome_options = webdriver.ChromeOptions()
+    chrome_options.add_argument("--headless")  # No interface
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument(
+        "--user-agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) \
+        AppleWebKit/537.36 (KHTML, like Gecko) Chrome/95.0.4638.69 Safari/537.36'"
+    )
+    # Con 'eager' la navegación termina al cargarse el DOM, sin esperar a imágenes y demás
+    # recursos. Los datos se esperan igualmente con las esperas de MedicinesSearch
+    chrome_options.page_load_strategy = page_load_strategy
+    block_resources = block_resources or []
+    if "images" in block_resources:
+        chrome_options.add_experimental_option(
+            "prefs", {"profile.managed_default_content_settings.images": 2}
+        )
+    driver = webdriver.Chrome(
+        service=Service(driver_path or resolve_driver_path()), options=chrome_options
+    )
+    urls = [url for recurso in block_resources for url in _RECURSOS[recurso]]
+    if urls:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": urls})
+    return driver
+
+
+def browser_rss(driver) -> Optional[int]:
+    # Memoria (en bytes) del chromedriver y de todos los procesos de Chrome que cuelgan de él
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        process = psutil.Process(driver.service.process.pid)
+        return sum(
+            p.memory_info().rss for p in [process, *process.children(recursive=True)]
+        )
+    except (AttributeError, psutil.Error):
+        return None
+
+
+class _DriverState:
+    def __init__(self) -> None:
+        self.pages = 0
+        self.replacement: Optional[Future] = None
+
+
+class DriverManager:
+    # Ciclo de vida de los navegadores. En scrapings largos Chrome va ocupando cada vez más
+    # memoria y se vuelve más lento, así que cada navegador se sustituye por uno nuevo tras
+    # 'max_pages' páginas o al superar 'max_rss' bytes. El reemplazo se arranca en segundo
+    # plano un poco antes de llegar al límite para que el cambio sea inmediato
+    def __init__(
+        self,
+        factory: Callable[[], webdriver],
+        max_pages: Optional[int] = None,
+        max_rss: Optional[int] = None,
+        prewarm: bool = True,
+    ) -> None:
+        self._factory = factory
+        self._max_pages = max_pages
+        self._max_rss = max_rss
+        self._prewarm = prewarm
+        self._lock = threading.Lock()
+        self._drivers: Dict[int, _DriverState] = {}
+        self._live = {}
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="driver")
+        self.recycled = 0
+        if max_rss is not None and importlib.util.find_spec("psutil") is None:
+            logger.warning(
+                "El límite de memoria de los navegadores requiere instalar psutil"
+                " (pip install psutil). Solo se aplicará el límite de páginas."
+            )
+
+    def new_driver(self) -> webdriver:
+        return self._register(self._factory())
+
+    def _register(self, driver) -> webdriver:
+        with self._lock:
+            self._drivers[id(driver)] = _DriverState()
+            self._live[id(driver)] = driver
+        return driver
+
+    def page_done(self, driver) -> Optional[webdriver]:
+        # Se llama tras cada página de detalle. Devuelve el nuevo navegador si 'driver' se ha
+        # sustituido (y ya no se debe utilizar), o None si se puede seguir utilizando
+        with self._lock:
+            state = self._drivers.get(id(driver))
+        if state is None:
+            return None
+        state.pages += 1
+        usage = self._usage(driver, state)
+        if usage >= _PREWARM_FRACTION and self._prewarm and state.replacement is None:
+            state.replacement = self._executor.submit(self._factory)
+        if usage < 1:
+            return None
+        if state.replacement is not None:
+            new_driver = self._register(state.replacement.result())
+            state.replacement = None
+        else:
+            new_driver = self.new_driver()
+        self.recycled += 1
+        logger.info(
+            f"Navegador sustituido tras {state.pages} páginas "
+            f"({self.recycled} sustituciones en total)"
+        )
+        # El navegador antiguo se cierra en segundo plano
+        self._executor.submit(self.quit, driver)
+        return new_driver
+
+    def _usage(self, driver, state: _DriverState) -> float:
+        # Fracción del límite (de páginas o de memoria) alcanzada por el navegador
+        usage = 0.0
+        if self._max_pages:
+            usage = state.pages / self._max_pages
+        if self._max_rss and state.pages % _RSS_CHECK_INTERVAL == 0:
+            rss = browser_rss(driver)
+            if rss is not None:
+                usage = max(usage, rss / self._max_rss)
+        return usage
+
+    def quit(self, driver):
+        with self._lock:
+            state = self._drivers.pop(id(driver), None)
+            self._live.pop(id(driver), None)
+        if state is not None and state.replacement is not None:
+            # Un reemplazo preparado que no se ha llegado a utilizar
+            state.replacement.add_done_callback(
+                lambda f: f.exception() is None and f.result().quit()
+            )
+        try:
+            driver.quit()
+        except Exception as err:
+            logger.warning(f"No se ha podido cerrar el navegador correctamente: {err}")
+
+    def close(self):
+        with self._lock:
+            drivers = list(self._live.values())
+        for driver in drivers:
+            self.quit(driver)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,128 @@
+import logging
+import random
+from typing import Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from cache import PageCache
+
+logger = logging.getLogger(__name__)
+
+_INDEX = "Número de registro"
+
+
+class IncrementalPlan:
+    def __init__(self, new: List[str], missing: List[str], refresh: List[str]) -> None:
+        # Medicamentos que no estaban en el dataset anterior, que ya no aparecen en la
+        # búsqueda y que, aun estando en ambos, se vuelven a descargar para actualizarlos
+        self.new = new
+        self.missing = missing
+        self.refresh = refresh
+
+    @property
+    def to_fetch(self) -> List[str]:
+        return self.new + self.refresh
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self.new)} nuevos, {len(self.missing)} eliminados, "
+            f"{len(self.refresh)} a actualizar"
+        )
+
+
+def load_previous_dataset(path: str) -> pd.DataFrame:
+    # Todas las columnas se leen como texto y sin convertir las celdas vacías a NaN, de forma
+    # que las filas que no cambian se vuelven a escribir exactamente igual
+    previous = pd.read_csv(path, index_col=_INDEX, dtype=str, keep_default_na=False)
+    return previous[~previous.index.duplicated(keep="last")]
+
+
+def plan_incremental(
+    current_ids: List[str],
+    previous: pd.DataFrame,
+    refresh_fraction: float = 0.0,
+    refresh_older_than: Optional[float] = None,
+    cache: PageCache = None,
+    formato: str = "html",
+    seed: Optional[int] = None,
+) -> IncrementalPlan:
+    previous_ids = set(previous.index)
+    current = set(current_ids)
+    new = [m for m in current_ids if m not in previous_ids]
+    missing = [m for m in previous.index if m not in current]
+    known = [m for m in current_ids if m in previous_ids]
+
+    refresh = set()
+    if refresh_fraction > 0:
+        # Muestra aleatoria de los medicamentos ya conocidos
+        k = min(len(known), round(len(known) * refresh_fraction))
+        refresh.update(random.Random(seed).sample(known, k))
+    if refresh_older_than is not None and cache is not None:
+        # Se actualizan los medicamentos cuya página se descargó hace más de
+        # 'refresh_older_than' segundos (o de los que no se tiene fecha)
+        for m in known:
+            age = cache.age(m, formato)
+            if age is None or age > refresh_older_than:
+                refresh.add(m)
+    return IncrementalPlan(
+        new=new, missing=missing, refresh=[m for m in known if m in refresh]
+    )
+
+
+def _to_csv_value(value) -> str:
+    # Representación con la que el valor queda escrito en el CSV
+    return "" if value is None else str(value)
+
+
+def merge_incremental(
+    current_ids: List[str],
+    previous: pd.DataFrame,
+    fetched_rows: Iterable[dict],
+    plan: IncrementalPlan,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    fetched = {str(row[_INDEX]): row for row in fetched_rows}
+    previous_rows = previous.to_dict("index")
+    records = []
+    changes = []
+    for m in current_ids:
+        if m in fetched:
+            row = {col: _to_csv_value(value) for col, value in fetched[m].items()}
+            if m in previous_rows:
+                old = previous_rows[m]
+                modified = [
+                    col
+                    for col, value in row.items()
+                    if col != _INDEX and value != old.get(col, "")
+                ]
+                if modified:
+                    changes.append(
+                        {
+                            _INDEX: m,
+                            "Cambio": "modificado",
+                            "Columnas": ", ".join(modified),
+                        }
+                    )
+            else:
+                changes.append({_INDEX: m, "Cambio": "nuevo", "Columnas": ""})
+            records.append(row)
+        elif m in previous_rows:
+            # Si no se ha podido descargar, se mantiene la versión anterior
+            records.append({_INDEX: m, **previous_rows[m]})
+    for m in plan.missing:
+        changes.append({_INDEX: m, "Cambio": "eliminado", "Columnas": ""})
+
+    # Si el parser ha añadido columnas nuevas, se añaden al final (vacías en las filas antiguas)
+    columns = [_INDEX, *previous.columns]
+    for row in fetched.values():
+        columns.extend(col for col in row if col not in columns)
+    merged = pd.DataFrame.from_records(records, columns=columns)
+    changelog = pd.DataFrame.from_records(
+        changes, columns=[_INDEX, "Cambio", "Columnas"]
+    )
+    logger.info(
+        f"Dataset actualizado: {len(merged)} medicamentos. Cambios: "
+        + ", ".join(
+            f"{n} {cambio}s" for cambio, n in changelog["Cambio"].value_counts().items()
+        )
+    )
+    return merged.set_index(_INDEX), changelog
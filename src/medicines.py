@@ -1,22 +1,88 @@
 import logging
 import re
-from time import sleep
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Iterable, Optional
 
 from bs4 import BeautifulSoup
 from selenium import webdriver
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 
+from cache import PageCache, SearchSession
+from checkpoint import CrawlCheckpoint
+from drivers import DriverManager
+from metrics import Metrics
+from parsers import (
+    parse_codigo_nacional,
+    parse_fecha_estado,
+    scrape_data_lxml,
+    scrape_data_selectolax,
+)
+from pool import OrderedProcessPool, ReorderBuffer, WorkerPool
+from records import MedicineColumns, MedicineRecord
+from retries import RetryPolicy, RetryQueue
+from scheduler import RequestScheduler
+from waits import AdaptiveWaiter, count_elements, num_elements_greater_than
+
 logger = logging.getLogger(__name__)
 
+_MEDICAMENTOS_LISTA = "div[onclick*=medicamentoOnSelect]"
+# Devuelve en una única llamada el atributo onclick de los elementos [inicio, fin) de la lista
+# de resultados, en lugar de una llamada a get_attribute por elemento
+_JS_IDENTIFICADORES = """
+var meds = document.querySelectorAll(arguments[0]);
+var fin = arguments[2] === null ? meds.length : Math.min(arguments[2], meds.length);
+var ids = [];
+for (var i = arguments[1]; i < fin; i++) {
+    ids.push(meds[i].getAttribute("onclick"));
+}
+return ids;
+"""
+
+CIMA_URL = "https://cima.aemps.es"
+
+
+def parse_medicine_html(html: str, parser: str = "bs4") -> dict:
+    # Función a nivel de módulo para que se pueda enviar a otros procesos
+    return MedicineDetails(html=html, parser=parser).scrape_data()
+
+
+def sort_by_id_numbers(data: MedicineColumns, meds_id_numbers: list) -> MedicineColumns:
+    # Ordena las filas según la lista de números de registro (p.ej. la lista de resultados);
+    # las que no aparecen en ella quedan al final
+    order = {m: index for index, m in enumerate(meds_id_numbers)}
+    numeros = data.column("Número de registro")
+    data.reorder(
+        sorted(
+            range(len(data)),
+            key=lambda index: order.get(numeros[index], len(order)),
+        )
+    )
+    return data
+
 
 class MedicineDetails:
-    def __init__(self, html: str) -> None:
+    PARSERS = ["bs4", "lxml", "selectolax"]
+
+    def __init__(self, html: str, parser: str = "bs4") -> None:
+        if parser not in self.PARSERS:
+            raise ValueError(
+                f"Parser '{parser}' no soportado. Opciones: {', '.join(self.PARSERS)}"
+            )
         self._html = html
+        self._parser = parser
 
     def scrape_data(self) -> dict:
+        # Los parsers alternativos localizan todos los elementos en una sola pasada por el
+        # documento y producen exactamente la misma fila que el parser de BeautifulSoup
+        if self._parser == "lxml":
+            return scrape_data_lxml(self._html)
+        if self._parser == "selectolax":
+            return scrape_data_selectolax(self._html)
+
         # Utilizamos un objeto BeautifulSoup para scrapear la página
         bs = BeautifulSoup(self._html, "html.parser")
 
@@ -34,31 +100,14 @@ class MedicineDetails:
         # Comprobamos si un medicamento se ha autorizado o no.
         # Esta información está contenida en la tag h2 identificada por el atributo id=estadoXS
         # Si no está autorizado, entonces la tag esta vacía. Si sí lo está entonces aparece el contenido no vacío con el formato "Autorizado ( dd/mm/aaaa )"
-        autorizado_bool = not bs.find("h2", {"id": "estadoXS"}).get_text() == ""
-        if autorizado_bool:
-            autorizado_fecha = re.sub(
-                "\( | \)",  # Quitamos los paréntesis y los espacios
-                "",
-                re.findall(
-                    "\(.*\)",  # Encontramos mediante una expresión regular el contenido de la fecha
-                    bs.find("h2", {"id": "estadoXS"}).get_text(),
-                )[0],
-            ).strip()  # Nos aseguramos de que no hay ningún espacio adicional
-        else:
-            autorizado_fecha = None
+        autorizado_bool, autorizado_fecha = parse_fecha_estado(
+            bs.find("h2", {"id": "estadoXS"}).get_text()
+        )
 
         # Explicación análoga al apartado anterior para, en este caso, el estado de suspendido
-        suspendido_bool = not bs.find("h2", {"id": "estadoXSsec"}).get_text() == ""
-        if suspendido_bool:
-            suspendido_fecha = re.sub(
-                "\( | \)",
-                "",
-                re.findall("\(.*\)", bs.find("h2", {"id": "estadoXSsec"}).get_text())[
-                    0
-                ],
-            ).strip()
-        else:
-            suspendido_fecha = None
+        suspendido_bool, suspendido_fecha = parse_fecha_estado(
+            bs.find("h2", {"id": "estadoXSsec"}).get_text()
+        )
 
         # Si el medicamento está o no comercializado se identifica con un tag h3 identificado por la id='estadocomercXS'
         comercializado_bool = not bs.find("h3", {"id": "estadocomercXS"}) == None
@@ -95,7 +144,7 @@ class MedicineDetails:
         for fmt in formatos:
             title, cn = fmt.find_all("h6")
             title = title.get_text()
-            cn = cn.get_text().strip(" National code: ").strip()
+            cn = parse_codigo_nacional(cn.get_text())
             formatos_parsed.append({"Titulo": title, "Codigo Nacional": cn})
 
         # Se guardan todos los elementos extraídos anteriormente en una nueva fila cuyo índice en el DataFrame será el número de registro
@@ -122,146 +171,634 @@ class MedicineDetails:
 
 
 class MedicinesSearch:
-    def __init__(self, driver: webdriver, sleep_time: float, timeout: float) -> None:
+    def __init__(
+        self,
+        driver: webdriver,
+        sleep_time: float,
+        timeout: float,
+        base_url: str = CIMA_URL,
+        parser: str = "bs4",
+        cache: PageCache = None,
+        waiter: AdaptiveWaiter = None,
+        scheduler: RequestScheduler = None,
+        driver_manager: DriverManager = None,
+        metrics: Metrics = None,
+        retry_policy: RetryPolicy = None,
+        session: SearchSession = None,
+        open_search: Callable[[], None] = None,
+    ) -> None:
         self._driver = driver
+        # Si se especifica, el navegador se sustituye periódicamente por uno nuevo
+        self._driver_manager = driver_manager
+        self._base_url = base_url
+        self._parser = parser
+        self._cache = cache
+        self._parse_pool = None
+        # Los tiempos de sleep son solo el límite superior de las esperas adaptativas
         self._sleep_time = sleep_time
         self._timeout = timeout
+        self._waiter = waiter or AdaptiveWaiter()
+        # Todas las navegaciones pasan por el planificador (compartido entre workers)
+        self._scheduler = scheduler or RequestScheduler()
+        # Tiempos y contadores de cada etapa (navegación, espera, page_source, parseo...)
+        self._metrics = metrics or Metrics()
+        # Espera entre reintentos y fichero de medicamentos fallidos
+        self._retry_policy = retry_policy or RetryPolicy()
+        # Resultados ya conocidos de la búsqueda. Si se han leído de la caché, la búsqueda
+        # todavía no se ha hecho en el navegador: 'open_search' la hace la primera vez que
+        # se necesita la lista de resultados
+        self._session = session
+        self._open_search = open_search
         self._wait = WebDriverWait(driver, self._timeout)
-        
+
+    def quit(self):
+        if self._driver_manager is not None:
+            self._driver_manager.quit(self._driver)
+        else:
+            self._driver.quit()
+
+    def _open_results(self):
+        if self._open_search is not None:
+            open_search, self._open_search = self._open_search, None
+            open_search()
+
+    def _cached_ids(self, num_medicines: int) -> list:
+        return self._session.ids_for(num_medicines) if self._session else None
+
+    def _remember_ids(self, meds_id_numbers: list = (), **kwargs):
+        if self._session is not None:
+            self._session.update(meds_id_numbers, **kwargs)
+
+    def _page_done(self):
+        # Solo se sustituye el navegador después de las páginas de detalle obtenidas por su
+        # número de registro, que no dependen del estado del navegador (a diferencia de la
+        # lista de resultados de la búsqueda)
+        if self._driver_manager is None:
+            return
+        new_driver = self._driver_manager.page_done(self._driver)
+        if new_driver is not None:
+            self._driver = new_driver
+            self._wait = WebDriverWait(new_driver, self._timeout)
+
     def wait_for_page_to_load(self):
-        self._wait.until(
-            EC.visibility_of_element_located(
-                (By.CSS_SELECTOR, "button[onclick='compartirMedicamento()'")
+        with self._metrics.timer("espera"):
+            self._waiter.until(
+                self._driver,
+                "carga de la página de detalle",
+                EC.visibility_of_element_located(
+                    (By.CSS_SELECTOR, "button[onclick='compartirMedicamento()'")
+                ),
+                max_wait=self._timeout,
+                raise_on_timeout=True,
             )
-        )        
 
-    def scrape_medicines(self, num_medicines: int, scroll_sleep_time: float) -> list:
-        data = []
-        if not num_medicines:
-            # No hace falta hacer scroll, se hace scraping de los 25 elementos presentes
-            meds_ids = self.get_medicines_identifiers()
-            # Recorremos las ids de todos los medicamentos representado a cada uno por 'm'
+    def _page_source(self) -> str:
+        # El html se transfiere completo desde el navegador en cada llamada
+        with self._metrics.timer("page_source"):
+            html = self._driver.page_source
+        self._metrics.inc("page_source_bytes_total", len(html))
+        return html
+
+    def scrape_medicines(
+        self,
+        num_medicines: int,
+        scroll_sleep_time: float,
+        workers: int = 1,
+        driver_factory: Callable[[], webdriver] = None,
+        max_retries: int = 2,
+        engine=None,
+        parse_workers: int = 1,
+        checkpoint: CrawlCheckpoint = None,
+        id_source: Callable[[int], Iterable[str]] = None,
+        on_result: Callable[[str, dict], None] = None,
+    ) -> MedicineColumns:
+        # 'id_source' permite obtener los números de registro de otra fuente (p.ej. el listado
+        # paginado de la API) en lugar de hacer scroll por la lista de resultados. Recibe el
+        # nº de medicamentos (-1 para todos) y devuelve sus números de registro.
+        # 'on_result' recibe cada fila, en el orden de la lista de resultados, en cuanto
+        # se han obtenido todas las anteriores (p.ej. para escribirla en el fichero de
+        # salida sin esperar al final). En ese caso las filas no se acumulan en memoria y se
+        # devuelve un resultado vacío
+        with self._parse_pool_for(parse_workers, engine):
+            return self._scrape_medicines(
+                num_medicines,
+                scroll_sleep_time,
+                workers=workers,
+                driver_factory=driver_factory,
+                max_retries=max_retries,
+                engine=engine,
+                checkpoint=checkpoint,
+                id_source=id_source,
+                on_result=on_result,
+            )
+
+    def scrape_medicines_by_id_numbers(
+        self,
+        meds_id_numbers: list,
+        workers: int = 1,
+        driver_factory: Callable[[], webdriver] = None,
+        max_retries: int = 2,
+        engine=None,
+        parse_workers: int = 1,
+    ) -> MedicineColumns:
+        # Scraping de una lista de números de registro ya conocida (sin pasar por la lista
+        # de resultados de la búsqueda)
+        with self._parse_pool_for(parse_workers, engine):
+            data = self._scrape_id_numbers(
+                meds_id_numbers,
+                num_medicines=len(meds_id_numbers),
+                workers=workers,
+                driver_factory=driver_factory,
+                max_retries=max_retries,
+                engine=engine,
+            )
+        logger.info(f"Obtenido un total de {len(data)} medicamentos")
+        return data
+
+    @contextmanager
+    def _parse_pool_for(self, parse_workers: int, engine):
+        # Con varios procesos de parseo, el html de cada página se envía a un pool de procesos
+        # y el driver puede navegar a la siguiente página mientras se parsea la anterior
+        if parse_workers <= 1 or engine is not None:
+            yield
+            return
+        self._parse_pool = OrderedProcessPool(
+            partial(parse_medicine_html, parser=self._parser), parse_workers
+        )
+        try:
+            yield
+        finally:
+            self._parse_pool.close()
+            self._parse_pool = None
+
+    def _scrape_medicines(
+        self,
+        num_medicines: int,
+        scroll_sleep_time: float,
+        workers: int,
+        driver_factory: Callable[[], webdriver],
+        max_retries: int,
+        engine,
+        checkpoint: CrawlCheckpoint,
+        id_source: Callable[[int], Iterable[str]],
+        on_result: Callable[[str, dict], None] = None,
+    ) -> MedicineColumns:
+        previous_data = MedicineColumns()
+        if checkpoint is not None and checkpoint.ids:
+            # Se reanuda un scraping anterior: la lista de identificadores ya se conoce y no
+            # hace falta volver a hacer scroll
+            meds_id_numbers = checkpoint.ids
+            previous_data = checkpoint.rows()
+            if not num_medicines or num_medicines == -1:
+                num_medicines = len(meds_id_numbers)
+        elif id_source is not None:
+            meds_id_numbers = list(id_source(num_medicines))
             logger.info(
-                f"Obtenido todos los {len(meds_ids)} identificadores de medicamentos"
+                f"Obtenidos {len(meds_id_numbers)} identificadores de medicamentos"
             )
+            if num_medicines == -1:
+                num_medicines = len(meds_id_numbers)
+        elif self._cached_ids(num_medicines) is not None:
+            # Búsqueda repetida: la lista de identificadores ya se conoce
+            meds_id_numbers = self._cached_ids(num_medicines)
             logger.info(
-                f"Scraping {len(meds_ids)} medicamentos por método de click y atrás..."
+                f"Obtenidos {len(meds_id_numbers)} identificadores de medicamentos de"
+                " la caché de búsquedas"
+            )
+            if not num_medicines or num_medicines == -1:
+                num_medicines = len(meds_id_numbers)
+        elif not num_medicines:
+            # No hace falta hacer scroll, se hace scraping de los 25 elementos presentes. Sus
+            # números de registro se leen de una vez y las páginas de detalle se abren
+            # directamente por su URL (o con el motor alternativo), sin hacer click en la
+            # lista ni volver atrás, de forma que la lista no se vuelve a generar para cada
+            # medicamento
+            meds_id_numbers = [
+                re.search("\d+", m).group(0) for m in self.get_medicines_identifiers()
+            ]
+            num_medicines = len(meds_id_numbers)
+            self._remember_ids(meds_id_numbers, initial=num_medicines)
+            logger.info(
+                f"Obtenido todos los {num_medicines} identificadores de medicamentos"
             )
-            for m in meds_ids:
-                med_data = self.scrape_medicine_click_and_back(m)
-                data.append(med_data)
         else:
             # Hace falta hacer scroll por la pagina
             if num_medicines == -1:
                 # \Todos los medicamentos disponibles serán scrapeados
-                num_medicines = int(
-                    self._driver.find_element(By.ID, "numResultados").text
-                )
+                num_medicines = self.get_num_results()
             logger.info(f"Scraping {num_medicines} medicines by scrolling method...")
-            self.scroll_down_until(num_medicines, scroll_sleep_time or self._sleep_time)
-            meds_ids = self.get_medicines_identifiers()
-            try:
-                # Obtenemos la parte numerica del identificador
-                meds_id_numbers = []
-                for m in meds_ids:
-                    num_registro = re.search("\d+", m).group(0)
-                    meds_id_numbers.append(num_registro)
-                logger.info(f"Retrieved all {len(meds_ids)} medicines identifiers")
-                for index, m in enumerate(meds_id_numbers):
-                    try:
-                        med_data = self.scrape_medicine_by_id_number(m)
-                        logger.info(
-                            f"Iteración nº {index} - Id medicamento: {m} - Título de página actual: '{self._driver.title}'"
-                        )
-                        data.append(med_data)
-                        # Si se llega al nº de medicamentos especificados se para la ejecución
-                        if len(data) >= num_medicines:
-                            break
-                    except Exception as err:
-                        logger.error(
-                            f"Iteración nº {index} - Id medicamento: {m} - Título de página actual: '{self._driver.title}'.\n"
-                            f"Detalles del error:\n'{err}'"
-                        )
-                        continue
-            except BaseException as err:
-                logger.error(f"Un error inesperado ha ocurrido: {err}")
+            # Los identificadores se leen por bloques a medida que aparecen con el scroll, en
+            # lugar de volver a contar toda la lista en cada iteración
+            meds_id_numbers = list(
+                self.iter_medicines_id_numbers(
+                    num_medicines, scroll_sleep_time or self._sleep_time
+                )
+            )
+            logger.info(f"Retrieved all {len(meds_id_numbers)} medicines identifiers")
+        if checkpoint is not None:
+            checkpoint.start(meds_id_numbers)
+        completed = checkpoint.completed if checkpoint is not None else set()
+        pending = [m for m in meds_id_numbers if m not in completed][
+            : num_medicines - len(previous_data)
+        ]
+        # Las filas se entregan (a 'on_result' o al resultado) en el orden de la lista de
+        # resultados, aunque los workers y los reintentos las obtengan desordenadas. Las que
+        # esperan su turno se guardan en formato compacto, y el resultado en formato
+        # columnar (ver records.py) para reducir la memoria en scrapings completos
+        data = MedicineColumns()
+        selected = completed.union(pending)
+        buffer = ReorderBuffer(
+            [m for m in meds_id_numbers if m in selected],
+            (
+                (lambda m, record: on_result(m, record.to_row()))
+                if on_result is not None
+                else (lambda m, record: data.append(record))
+            ),
+        )
+        for row in previous_data:
+            buffer.put(row["Número de registro"], MedicineRecord.from_row(row))
+
+        def record(med_id_number, med_data):
+            # Se llama desde los workers, posiblemente desde varios hilos a la vez
+            if checkpoint is not None:
+                checkpoint.record(med_id_number, med_data)
+            buffer.put(med_id_number, MedicineRecord.from_row(med_data))
+
+        try:
+            self._scrape_id_numbers(
+                pending,
+                len(pending),
+                workers=workers,
+                driver_factory=driver_factory,
+                max_retries=max_retries,
+                engine=engine,
+                on_result=record,
+                on_discard=buffer.discard,
+                keep_rows=False,
+            )
+        except BaseException as err:
+            logger.error(f"Un error inesperado ha ocurrido: {err}")
+            if checkpoint is None:
                 meds_ids_filename = "meds_ids.txt"
                 with open(meds_ids_filename, "w") as out:
-                    out.write("\n".join(meds_ids))
+                    out.write("\n".join(meds_id_numbers))
                 logger.info(
                     f"Se han guardado los identificadores en el archivo {meds_ids_filename}."
                 )
-        logger.info(f"Obtenido un total de {len(data)} medicamentos")
+            else:
+                checkpoint.interrupted = True
+                checkpoint.save()
+                logger.info(
+                    f"Se ha guardado el progreso ({len(checkpoint.completed)} medicamentos) "
+                    "en el checkpoint. Se puede continuar con --resume."
+                )
+        # Se entregan también las filas retenidas detrás de medicamentos que no han llegado
+        # (p.ej. si el scraping se ha interrumpido)
+        buffer.flush()
+        logger.info(f"Obtenido un total de {buffer.emitted} medicamentos")
         return data
 
-    def get_medicines_identifiers(self):
-        meds = self._driver.find_elements(
-            By.CSS_SELECTOR, "div[onclick*=medicamentoOnSelect]"
+    def _scrape_id_numbers(
+        self,
+        meds_id_numbers: list,
+        num_medicines: int,
+        workers: int,
+        driver_factory: Callable[[], webdriver],
+        max_retries: int,
+        engine,
+        on_result: Callable[[str, dict], None] = None,
+        on_discard: Callable[[str], None] = None,
+        keep_rows: bool = True,
+    ) -> MedicineColumns:
+        # 'on_result' se llama con cada medicamento scrapeado correctamente (p.ej. para
+        # guardarlo en el checkpoint), posiblemente desde varios hilos, y 'on_discard' con
+        # los que fallan en todos los intentos. Con 'keep_rows' a False las filas solo se
+        # entregan a 'on_result' y se devuelve un resultado vacío
+        if engine is not None:
+            return engine.scrape_medicines_by_id_numbers(
+                meds_id_numbers[:num_medicines],
+                workers=workers,
+                max_retries=max_retries,
+                on_result=on_result,
+                on_discard=on_discard,
+                keep_rows=keep_rows,
+            )
+        if workers > 1 and driver_factory is not None:
+            return self.scrape_medicines_with_workers(
+                meds_id_numbers[:num_medicines],
+                workers=workers,
+                driver_factory=driver_factory,
+                max_retries=max_retries,
+                on_result=on_result,
+                on_discard=on_discard,
+                keep_rows=keep_rows,
+            )
+        # Pasada principal y, a continuación, las rondas de reintentos diferidos de los
+        # medicamentos que han fallado
+        retries = RetryQueue(max_retries, self._retry_policy, self._metrics, on_discard)
+        data = MedicineColumns() if keep_rows else None
+        pending = meds_id_numbers[:num_medicines]
+        retried = False
+        while pending:
+            if self._parse_pool is not None:
+                self._parse_in_pool(
+                    self._iter_medicines_html(pending, retries),
+                    data,
+                    retries,
+                    on_result,
+                )
+            else:
+                self._scrape_sequentially(pending, data, retries, on_result)
+            pending = retries.take()
+            retried = retried or bool(pending)
+        if data is None:
+            return MedicineColumns()
+        # Los medicamentos obtenidos en un reintento se han añadido al final
+        return sort_by_id_numbers(data, meds_id_numbers) if retried else data
+
+    def _scrape_sequentially(
+        self,
+        meds_id_numbers: list,
+        data: Optional[MedicineColumns],
+        retries: RetryQueue,
+        on_result: Callable[[str, dict], None] = None,
+    ):
+        # Sin 'data' las filas solo se entregan a 'on_result'
+        for index, m in enumerate(meds_id_numbers):
+            retries.wait(m)
+            try:
+                med_data = self.scrape_medicine_by_id_number(m)
+            except Exception as err:
+                retries.failed(m, err)
+                continue
+            logger.info(
+                f"Iteración nº {index} - Id medicamento: {m} - Título de página actual: '{self._driver.title}'"
+            )
+            if data is not None:
+                data.append(med_data)
+            if on_result is not None:
+                on_result(m, med_data)
+
+    def scrape_medicines_with_workers(
+        self,
+        meds_id_numbers: list,
+        workers: int,
+        driver_factory: Callable[[], webdriver],
+        max_retries: int,
+        on_result: Callable[[str, dict], None] = None,
+        on_discard: Callable[[str], None] = None,
+        keep_rows: bool = True,
+    ) -> MedicineColumns:
+        logger.info(
+            f"Scraping {len(meds_id_numbers)} medicamentos con {workers} workers en paralelo..."
+        )
+
+        # Cada worker tiene su propio driver (y por tanto su propia instancia de Chrome),
+        # ya que los drivers de Selenium no se pueden compartir entre hilos
+        def new_worker():
+            return MedicinesSearch(
+                driver_factory(),
+                sleep_time=self._sleep_time,
+                timeout=self._timeout,
+                base_url=self._base_url,
+                parser=self._parser,
+                cache=self._cache,
+                waiter=self._waiter,
+                scheduler=self._scheduler,
+                driver_manager=self._driver_manager,
+                metrics=self._metrics,
+                retry_policy=self._retry_policy,
+            )
+
+        def scrape(worker, med_id_number):
+            # El parseo se hace en el pool de procesos del objeto principal (si existe), de forma
+            # que los hilos de los workers solo esperan a la red y no compiten por el GIL
+            with self._metrics.profile(med_id_number):
+                med_data = self._parse_page(
+                    med_id_number, worker.get_medicine_html_by_id_number(med_id_number)
+                )
+            logger.info(
+                f"Id medicamento: {med_id_number} - Título de página actual: '{worker._driver.title}'"
+            )
+            if on_result is not None:
+                on_result(med_id_number, med_data)
+            if not keep_rows:
+                return None
+            # Mientras terminan el resto de medicamentos se guarda en formato compacto
+            return MedicineRecord.from_row(med_data)
+
+        pool = WorkerPool(
+            worker_factory=new_worker,
+            num_workers=workers,
+            max_retries=max_retries,
+            close_worker=lambda worker: worker.quit(),
+            # Si el error no es un simple timeout, el driver puede haber quedado en un estado
+            # inconsistente (p.ej. Chrome se ha cerrado), así que se sustituye por uno nuevo
+            should_recycle=lambda err: isinstance(err, WebDriverException)
+            and not isinstance(err, TimeoutException),
+            metrics=self._metrics,
+            retry_policy=self._retry_policy,
+            on_discard=on_discard,
         )
-        meds_ids = []
-        for m in meds:
-            id = m.get_attribute("onclick")
-            meds_ids.append(id)
-        return meds_ids
-
-    def scrape_medicine_click_and_back(self, med_id: str):
-        # Hacemos click en el elemento de la página web que se identifica por el atributo onclick=i que corresponde al medicamento
-        # con el número de registro 'med_id'
-        self._driver.find_element(
-            By.CSS_SELECTOR, 'div[onclick="{}"]'.format(med_id)
-        ).click()
-
-        # Esperamos hasta que se termine de cargar el contenido del html donde se encuentran todos los datos de interés del medicamento
-        self.wait_for_page_to_load()
-        logger.info(f"Accedido a {self._driver.title}.")
+        results = pool.map(scrape, meds_id_numbers)
+        # Los medicamentos que han fallado en todos los intentos se descartan (y se guardan
+        # en el fichero de fallidos)
+        return MedicineColumns(record for record in results if record is not None)
+
+    def _iter_medicines_html(self, meds_id_numbers: list, retries: RetryQueue):
+        for index, m in enumerate(meds_id_numbers):
+            retries.wait(m)
+            try:
+                html = self.get_medicine_html_by_id_number(m)
+            except Exception as err:
+                retries.failed(m, err)
+                continue
+            logger.info(
+                f"Iteración nº {index} - Id medicamento: {m} - Título de página actual: '{self._driver.title}'"
+            )
+            yield m, html
+
+    def _parse_in_pool(
+        self,
+        pages,
+        data: Optional[MedicineColumns],
+        retries: RetryQueue,
+        on_result: Callable[[str, dict], None] = None,
+    ):
+        for m, med_data, err in self._parse_pool.imap(pages):
+            if err is not None:
+                self._invalidate(m)
+                retries.failed(m, err)
+                continue
+            if data is not None:
+                data.append(med_data)
+            if on_result is not None:
+                on_result(m, med_data)
 
-        # Accedemos al código fuente de la página una vez que esté se ha terminado de rellenar
-        nueva_fila = MedicineDetails(html=self._driver.page_source).scrape_data()
+    def _parse_html(self, html: str) -> dict:
+        if self._parse_pool is not None:
+            return self._parse_pool.submit(html).result()
+        with self._metrics.timer("parseo"):
+            return MedicineDetails(html=html, parser=self._parser).scrape_data()
 
-        # Se vuelve atrás esperando a que la página cargue para seguir haciendo el mismo proceso para los demás medicamentos
-        self._driver.back()
-        self._driver.implicitly_wait(self._timeout)
-        logger.info(f"Vuelto para atrás {self._driver.title}.")
+    def _parse_page(self, med_id_number, html: str) -> dict:
+        try:
+            return self._parse_html(html)
+        except Exception:
+            self._invalidate(med_id_number)
+            raise
+
+    def _invalidate(self, med_id_number):
+        # Si la página no se ha podido parsear, al reintentarla se vuelve a descargar en
+        # lugar de leerse de la caché
+        if self._cache is not None:
+            self._cache.delete(med_id_number)
+
+    def get_num_results(self) -> int:
+        if self._open_search is not None and self._session.total is not None:
+            return self._session.total
+        self._open_results()
+        return int(self._driver.find_element(By.ID, "numResultados").text)
+
+    def resolve_num_medicines(self, num_medicines: int) -> int:
+        # Mismo criterio que --num-medicamentos: -1 son todos los resultados de la búsqueda y
+        # si no se especifica, los elementos presentes inicialmente en la lista
+        if num_medicines == -1:
+            if self._cached_ids(-1) is not None:
+                return len(self._session.ids)
+            return self.get_num_results()
+        if not num_medicines:
+            if self._session is not None and self._session.initial is not None:
+                return self._session.initial
+            initial = len(self.get_medicines_identifiers())
+            self._remember_ids(initial=initial)
+            return initial
+        return num_medicines
+
+    def get_medicines_id_numbers(
+        self, num_medicines: int, scroll_sleep_time: float
+    ) -> list:
+        return list(
+            self.iter_medicines_id_numbers(
+                self.resolve_num_medicines(num_medicines),
+                scroll_sleep_time or self._sleep_time,
+            )
+        )
 
-        return nueva_fila
+    def get_medicines_identifiers(self, start: int = 0, end: int = None):
+        self._open_results()
+        return self._driver.execute_script(
+            _JS_IDENTIFICADORES, _MEDICAMENTOS_LISTA, start, end
+        )
 
     def scrape_medicine_by_id_number(self, med_id_number: int):
-        url = "https://cima.aemps.es/cima/publico/detalle.html?nregistro={}".format(
-            med_id_number
+        with self._metrics.profile(med_id_number):
+            return self._parse_page(
+                med_id_number, self.get_medicine_html_by_id_number(med_id_number)
+            )
+
+    def get_medicine_html_by_id_number(self, med_id_number: int) -> str:
+        if self._cache is not None:
+            html = self._cache.get(med_id_number)
+            if html is not None:
+                self._metrics.inc("cache_hits_total")
+                logger.debug(f"Id medicamento: {med_id_number} obtenido de la caché.")
+                return html
+
+        url = "{}/cima/publico/detalle.html?nregistro={}".format(
+            self._base_url, med_id_number
         )
-        self._driver.get(url)
         # Esperamos hasta que se termine de cargar el contenido del html donde se
-        # encuentran todos los datos de interés del medicamento
+        # encuentran todos los datos de interés del medicamento. Si no carga a tiempo no se
+        # recarga aquí: el error llega a la cola de reintentos y el medicamento se vuelve a
+        # intentar al final, con espera exponencial, sin retrasar al resto
         try:
-            # Espera a que cargue el botón de compartir
-            self.wait_for_page_to_load()
+            with self._scheduler.request("detalle"):
+                with self._metrics.timer("navegacion"):
+                    self._driver.get(url)
+                # Espera a que cargue el botón de compartir
+                self.wait_for_page_to_load()
         except TimeoutException:
-            logger.warning(
-                f"El medicamento con id {med_id_number} ha provocado un TimeoutException. "
-                "Se procederá a recargar la página y esperar un tiempo por defecto."
-            )
-            self._driver.get(url)
-            sleep(self._sleep_time)
+            self._metrics.inc("timeouts_total", stage="detalle")
+            raise
 
         # Accedemos al código fuente de la página una vez que esté se ha terminado de rellenar
-        nueva_fila = MedicineDetails(html=self._driver.page_source).scrape_data()
+        html = self._page_source()
+        if self._cache is not None:
+            self._cache.put(med_id_number, html)
+        self._page_done()
+        return html
+
+    def iter_medicines_id_numbers(self, max_elements: int, sleep_time: float):
+        cached = self._cached_ids(max_elements)
+        if cached is not None:
+            logger.info(
+                f"Obtenidos {len(cached)} identificadores de medicamentos de la caché"
+                " de búsquedas"
+            )
+            yield from cached
+            return
+        meds_id_numbers = []
+        for med_id_number in self._scroll_medicines_id_numbers(
+            max_elements, sleep_time
+        ):
+            meds_id_numbers.append(med_id_number)
+            yield med_id_number
+        # Si la lista se ha terminado antes de llegar a 'max_elements', ya está completa
+        self._remember_ids(
+            meds_id_numbers, complete=len(meds_id_numbers) < max_elements
+        )
 
-        return nueva_fila
+    def _scroll_medicines_id_numbers(self, max_elements: int, sleep_time: float):
+        # Versión incremental de scroll_down_until + get_medicines_identifiers: se devuelven
+        # los números de registro a medida que van apareciendo en la lista, sin esperar a
+        # terminar el scroll
+        # En cada scroll solo se transfieren los identificadores nuevos
+        n_yielded = 0
+        n_iters = 0
+        while n_yielded < max_elements:
+            new_meds = self.get_medicines_identifiers(n_yielded, max_elements)
+            if not new_meds and n_iters > 0:
+                # El scroll no ha cargado más elementos: hemos llegado al final de la lista
+                logger.info(f"Fin de la lista alcanzado con {n_yielded} elementos.")
+                return
+            for m in new_meds:
+                yield re.search("\d+", m).group(0)
+                n_yielded += 1
+            if n_yielded >= max_elements:
+                return
+            with self._scheduler.request("scroll"):
+                self._driver.execute_script(
+                    "window.scrollTo(0, document.body.scrollHeight);"
+                )
+            self._wait_for_more_results(n_yielded, sleep_time)
+            self._wait.until(
+                EC.element_to_be_clickable(
+                    (
+                        By.XPATH,
+                        "//div[@id='resultlist']/div[last()]//div[contains(@onclick,'medicamentoOnSelect')]",
+                    )
+                )
+            )
+            n_iters += 1
 
     def scroll_down_until(self, max_elements: int, sleep_time: float):
+        self._open_results()
         n_iters = 0
-        n_meds = 0
+        n_meds = count_elements(self._driver, _MEDICAMENTOS_LISTA)
         while n_meds < max_elements:
-            n_meds = len(
-                self._driver.find_elements(
-                    By.CSS_SELECTOR, "div[onclick*=medicamentoOnSelect]"
+            # Scroll hasta el final de la página. Solo el scroll pasa por el planificador: la
+            # espera al final de la lista dura siempre 'sleep_time' y no es latencia de la web
+            with self._scheduler.request("scroll"):
+                self._driver.execute_script(
+                    "window.scrollTo(0, document.body.scrollHeight);"
                 )
-            )
-            # Scroll hasta el final de la página
-            self._driver.execute_script(
-                "window.scrollTo(0, document.body.scrollHeight);"
-            )
-            sleep(sleep_time)
+            # Esperar a que aparezcan más elementos (o como mucho 'sleep_time')
+            more = self._wait_for_more_results(n_meds, sleep_time)
+            if not more:
+                # El scroll no ha cargado más elementos: hemos llegado al final de la lista
+                logger.info(f"Fin de la lista alcanzado con {n_meds} elementos.")
+                return
             # Esperar hasta que el último elemento de la lista sea clicable
             self._wait.until(
                 EC.element_to_be_clickable(
@@ -271,7 +808,19 @@ class MedicinesSearch:
                     )
                 )
             )
+            n_meds = count_elements(self._driver, _MEDICAMENTOS_LISTA)
             # Por motivos informativos, imprimimos cuantas iteraciones/scrollings llevamos
             n_iters += 1
             if n_meds % 100 == 0:
                 logger.info(f"Found {n_meds} elements (in {n_iters} iterations)...")
+
+    def _wait_for_more_results(self, num_meds: int, max_wait: float) -> bool:
+        # Tras hacer scroll, la página carga el siguiente bloque de resultados. Se espera a
+        # que la lista tenga más elementos que antes del scroll; al final de la lista no
+        # aparecen más, así que la espera se agota tras 'max_wait' segundos
+        return self._waiter.until(
+            self._driver,
+            "scroll de resultados",
+            num_elements_greater_than(_MEDICAMENTOS_LISTA, num_meds),
+            max_wait=max_wait,
+        )
@@ -0,0 +1,303 @@
+import bisect
+import importlib.util
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_PREFIX = "medicinescraper_"
+# Límites superiores (en segundos) de los buckets de los histogramas de tiempos
+_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+_PERFILADORES = ["cprofile", "pyinstrument"]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = _BUCKETS) -> None:
+        self.buckets = buckets
+        # El último bucket corresponde a +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        # Estimación a partir de los buckets (interpolación lineal dentro del bucket), igual
+        # que histogram_quantile de Prometheus
+        if not self.count:
+            return None
+        rank = q * self.count
+        accumulated = 0
+        for index, count in enumerate(self.counts):
+            if accumulated + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                estimate = lower + (upper - lower) * (rank - accumulated) / count
+                return min(estimate, self.max)
+            accumulated += count
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+            "p50": _round(self.quantile(0.5)),
+            "p90": _round(self.quantile(0.9)),
+            "p99": _round(self.quantile(0.99)),
+            "max": round(self.max, 6),
+        }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 6)
+
+
+def _labels_key(labels: dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], **extra) -> str:
+    items = list(labels) + [(k, str(v)) for k, v in extra.items()]
+    if not items:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in items
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class PageProfiler:
+    # Perfilado de una muestra de las páginas: se perfila 1 de cada 'every' páginas con
+    # cProfile (se acumulan en un único fichero .pstats) o con pyinstrument (un informe html
+    # por página). Los perfiladores de Python no admiten varias sesiones a la vez, así que
+    # si ya se está perfilando una página en otro hilo la página no se perfila
+    def __init__(self, every: int, out_dir: str, backend: str = "cprofile") -> None:
+        if backend not in _PERFILADORES:
+            raise ValueError(
+                f"Perfilador '{backend}' no soportado. Opciones: {', '.join(_PERFILADORES)}"
+            )
+        if (
+            backend == "pyinstrument"
+            and importlib.util.find_spec("pyinstrument") is None
+        ):
+            raise ImportError(
+                "El perfilador 'pyinstrument' requiere instalar el paquete pyinstrument"
+                " (pip install pyinstrument)"
+            )
+        self._every = max(1, every)
+        self._out_dir = out_dir
+        self._backend = backend
+        self._pages = 0
+        self._counter_lock = threading.Lock()
+        self._active = threading.Lock()
+        self._stats = None
+        self.profiled = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    @contextmanager
+    def sample(self, name: str):
+        with self._counter_lock:
+            self._pages += 1
+            selected = (self._pages - 1) % self._every == 0
+        if not selected or not self._active.acquire(blocking=False):
+            yield
+            return
+        try:
+            if self._backend == "cprofile":
+                with self._cprofile():
+                    yield
+            else:
+                with self._pyinstrument(name):
+                    yield
+            self.profiled += 1
+        finally:
+            self._active.release()
+
+    @contextmanager
+    def _cprofile(self):
+        import cProfile
+        import pstats
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    @contextmanager
+    def _pyinstrument(self, name: str):
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            path = os.path.join(self._out_dir, f"pagina_{name}.html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+
+    def close(self):
+        if self._stats is None:
+            if self._backend == "pyinstrument" and self.profiled:
+                logger.info(f"Perfiles de {self.profiled} páginas en {self._out_dir}")
+            return
+        path = os.path.join(self._out_dir, "paginas.pstats")
+        self._stats.dump_stats(path)
+        logger.info(
+            f"Perfil acumulado de {self.profiled} páginas guardado en {path} "
+            f"(python -m pstats {path})"
+        )
+
+
+class Metrics:
+    # Registro de histogramas de tiempos y contadores de las etapas del scraping
+    # (navegación, espera de la página, transferencia del html, parseo, escritura...),
+    # compartido por todos los workers. Se exporta al final en formato de texto de
+    # Prometheus o como resumen json
+    def __init__(self, profiler: PageProfiler = None) -> None:
+        self._profiler = profiler
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[tuple, Histogram]] = {}
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._start = time.time()
+
+    def observe(self, name: str, value: float, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, stage: str):
+        # Uso: with metrics.timer("parseo"): ...
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def profile(self, name: str):
+        # Perfila el bloque si la página forma parte de la muestra (con --profile-pages)
+        if self._profiler is None:
+            return nullcontext()
+        return self._profiler.sample(name)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {_PREFIX}{name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{_PREFIX}{name}{_format_labels(labels)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {_PREFIX}{name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    accumulated = 0
+                    for bound, count in zip(
+                        (*histogram.buckets, "+Inf"), histogram.counts
+                    ):
+                        accumulated += count
+                        lines.append(
+                            f"{_PREFIX}{name}_bucket{_format_labels(labels, le=bound)} "
+                            f"{accumulated}"
+                        )
+                    lines.append(
+                        f"{_PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum}"
+                    )
+                    lines.append(
+                        f"{_PREFIX}{name}_count{_format_labels(labels)} {histogram.count}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                "duration_s": round(time.time() - self._start, 3),
+                "counters": {
+                    name: [
+                        {"labels": dict(labels), "value": value}
+                        for labels, value in sorted(series.items())
+                    ]
+                    for name, series in sorted(self._counters.items())
+                },
+                "histograms": {
+                    name: [
+                        {"labels": dict(labels), **histogram.summary()}
+                        for labels, histogram in sorted(series.items())
+                    ]
+                    for name, series in sorted(self._histograms.items())
+                },
+            }
+
+    def export(self, path: str):
+        # Formato según la extensión: .json para el resumen json y Prometheus para el resto
+        # (p.ej. .prom, para el textfile collector de node_exporter)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            if path.endswith(".json"):
+                json.dump(self.to_json(), f, ensure_ascii=False, indent=2)
+            else:
+                f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+        logger.info(f"Métricas guardadas en {path}")
+
+    def report(self):
+        # Resumen en el log del tiempo dedicado a cada etapa
+        with self._lock:
+            stages = dict(self._histograms.get("stage_seconds", {}))
+        if not stages:
+            return
+        logger.info("Tiempo por etapa:")
+        for labels, histogram in sorted(stages.items(), key=lambda item: -item[1].sum):
+            summary = histogram.summary()
+            logger.info(
+                f"  {dict(labels)['stage']:>12}: {summary['sum']:.1f} s en "
+                f"{summary['count']} llamadas (p50 {summary['p50'] * 1000:.1f} ms, "
+                f"p99 {summary['p99'] * 1000:.1f} ms)"
+            )
+
+    def close(self):
+        if self._profiler is not None:
+            self._profiler.close()
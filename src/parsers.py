@@ -0,0 +1,204 @@
+import re
+
+# Expresiones regulares precompiladas para el parseo de las fechas de los estados del
+# medicamento, que tienen el formato "Autorizado ( dd/mm/aaaa )"
+_RE_FECHA = re.compile(r"\(.*\)")
+_RE_PARENTESIS = re.compile(r"\( | \)")
+
+# Identificadores (y tag correspondiente) de todos los elementos de la página de detalle
+# que contienen datos del medicamento
+_ELEMENTOS = {
+    "nombrelabXS": "div",
+    "nregistroId": "span",
+    "estadoXS": "h2",
+    "estadoXSsec": "h2",
+    "estadocomercXS": "h3",
+    "viasadministracion": "div",
+    "dosis": "div",
+    "formas": "div",
+    "pactivosList": "div",
+    "excipientesList": "div",
+    "caracteristicasList": "div",
+    "atcList": "div",
+    "bodyFormatos": "div",
+}
+
+# Listas de la página con la misma estructura: un div identificado por su id con un <li> por elemento
+_LISTAS = {
+    "Vías administración": "viasadministracion",
+    "Dosis": "dosis",
+    "Formas farmacéuticas": "formas",
+    "Principios activos": "pactivosList",
+    "Excipientes": "excipientesList",
+    "Características": "caracteristicasList",
+    "Códigos ATC": "atcList",
+}
+
+
+def parse_fecha_estado(texto: str):
+    # Si el estado no aplica, la tag está vacía. Si aplica, el contenido tiene el formato
+    # "Estado ( dd/mm/aaaa )" y nos quedamos solo con la fecha
+    if texto == "":
+        return False, None
+    fecha = _RE_PARENTESIS.sub("", _RE_FECHA.findall(texto)[0]).strip()
+    return True, fecha
+
+
+# Espacios de html: BeautifulSoup sustituye cada texto formado solo por ellos por un salto de
+# línea (si contiene alguno) o por un espacio (salvo dentro de <pre> y <textarea>, que no
+# aparecen en la página de detalle)
+_ESPACIOS = " \n\t\f\r"
+
+
+def _join_text(strings) -> str:
+    # Texto de un elemento a partir de sus textos (sin comentarios), igual que get_text()
+    return "".join(
+        ("\n" if "\n" in s else " ") if not s.strip(_ESPACIOS) else s for s in strings
+    )
+
+
+def parse_codigo_nacional(texto: str) -> str:
+    return texto.strip(" National code: ").strip()
+
+
+def build_row(
+    num_registro: str,
+    medicamento: str,
+    laboratorio: str,
+    estado: str,
+    estado_sec: str,
+    comercializado: bool,
+    listas: dict,
+    formatos: list,
+) -> dict:
+    autorizado_bool, autorizado_fecha = parse_fecha_estado(estado)
+    suspendido_bool, suspendido_fecha = parse_fecha_estado(estado_sec)
+    return {
+        "Número de registro": num_registro,
+        "Medicamento": medicamento,
+        "Laboratorio": laboratorio,
+        "Autorizado": autorizado_bool,
+        "Fecha autorización": autorizado_fecha,
+        "Suspendido": suspendido_bool,
+        "Fecha suspensión": suspendido_fecha,
+        "Comercializado": comercializado,
+        "Vías administración": listas["Vías administración"],
+        "Dosis": listas["Dosis"],
+        "Formas farmacéuticas": listas["Formas farmacéuticas"],
+        "Principios activos": listas["Principios activos"],
+        "Excipientes": listas["Excipientes"],
+        "Características": listas["Características"],
+        "Códigos ATC": listas["Códigos ATC"],
+        "Formatos": formatos,
+    }
+
+
+_lxml_xpath = None
+
+
+def scrape_data_lxml(html: str) -> dict:
+    global _lxml_xpath
+    try:
+        from lxml import etree, html as lxml_html
+    except ImportError:
+        raise ImportError(
+            "El parser 'lxml' requiere instalar el paquete lxml (pip install lxml)"
+        )
+    if _lxml_xpath is None:
+        # Una única expresión XPath (compilada una sola vez) localiza en una sola pasada por
+        # el documento el h1 y todos los elementos identificados por su id
+        condiciones = " or ".join(f"@id='{i}'" for i in _ELEMENTOS)
+        _lxml_xpath = etree.XPath(f"//h1 | //*[{condiciones}]")
+
+    root = lxml_html.fromstring(html)
+    h1 = None
+    elementos = {}
+    for el in _lxml_xpath(root):
+        if el.tag == "h1":
+            if h1 is None:
+                h1 = el
+            continue
+        id_ = el.get("id")
+        # Igual que bs.find(tag, {"id": id_}): el primero con la tag esperada
+        if id_ not in elementos and el.tag == _ELEMENTOS[id_]:
+            elementos[id_] = el
+
+    def text(el) -> str:
+        return _join_text(el.itertext())
+
+    listas = {
+        columna: [text(li) for li in elementos[id_].iter("li")]
+        for columna, id_ in _LISTAS.items()
+    }
+    formatos = []
+    for fmt in (c for c in elementos["bodyFormatos"] if c.tag == "div"):
+        title, cn = fmt.iter("h6")
+        formatos.append(
+            {"Titulo": text(title), "Codigo Nacional": parse_codigo_nacional(text(cn))}
+        )
+
+    return build_row(
+        num_registro=text(elementos["nregistroId"]),
+        medicamento=text(h1),
+        laboratorio=text(elementos["nombrelabXS"]),
+        estado=text(elementos["estadoXS"]),
+        estado_sec=text(elementos["estadoXSsec"]),
+        comercializado="estadocomercXS" in elementos,
+        listas=listas,
+        formatos=formatos,
+    )
+
+
+_selectolax_selector = ", ".join(
+    ["h1"] + [f"{tag}#{id_}" for id_, tag in _ELEMENTOS.items()]
+)
+
+
+def scrape_data_selectolax(html: str) -> dict:
+    try:
+        from selectolax.lexbor import LexborHTMLParser
+    except ImportError:
+        raise ImportError(
+            "El parser 'selectolax' requiere instalar el paquete selectolax (pip install selectolax)"
+        )
+    tree = LexborHTMLParser(html)
+    h1 = None
+    elementos = {}
+    # Un único selector CSS compuesto devuelve, en orden de documento, todos los elementos de interés
+    for node in tree.css(_selectolax_selector):
+        if node.tag == "h1":
+            if h1 is None:
+                h1 = node
+            continue
+        id_ = node.attributes.get("id")
+        if id_ not in elementos:
+            elementos[id_] = node
+
+    def text(node) -> str:
+        return _join_text(
+            n.text_content for n in node.traverse(include_text=True) if n.tag == "-text"
+        )
+
+    listas = {
+        columna: [text(li) for li in elementos[id_].css("li")]
+        for columna, id_ in _LISTAS.items()
+    }
+    formatos = []
+    for fmt in elementos["bodyFormatos"].iter():
+        if fmt.tag != "div":
+            continue
+        title, cn = fmt.css("h6")
+        formatos.append(
+            {"Titulo": text(title), "Codigo Nacional": parse_codigo_nacional(text(cn))}
+        )
+
+    return build_row(
+        num_registro=text(elementos["nregistroId"]),
+        medicamento=text(h1),
+        laboratorio=text(elementos["nombrelabXS"]),
+        estado=text(elementos["estadoXS"]),
+        estado_sec=text(elementos["estadoXSsec"]),
+        comercializado="estadocomercXS" in elementos,
+        listas=listas,
+        formatos=formatos,
+    )
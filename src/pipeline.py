@@ -0,0 +1,338 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Optional
+
+from metrics import Metrics
+from retries import RetryPolicy, RetryQueue
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_QUEUE_SIZE = 100
+_DEFAULT_LOG_INTERVAL = 30
+# Cada cuánto comprueba el productor si el pipeline se está deteniendo mientras espera
+# hueco en la cola
+_STOP_POLL = 0.5
+
+# Marca de fin de datos que se propaga de una etapa a la siguiente
+_END = object()
+
+
+class StageStats:
+    def __init__(self, name: str, concurrency: int = 1) -> None:
+        self.name = name
+        self.concurrency = concurrency
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self._started = time.perf_counter()
+        self._finished = None
+
+    def record(self, elapsed: float, error: bool = False):
+        self.busy_time += elapsed
+        if error:
+            self.errors += 1
+        else:
+            self.processed += 1
+
+    def finish(self):
+        self._finished = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return (self._finished or time.perf_counter()) - self._started
+
+    @property
+    def throughput(self) -> float:
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def utilization(self) -> float:
+        # Fracción del tiempo que los workers de la etapa han estado trabajando (y no
+        # esperando a la etapa anterior o a la siguiente). Una etapa cercana al 100% es
+        # el cuello de botella del pipeline
+        capacity = self.elapsed * self.concurrency
+        return self.busy_time / capacity if capacity else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.processed} procesados, {self.errors} errores, "
+            f"{self.throughput:.2f} elem/s, ocupación {self.utilization:.0%}"
+        )
+
+
+class CrawlPipeline:
+    def __init__(
+        self,
+        fetcher_factory: Callable[[], Any],
+        fetch: Callable[[Any, str], Any],
+        parse: Callable[[Any], dict],
+        writer,
+        workers: int = 1,
+        queue_size: int = _DEFAULT_QUEUE_SIZE,
+        max_retries: int = 2,
+        close_fetcher: Optional[Callable[[Any], None]] = None,
+        log_interval: float = _DEFAULT_LOG_INTERVAL,
+        parse_workers: int = 1,
+        metrics: Metrics = None,
+        retry_policy: RetryPolicy = None,
+        invalidate: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self._fetcher_factory = fetcher_factory
+        self._fetch = fetch
+        self._parse = parse
+        self._writer = writer
+        self._workers = max(1, workers)
+        self._queue_size = max(1, queue_size)
+        self._max_retries = max(0, max_retries)
+        self._close_fetcher = close_fetcher
+        self._log_interval = log_interval
+        self._parse_workers = max(1, parse_workers)
+        self._metrics = metrics or Metrics()
+        self._retry_policy = retry_policy or RetryPolicy()
+        # Se llama con los medicamentos cuya página no se ha podido parsear, antes de
+        # reintentarlos (p.ej. para quitar la página de la caché)
+        self._invalidate = invalidate
+        self.stats = {}
+        self._fetchers = {}
+        self._stopping = threading.Event()
+        self._writer_closed = False
+
+    def run(self, meds_id_numbers: Iterable[str]) -> int:
+        return asyncio.run(self._run(meds_id_numbers))
+
+    async def _run(self, meds_id_numbers: Iterable[str]) -> int:
+        # Todas las operaciones bloqueantes (Selenium, HTTP, parseo y escritura) se ejecutan
+        # en hilos; el bucle de eventos solo coordina el paso de elementos entre etapas
+        self._executor = ThreadPoolExecutor(max_workers=self._workers + 3)
+        # Con varios workers de parseo, el parseo (CPU) se hace en un pool de procesos. En ese
+        # caso 'parse' tiene que poder serializarse con pickle
+        self._parse_executor = (
+            ProcessPoolExecutor(max_workers=self._parse_workers)
+            if self._parse_workers > 1
+            else self._executor
+        )
+        # Los fetchers (p.ej. navegadores) se crean una vez por worker y se reutilizan en
+        # las rondas de reintentos
+        self._fetchers = {}
+        self._stopping.clear()
+        self._writer_closed = False
+        # Las colas acotadas hacen de backpressure: si una etapa se retrasa, las anteriores
+        # se bloquean en lugar de acumular elementos en memoria
+        ids_queue = asyncio.Queue(maxsize=self._queue_size)
+        docs_queue = asyncio.Queue(maxsize=self._queue_size)
+        rows_queue = asyncio.Queue(maxsize=self._queue_size)
+        self.stats = {
+            "ids": StageStats("ids"),
+            "fetch": StageStats("fetch", concurrency=self._workers),
+            "parse": StageStats("parse", concurrency=self._parse_workers),
+            "write": StageStats("write"),
+        }
+
+        self._retries = RetryQueue(self._max_retries, self._retry_policy, self._metrics)
+        parsers = [
+            asyncio.create_task(self._parse_worker(docs_queue, rows_queue))
+            for _ in range(self._parse_workers)
+        ]
+        writer = asyncio.create_task(self._write_worker(rows_queue))
+        reporter = asyncio.create_task(self._report(ids_queue, docs_queue, rows_queue))
+        try:
+            # Pasada principal y, a continuación, las rondas de reintentos diferidos. Antes
+            # de cada ronda se espera a que se hayan parseado todas las páginas descargadas,
+            # ya que los errores de parseo también se reintentan
+            pending = meds_id_numbers
+            while pending:
+                await self._fetch_round(pending, ids_queue, docs_queue)
+                await docs_queue.join()
+                pending = self._retries.take()
+            self.stats["fetch"].finish()
+            for _ in parsers:
+                await docs_queue.put(_END)
+            await asyncio.gather(*parsers)
+            self.stats["parse"].finish()
+            await rows_queue.put(_END)
+            await writer
+        finally:
+            self._stopping.set()
+            for task in [*parsers, writer, reporter]:
+                task.cancel()
+            # Se espera a que terminen las operaciones que ya están en curso en los hilos y
+            # procesos (las pendientes se descartan) antes de cerrar los fetchers y el writer
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            if self._parse_executor is not self._executor:
+                self._parse_executor.shutdown(wait=True, cancel_futures=True)
+            if self._close_fetcher is not None:
+                for fetcher in self._fetchers.values():
+                    self._close_fetcher(fetcher)
+            self._fetchers = {}
+            if not self._writer_closed:
+                # Error o interrupción: se guardan las filas ya parseadas
+                self._close_writer(rows_queue)
+        self._log_stats()
+        return self.stats["write"].processed
+
+    async def _fetch_round(
+        self, meds_id_numbers, ids_queue: asyncio.Queue, docs_queue: asyncio.Queue
+    ):
+        loop = asyncio.get_running_loop()
+        producer = loop.run_in_executor(
+            self._executor, self._produce, meds_id_numbers, ids_queue, loop
+        )
+        fetchers = [
+            asyncio.create_task(self._fetch_worker(worker_num, ids_queue, docs_queue))
+            for worker_num in range(self._workers)
+        ]
+        try:
+            await producer
+            for _ in fetchers:
+                await ids_queue.put(_END)
+            await asyncio.gather(*fetchers)
+        finally:
+            for task in fetchers:
+                task.cancel()
+
+    def _produce(self, meds_id_numbers, ids_queue: asyncio.Queue, loop):
+        # El productor es un iterador bloqueante (p.ej. el scroll de la lista de resultados),
+        # así que se ejecuta en un hilo y entrega cada id al bucle de eventos esperando
+        # a que haya hueco en la cola
+        stats = self.stats["ids"]
+        start = time.perf_counter()
+        for med_id_number in meds_id_numbers:
+            stats.record(time.perf_counter() - start)
+            if not self._put_threadsafe(ids_queue, med_id_number, loop):
+                return
+            start = time.perf_counter()
+        stats.finish()
+
+    def _put_threadsafe(self, queue: asyncio.Queue, item, loop) -> bool:
+        # Devuelve False si el pipeline se detiene (error o interrupción) mientras se espera
+        # hueco en la cola: en ese caso ya no hay nadie leyendo de ella
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=_STOP_POLL)
+                return True
+            except concurrent.futures.TimeoutError:
+                if self._stopping.is_set():
+                    future.cancel()
+                    return False
+            except concurrent.futures.CancelledError:
+                return False
+
+    def _get_fetcher(self, worker_num: int):
+        # Se ejecuta en un hilo; el fetcher se guarda en cuanto se crea para poder cerrarlo
+        # aunque el worker se cancele mientras tanto
+        fetcher = self._fetchers.get(worker_num)
+        if fetcher is None:
+            fetcher = self._fetchers[worker_num] = self._fetcher_factory()
+        return fetcher
+
+    async def _fetch_worker(
+        self, worker_num: int, ids_queue: asyncio.Queue, docs_queue: asyncio.Queue
+    ):
+        loop = asyncio.get_running_loop()
+        stats = self.stats["fetch"]
+        while True:
+            med_id_number = await ids_queue.get()
+            if med_id_number is _END:
+                break
+            # En las rondas de reintentos, cada medicamento espera su turno
+            await loop.run_in_executor(
+                self._executor, self._retries.wait, med_id_number
+            )
+            start = time.perf_counter()
+            try:
+                fetcher = await loop.run_in_executor(
+                    self._executor, self._get_fetcher, worker_num
+                )
+                document = await loop.run_in_executor(
+                    self._executor, self._fetch, fetcher, med_id_number
+                )
+            except Exception as err:
+                stats.record(time.perf_counter() - start, error=True)
+                logger.debug(f"Fetch worker {worker_num} - Error en {med_id_number}")
+                self._retries.failed(med_id_number, err)
+                continue
+            stats.record(time.perf_counter() - start)
+            await docs_queue.put((med_id_number, document))
+
+    async def _parse_worker(self, docs_queue: asyncio.Queue, rows_queue: asyncio.Queue):
+        while True:
+            item = await docs_queue.get()
+            if item is _END:
+                break
+            try:
+                await self._parse_document(*item, rows_queue)
+            finally:
+                docs_queue.task_done()
+
+    async def _parse_document(
+        self, med_id_number: str, document, rows_queue: asyncio.Queue
+    ):
+        loop = asyncio.get_running_loop()
+        stats = self.stats["parse"]
+        start = time.perf_counter()
+        try:
+            row = await loop.run_in_executor(
+                self._parse_executor, self._parse, document
+            )
+        except Exception as err:
+            stats.record(time.perf_counter() - start, error=True)
+            if self._invalidate is not None:
+                await loop.run_in_executor(
+                    self._executor, self._invalidate, med_id_number
+                )
+            self._retries.failed(med_id_number, err)
+            return
+        stats.record(time.perf_counter() - start)
+        # Con varios workers de parseo incluye el envío al proceso y la espera en su cola
+        self._metrics.observe(
+            "stage_seconds", time.perf_counter() - start, stage="parseo"
+        )
+        await rows_queue.put(row)
+
+    async def _write_worker(self, rows_queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        stats = self.stats["write"]
+        while True:
+            row = await rows_queue.get()
+            if row is _END:
+                break
+            start = time.perf_counter()
+            await loop.run_in_executor(self._executor, self._writer.write, row)
+            stats.record(time.perf_counter() - start)
+        self._writer_closed = True
+        await loop.run_in_executor(self._executor, self._writer.close)
+        stats.finish()
+
+    def _close_writer(self, rows_queue: asyncio.Queue):
+        # Se llama con los hilos ya detenidos: escribe las filas que quedan en la cola y
+        # cierra el writer para que lleguen al disco
+        self._writer_closed = True
+        stats = self.stats["write"]
+        try:
+            while not rows_queue.empty():
+                row = rows_queue.get_nowait()
+                if row is _END:
+                    continue
+                start = time.perf_counter()
+                self._writer.write(row)
+                stats.record(time.perf_counter() - start)
+            self._writer.close()
+        except Exception as err:
+            logger.error(f"Error al guardar las filas pendientes: {err}")
+        stats.finish()
+
+    async def _report(self, *queues: asyncio.Queue):
+        while True:
+            await asyncio.sleep(self._log_interval)
+            sizes = ", ".join(str(q.qsize()) for q in queues)
+            logger.info(f"Colas (ids, páginas, filas): {sizes}")
+            self._log_stats()
+
+    def _log_stats(self):
+        for stats in self.stats.values():
+            logger.info(str(stats))
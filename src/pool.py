@@ -0,0 +1,319 @@
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+from metrics import Metrics
+from retries import RetryPolicy, RetryQueue
+
+logger = logging.getLogger(__name__)
+
+# Marca de los elementos descartados en ReorderBuffer
+_DISCARDED = object()
+
+
+class WorkerPool:
+    def __init__(
+        self,
+        worker_factory: Callable[[], Any],
+        num_workers: int,
+        max_retries: int = 2,
+        close_worker: Optional[Callable[[Any], None]] = None,
+        should_recycle: Optional[Callable[[Exception], bool]] = None,
+        metrics: Metrics = None,
+        retry_policy: RetryPolicy = None,
+        on_discard: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        self._worker_factory = worker_factory
+        self._num_workers = max(1, num_workers)
+        self._max_retries = max(0, max_retries)
+        self._close_worker = close_worker
+        self._should_recycle = should_recycle
+        self._metrics = metrics or Metrics()
+        self._retry_policy = retry_policy or RetryPolicy()
+        # Se llama con cada elemento que falla en todos los intentos
+        self._on_discard = on_discard
+
+    def map(self, task: Callable[[Any, Any], Any], items: Iterable) -> List:
+        # Cada tarea lleva su posición original para poder devolver los resultados
+        # en el mismo orden en que se recibieron, independientemente del worker que la procese
+        # (o de que se haya obtenido en un reintento). Las tareas que fallan en todos los
+        # intentos quedan a None
+        items = list(items)
+        results = [None] * len(items)
+        retries = RetryQueue(
+            self._max_retries, self._retry_policy, self._metrics, self._on_discard
+        )
+        pending = list(enumerate(items))
+        # Pasada principal y, a continuación, las rondas de reintentos diferidos
+        while pending:
+            self._run_round(task, pending, results, retries)
+            pending = retries.take()
+        return results
+
+    def _run_round(self, task, pending: list, results: list, retries: RetryQueue):
+        tasks = queue.Queue()
+        for index, item in pending:
+            tasks.put((index, item))
+
+        threads = [
+            threading.Thread(
+                target=self._run_worker,
+                args=(worker_num, task, tasks, results, retries),
+                name=f"worker-{worker_num}",
+                daemon=True,
+            )
+            for worker_num in range(min(self._num_workers, len(pending)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _run_worker(
+        self,
+        worker_num: int,
+        task,
+        tasks: queue.Queue,
+        results: list,
+        retries: RetryQueue,
+    ):
+        worker = None
+        try:
+            while True:
+                try:
+                    index, item = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                retries.wait(item)
+                try:
+                    # El worker (p.ej. un driver) se crea la primera vez que se necesita
+                    # o tras haberse descartado por un error irrecuperable
+                    if worker is None:
+                        worker = self._worker_factory()
+                    results[index] = task(worker, item)
+                except Exception as err:
+                    logger.debug(f"Worker {worker_num} - Error en '{item}': {err}")
+                    retries.failed(item, err, payload=(index, item))
+                    if (
+                        worker is not None
+                        and self._should_recycle
+                        and self._should_recycle(err)
+                    ):
+                        self._close(worker)
+                        worker = None
+        finally:
+            if worker is not None:
+                self._close(worker)
+
+    def _close(self, worker):
+        if self._close_worker is None:
+            return
+        try:
+            self._close_worker(worker)
+        except Exception as err:
+            logger.warning(f"No se ha podido cerrar el worker correctamente: {err}")
+
+
+class WarmPool:
+    # Workers (p.ej. navegadores) arrancados de antemano y reutilizados entre llamadas, para
+    # los procesos de larga duración (ver service.py): cada tarea toma prestado un worker
+    # libre y lo devuelve al terminar, sin pagar el arranque en cada petición. Los workers
+    # que quedan inservibles se sustituyen por uno nuevo en segundo plano
+    def __init__(
+        self,
+        worker_factory: Callable[[], Any],
+        size: int,
+        close_worker: Optional[Callable[[Any], None]] = None,
+        should_recycle: Optional[Callable[[Exception], bool]] = None,
+    ) -> None:
+        self._worker_factory = worker_factory
+        self._size = max(1, size)
+        self._close_worker = close_worker
+        self._should_recycle = should_recycle
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        # Workers creados o en creación (libres y prestados)
+        self._live = 0
+
+    def start(self) -> "WarmPool":
+        # Todos los workers se arrancan a la vez
+        with self._lock:
+            missing = self._size - self._live
+            self._live += missing
+        threads = [
+            threading.Thread(target=self._add, name=f"warm-{n}", daemon=True)
+            for n in range(missing)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.info(f"{self._idle.qsize()} workers preparados")
+        return self
+
+    def _add(self):
+        try:
+            worker = self._worker_factory()
+        except Exception as err:
+            # Se volverá a intentar crear cuando se necesite
+            with self._lock:
+                self._live -= 1
+            logger.error(f"No se ha podido arrancar un worker: {err}")
+            return
+        self._idle.put(worker)
+
+    def _acquire(self):
+        with self._lock:
+            create = self._idle.empty() and self._live < self._size
+            if create:
+                self._live += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return self._worker_factory()
+        except Exception:
+            with self._lock:
+                self._live -= 1
+            raise
+
+    @contextmanager
+    def worker(self):
+        worker = self._acquire()
+        try:
+            yield worker
+        except Exception as err:
+            if self._should_recycle and self._should_recycle(err):
+                self._replace(worker)
+                worker = None
+            raise
+        finally:
+            if worker is not None:
+                self._idle.put(worker)
+
+    def _replace(self, worker):
+        self._close(worker)
+        threading.Thread(target=self._add, name="warm-replace", daemon=True).start()
+
+    def _close(self, worker):
+        if self._close_worker is None:
+            return
+        try:
+            self._close_worker(worker)
+        except Exception as err:
+            logger.warning(f"No se ha podido cerrar el worker correctamente: {err}")
+
+    def close(self):
+        # Cierra los workers libres (se llama cuando ya no quedan tareas en curso)
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(worker)
+            with self._lock:
+                self._live -= 1
+
+
+class ReorderBuffer:
+    # Entrega los resultados en el orden de 'items' aunque lleguen desordenados (varios
+    # workers, reintentos al final de la pasada...). Cada resultado espera en el búfer solo
+    # hasta que se han entregado o descartado todos los anteriores, así que en memoria
+    # quedan únicamente los que van por delante de un elemento pendiente
+    def __init__(self, items: Iterable, emit: Callable[[Any, Any], None]) -> None:
+        self._items = list(dict.fromkeys(items))
+        self._position = {item: index for index, item in enumerate(self._items)}
+        self._emit = emit
+        self._pending = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        self.emitted = 0
+
+    def put(self, item, value):
+        # Se puede llamar desde varios hilos a la vez; 'emit' se llama siempre en orden y
+        # desde un solo hilo a la vez
+        self._resolve(item, value)
+
+    def discard(self, item):
+        # 'item' ha fallado definitivamente: deja de retener a los siguientes
+        self._resolve(item, _DISCARDED)
+
+    def _resolve(self, item, value):
+        with self._lock:
+            index = self._position.get(item)
+            if index is None:
+                # Fuera de la lista: no tiene posición que esperar
+                if value is not _DISCARDED:
+                    self._deliver(item, value)
+                return
+            if index < self._next or index in self._pending:
+                return
+            self._pending[index] = value
+            while self._next in self._pending:
+                value = self._pending.pop(self._next)
+                if value is not _DISCARDED:
+                    self._deliver(self._items[self._next], value)
+                self._next += 1
+
+    def flush(self):
+        # Al terminar (o si se interrumpe el scraping) se entrega lo que quede retenido,
+        # en orden, saltando los elementos que no han llegado
+        with self._lock:
+            for index in sorted(self._pending):
+                value = self._pending.pop(index)
+                if value is not _DISCARDED:
+                    self._deliver(self._items[index], value)
+            self._next = len(self._items)
+
+    def _deliver(self, item, value):
+        self._emit(item, value)
+        self.emitted += 1
+
+
+class OrderedProcessPool:
+    def __init__(
+        self,
+        func: Callable[[Any], Any],
+        num_workers: int,
+        max_in_flight: Optional[int] = None,
+    ) -> None:
+        # 'func' se ejecuta en otros procesos, por lo que tiene que poder serializarse con
+        # pickle (una función definida a nivel de módulo o un functools.partial de una)
+        self._func = func
+        self._executor = ProcessPoolExecutor(max_workers=max(1, num_workers))
+        self._max_in_flight = max_in_flight or 2 * max(1, num_workers)
+
+    def submit(self, arg) -> Future:
+        return self._executor.submit(self._func, arg)
+
+    def imap(self, items: Iterable[Tuple[Any, Any]]) -> Iterator[Tuple[Any, Any, Any]]:
+        # Recibe pares (clave, argumento) y devuelve (clave, resultado, error) en el mismo
+        # orden de entrada. Mientras los procesos trabajan, el iterador de entrada puede ir
+        # generando el siguiente elemento (p.ej. descargando la siguiente página), pero nunca
+        # hay más de 'max_in_flight' elementos pendientes para acotar la memoria
+        in_flight = deque()
+        for key, arg in items:
+            in_flight.append((key, self.submit(arg)))
+            if len(in_flight) >= self._max_in_flight:
+                yield self._result(*in_flight.popleft())
+        while in_flight:
+            yield self._result(*in_flight.popleft())
+
+    @staticmethod
+    def _result(key, future: Future):
+        try:
+            return key, future.result(), None
+        except Exception as err:
+            return key, None, err
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
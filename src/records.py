@@ -0,0 +1,221 @@
+import gc
+import sys
+from array import array
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List
+
+# Columnas de las filas de medicamentos, en el orden del fichero de salida
+COLUMNAS = [
+    "Número de registro",
+    "Medicamento",
+    "Laboratorio",
+    "Autorizado",
+    "Fecha autorización",
+    "Suspendido",
+    "Fecha suspensión",
+    "Comercializado",
+    "Vías administración",
+    "Dosis",
+    "Formas farmacéuticas",
+    "Principios activos",
+    "Excipientes",
+    "Características",
+    "Códigos ATC",
+    "Formatos",
+]
+_BOOLEANAS = ["Autorizado", "Suspendido", "Comercializado"]
+_LISTAS = [
+    "Vías administración",
+    "Dosis",
+    "Formas farmacéuticas",
+    "Principios activos",
+    "Excipientes",
+    "Características",
+    "Códigos ATC",
+]
+# Columnas de texto con muchos valores repetidos entre medicamentos (el nombre del
+# medicamento y el nº de registro son casi siempre únicos, así que no se internan)
+_TEXTO_REPETIDO = ["Laboratorio", "Fecha autorización", "Fecha suspensión"]
+_FORMATOS = "Formatos"
+_FORMATO_TITULO = "Titulo"
+_FORMATO_CN = "Codigo Nacional"
+# Valor de las columnas booleanas sin dato (p.ej. filas incompletas)
+_SIN_VALOR = -1
+
+
+@contextmanager
+def _gc_paused():
+    # Al convertir las columnas se crean cientos de miles de listas y diccionarios que
+    # disparan repetidamente el recolector de ciclos sin que haya nada que recoger
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _intern(value):
+    # Una única copia en memoria de cada texto repetido (laboratorios, vías, formas, ATC...)
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _compact_list(values) -> tuple:
+    return tuple(_intern(v) for v in values or ())
+
+
+def _compact_formatos(formatos) -> tuple:
+    return tuple(
+        (f.get(_FORMATO_TITULO), _intern(f.get(_FORMATO_CN))) for f in formatos or ()
+    )
+
+
+def _expand_formatos(formatos: tuple) -> list:
+    return [{_FORMATO_TITULO: titulo, _FORMATO_CN: cn} for titulo, cn in formatos]
+
+
+def _compact_bool(value) -> int:
+    return _SIN_VALOR if value is None else int(bool(value))
+
+
+def _expand_bool(value: int):
+    return None if value == _SIN_VALOR else bool(value)
+
+
+def _compact(col: str, value):
+    if col in _BOOLEANAS:
+        return _compact_bool(value)
+    if col in _LISTAS:
+        return _compact_list(value)
+    if col == _FORMATOS:
+        return _compact_formatos(value)
+    if col in _TEXTO_REPETIDO:
+        return _intern(value)
+    return value
+
+
+def _expand(col: str, value):
+    if col in _BOOLEANAS:
+        return _expand_bool(value)
+    if col in _LISTAS:
+        return list(value)
+    if col == _FORMATOS:
+        return _expand_formatos(value)
+    return value
+
+
+class MedicineRecord:
+    # Fila de un medicamento en formato compacto: atributos con __slots__ en lugar de un
+    # diccionario, listas como tuplas y textos repetidos internados
+    __slots__ = ("_values",)
+
+    def __init__(self, values: tuple) -> None:
+        self._values = values
+
+    @classmethod
+    def from_row(cls, row: dict) -> "MedicineRecord":
+        return cls(tuple(_compact(col, row.get(col)) for col in COLUMNAS))
+
+    def to_row(self) -> dict:
+        return {col: _expand(col, value) for col, value in zip(COLUMNAS, self._values)}
+
+
+class MedicineColumns:
+    # Acumulador por columnas de las filas de medicamentos. En un scraping completo se
+    # guardan decenas de miles de filas en memoria; en lugar de un diccionario por fila,
+    # cada columna es una lista (o un array de bytes para los booleanos), las listas de cada
+    # fila se guardan como tuplas y los textos repetidos se internan. Al iterar se obtienen
+    # las filas con el mismo formato de siempre, y to_pandas/to_arrow construyen el
+    # DataFrame o la tabla directamente a partir de las columnas
+    def __init__(self, rows: Iterable = ()) -> None:
+        self._columns = {
+            col: array("b") if col in _BOOLEANAS else [] for col in COLUMNAS
+        }
+        self.extend(rows)
+
+    def append(self, row):
+        # Admite filas (diccionarios) y MedicineRecord, que ya están compactados
+        if isinstance(row, MedicineRecord):
+            values = row._values
+        else:
+            values = [_compact(col, row.get(col)) for col in COLUMNAS]
+        for col, value in zip(COLUMNAS, values):
+            self._columns[col].append(value)
+
+    def extend(self, rows: Iterable):
+        if isinstance(rows, MedicineColumns):
+            for col in COLUMNAS:
+                self._columns[col].extend(rows._columns[col])
+            return
+        for row in rows:
+            self.append(row)
+
+    def __len__(self) -> int:
+        return len(self._columns[COLUMNAS[0]])
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __getitem__(self, index: int) -> dict:
+        return {col: self._value(col, index) for col in COLUMNAS}
+
+    def __iter__(self) -> Iterator[dict]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def _value(self, col: str, index: int):
+        return _expand(col, self._columns[col][index])
+
+    def column(self, col: str) -> list:
+        # Columna con los mismos valores que las filas (listas en lugar de tuplas). Se
+        # convierte la columna entera de una vez, sin pasar por _expand en cada celda
+        values = self._columns[col]
+        if col in _BOOLEANAS:
+            return [None if v == _SIN_VALOR else v == 1 for v in values]
+        if col in _LISTAS:
+            return list(map(list, values))
+        if col == _FORMATOS:
+            return list(map(_expand_formatos, values))
+        return list(values)
+
+    def slice(self, start: int, end: int) -> "MedicineColumns":
+        part = MedicineColumns()
+        for col in COLUMNAS:
+            part._columns[col] = self._columns[col][start:end]
+        return part
+
+    def reorder(self, order: List[int]):
+        # Reordena las filas en el sitio: la fila i pasa a ser la fila order[i]
+        for col, values in self._columns.items():
+            reordered = [values[index] for index in order]
+            self._columns[col] = (
+                array("b", reordered) if col in _BOOLEANAS else reordered
+            )
+
+    def to_pandas(self):
+        import pandas as pd
+
+        with _gc_paused():
+            return pd.DataFrame({col: self.column(col) for col in COLUMNAS})
+
+    def to_arrow(self, schema=None, converters: dict = None):
+        # 'converters' permite transformar columnas concretas (p.ej. fechas) antes de
+        # construir la tabla. pyarrow admite directamente las tuplas de las listas y de los
+        # formatos, así que no hace falta convertirlas a listas y diccionarios
+        import pyarrow as pa
+
+        converters = converters or {}
+        data = {}
+        with _gc_paused():
+            for col in COLUMNAS:
+                if col in _BOOLEANAS:
+                    values = self.column(col)
+                else:
+                    values = list(self._columns[col])
+                if col in converters:
+                    # Cada valor distinto (p.ej. cada fecha) se convierte una sola vez
+                    converted = {v: converters[col](v) for v in set(values)}
+                    values = [converted[v] for v in values]
+                data[col] = values
+            return pa.Table.from_pydict(data, schema=schema)
@@ -0,0 +1,219 @@
+import heapq
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, List
+
+import requests
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    TimeoutException,
+    WebDriverException,
+)
+
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+# Tipos de error de un medicamento
+TIMEOUT = "timeout"
+ELEMENTO_AUSENTE = "elemento_ausente"
+PARSEO = "parseo"
+RED = "red"
+# Respuesta 4xx (salvo 429) del servidor: p.ej. un número de registro que no existe
+NO_DISPONIBLE = "no_disponible"
+OTRO = "otro"
+
+_DEFAULT_BASE_DELAY = 1.0
+_DEFAULT_MAX_DELAY = 60.0
+
+
+def _http_status(err: BaseException):
+    return getattr(getattr(err, "response", None), "status_code", None)
+
+
+def classify_error(err: Exception) -> str:
+    if isinstance(err, (TimeoutException, requests.Timeout, TimeoutError)):
+        return TIMEOUT
+    status = _http_status(err)
+    if status is not None and 400 <= status < 500 and status != 429:
+        return NO_DISPONIBLE
+    # scrape_data accede directamente a los elementos de la página: si falta alguno, bs4
+    # devuelve None (AttributeError al leer su texto), lxml/selectolax y el json de la API
+    # no encuentran la clave (KeyError)
+    if isinstance(err, (NoSuchElementException, AttributeError, KeyError)):
+        return ELEMENTO_AUSENTE
+    # Contenido con un formato inesperado (fechas, códigos nacionales, json inválido...)
+    if isinstance(err, (ValueError, IndexError, TypeError)):
+        return PARSEO
+    if isinstance(err, (requests.RequestException, WebDriverException, OSError)):
+        return RED
+    return OTRO
+
+
+def is_transient(err: BaseException) -> bool:
+    # Timeouts, errores de conexión y respuestas 429/5xx: el servidor está saturado o caído
+    # momentáneamente y tiene sentido volver a intentarlo. Otros errores HTTP (p.ej. 404) o
+    # de parseo se repetirían igual
+    if not isinstance(err, Exception):
+        return False
+    status = _http_status(err)
+    if status is not None:
+        return status == 429 or status >= 500
+    return classify_error(err) in (TIMEOUT, RED)
+
+
+class RetryPolicy:
+    # Configuración de los reintentos compartida por todos los componentes del scraping:
+    # espera exponencial con jitter entre intentos y fichero de medicamentos fallidos
+    # (dead-letter), en formato json lines, que se puede volver a usar con --ids-from
+    def __init__(
+        self,
+        base_delay: float = _DEFAULT_BASE_DELAY,
+        max_delay: float = _DEFAULT_MAX_DELAY,
+        dead_letter_path: str = None,
+    ) -> None:
+        self._base_delay = max(0.0, base_delay)
+        self._max_delay = max(self._base_delay, max_delay)
+        self._dead_letter_path = dead_letter_path
+        self._lock = threading.Lock()
+        self._file = None
+        self.dead_letters = 0
+
+    def delay(self, attempt: int) -> float:
+        # Espera antes del reintento nº 'attempt' (1, 2, ...): la mitad fija y la otra
+        # mitad aleatoria, para que los medicamentos que fallaron a la vez (p.ej. durante
+        # una caída de la web) no se reintenten todos en el mismo instante
+        delay = min(self._max_delay, self._base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def dead_letter(self, item, tipo: str, err: Exception, attempts: int):
+        with self._lock:
+            self.dead_letters += 1
+            if self._dead_letter_path is None:
+                return
+            if self._file is None:
+                # El fichero se sobrescribe con el primer fallido: los de una ejecución
+                # anterior ya no aplican, pero se conservan hasta entonces
+                self._file = open(self._dead_letter_path, "w", encoding="utf-8")
+            entry = {
+                "nregistro": str(item),
+                "tipo": tipo,
+                "error": f"{type(err).__name__}: {err}".strip(),
+                "intentos": attempts,
+                "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            }
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self.dead_letters and self._dead_letter_path:
+            logger.warning(
+                f"{self.dead_letters} medicamentos fallidos guardados en "
+                f"{self._dead_letter_path}. Se pueden volver a scrapear con "
+                f"--ids-from {self._dead_letter_path}"
+            )
+
+
+class RetryQueue:
+    # Cola de reintentos diferidos de un scraping: en la pasada principal cada medicamento
+    # se intenta una sola vez y los que fallan se apartan a esta cola (sin bloquear al resto
+    # con recargas y esperas). Al terminar la pasada se reintentan por rondas, cada uno tras
+    # su espera exponencial, y los que agotan los reintentos pasan al fichero de fallidos.
+    # Es compartida por todos los workers de un mismo scraping. 'on_discard' se llama con
+    # cada elemento que se descarta definitivamente
+    def __init__(
+        self,
+        max_retries: int,
+        policy: RetryPolicy = None,
+        metrics: Metrics = None,
+        on_discard: Callable[[Any], None] = None,
+    ) -> None:
+        self._max_retries = max(0, max_retries)
+        self._policy = policy or RetryPolicy()
+        self._metrics = metrics or Metrics()
+        self._on_discard = on_discard
+        self._lock = threading.Lock()
+        self._attempts = {}
+        self._ready_at = {}
+        self._pending = []
+        self._seq = 0
+
+    def failed(self, item, err: Exception, payload: Any = None) -> bool:
+        # Registra el fallo de 'item' y devuelve True si se va a reintentar. 'payload' es lo
+        # que devolverá take() para reintentarlo (por defecto, el propio item)
+        tipo = classify_error(err)
+        self._metrics.inc("errors_total", tipo=tipo)
+        with self._lock:
+            attempts = self._attempts.get(item, 0) + 1
+            self._attempts[item] = attempts
+            # Lo que el servidor rechaza (p.ej. un 404) se rechazaría igual al reintentarlo
+            retry = attempts <= self._max_retries and tipo != NO_DISPONIBLE
+            if retry:
+                delay = self._policy.delay(attempts)
+                ready_at = time.monotonic() + delay
+                self._ready_at[item] = ready_at
+                payload = item if payload is None else payload
+                heapq.heappush(self._pending, (ready_at, self._seq, payload))
+                self._seq += 1
+        if retry:
+            self._metrics.inc("retries_total", tipo=tipo)
+            logger.warning(
+                f"Id medicamento: {item} - Intento {attempts}/{self._max_retries + 1}"
+                f" fallido ({tipo}). Se reintentará al final de la pasada (espera de"
+                f" {delay:.2f} s)."
+                f" Detalles del error: '{err}'"
+            )
+        else:
+            self._metrics.inc("discarded_total", tipo=tipo)
+            self._policy.dead_letter(item, tipo, err, attempts)
+            logger.error(
+                f"Id medicamento: {item} - Descartado tras {attempts} intentos ({tipo})."
+                f" Detalles del error:\n'{err}'"
+            )
+            if self._on_discard is not None:
+                self._on_discard(item)
+        return retry
+
+    def take(self) -> List:
+        # Siguiente ronda de reintentos, en el orden en el que vence su espera
+        with self._lock:
+            pending = [
+                heapq.heappop(self._pending)[2] for _ in range(len(self._pending))
+            ]
+        if pending:
+            logger.info(f"Reintentando {len(pending)} medicamentos fallidos...")
+        return pending
+
+    def wait(self, item):
+        # Espera hasta que se pueda reintentar 'item' (no espera en la pasada principal)
+        with self._lock:
+            ready_at = self._ready_at.pop(item, None)
+        if ready_at is not None:
+            time.sleep(max(0.0, ready_at - time.monotonic()))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+
+def read_ids(path: str) -> List[str]:
+    # Números de registro de un fichero de fallidos (json lines) o de un fichero de texto
+    # con uno por línea (p.ej. meds_ids.txt)
+    ids = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                line = str(json.loads(line)["nregistro"])
+            ids.append(line)
+    return ids
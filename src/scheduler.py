@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from selenium.common.exceptions import TimeoutException
+
+from metrics import Metrics
+from retries import is_transient
+
+logger = logging.getLogger(__name__)
+
+# Peso de la última medida en la media móvil de la latencia
+_EWMA_ALPHA = 0.2
+# Sin latencia objetivo, una latencia mayor que este múltiplo de la mínima observada se
+# considera síntoma de saturación del servidor
+_LATENCY_FACTOR = 3.0
+# Tiempo mínimo (en segundos) entre dos reducciones de la concurrencia, para que una misma
+# racha de errores de las peticiones en curso no la reduzca varias veces
+_MIN_COOLDOWN = 1.0
+
+
+class RequestScheduler:
+    # Planificador central por el que pasan todas las navegaciones y peticiones a CIMA,
+    # compartido por todos los drivers y clientes. Combina:
+    #  - un token bucket global: como mucho 'rate' peticiones por segundo, con ráfagas de
+    #    hasta 'burst' peticiones
+    #  - un límite de peticiones simultáneas que se ajusta solo (AIMD): se duplica al
+    #    principio (slow start), crece de uno en uno mientras las peticiones van bien y se
+    #    reduce a la mitad ante timeouts, errores del servidor o latencias excesivas
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: int = 1,
+        max_concurrency: Optional[int] = None,
+        min_concurrency: int = 1,
+        latency_target: Optional[float] = None,
+        metrics: Metrics = None,
+    ) -> None:
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._last_refill = time.monotonic()
+        # Sin 'max_concurrency' no se limita el nº de peticiones simultáneas
+        self._adaptive = max_concurrency is not None
+        self._max_concurrency = max(1, max_concurrency or 1)
+        self._min_concurrency = max(1, min(min_concurrency, self._max_concurrency))
+        self._latency_target = latency_target
+        self._metrics = metrics or Metrics()
+        self._limit = self._min_concurrency
+        self._slow_start = True
+        self._successes = 0
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        # Latencia típica (media móvil) y mínima de cada tipo de petición, ya que p.ej. una
+        # página de detalle tarda mucho más que cargar más resultados de la lista
+        self._latency = {}
+        self._min_latency = {}
+        self._lock = threading.Lock()
+        self._slot_available = threading.Condition(self._lock)
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.waited = 0.0
+
+    @property
+    def concurrency(self) -> int:
+        return self._limit
+
+    @contextmanager
+    def request(self, name: str):
+        # Uso: with scheduler.request("detalle"): driver.get(url)
+        start = time.monotonic()
+        self._acquire_slot()
+        try:
+            self._acquire_token()
+            with self._lock:
+                self.waited += time.monotonic() - start
+            request_start = time.monotonic()
+            try:
+                yield
+            except Exception as err:
+                # Una interrupción (p.ej. Ctrl+C) no es un error de la petición
+                self._on_failure(name, err)
+                raise
+            else:
+                self._on_success(name, time.monotonic() - request_start)
+        finally:
+            self._release_slot()
+
+    def _acquire_slot(self):
+        with self._slot_available:
+            while self._adaptive and self._in_flight >= self._limit:
+                self._slot_available.wait()
+            self._in_flight += 1
+
+    def _release_slot(self):
+        with self._slot_available:
+            self._in_flight -= 1
+            self._slot_available.notify_all()
+
+    def _acquire_token(self):
+        if self._rate is None:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._burst, self._tokens + (now - self._last_refill) * self._rate
+                )
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def _on_success(self, name: str, latency: float):
+        self._metrics.observe("request_seconds", latency, request=name)
+        with self._slot_available:
+            self.requests += 1
+            previous = self._latency.get(name, latency)
+            self._latency[name] = _EWMA_ALPHA * latency + (1 - _EWMA_ALPHA) * previous
+            self._min_latency[name] = min(self._min_latency.get(name, latency), latency)
+            if not self._adaptive:
+                return
+            if self._is_slow(name, latency):
+                self._decrease("latencia de {:.2f} s".format(latency))
+                return
+            # Aumento aditivo: +1 por cada 'limit' peticiones correctas (en slow start, x2)
+            self._successes += 1
+            if self._successes >= self._limit and self._limit < self._max_concurrency:
+                self._successes = 0
+                self._limit = min(
+                    self._max_concurrency,
+                    self._limit * 2 if self._slow_start else self._limit + 1,
+                )
+                self._slot_available.notify_all()
+                logger.debug(f"Concurrencia aumentada a {self._limit}")
+
+    def _on_failure(self, name: str, err: Exception):
+        self._metrics.inc(
+            "request_errors_total", request=name, error=type(err).__name__
+        )
+        with self._slot_available:
+            self.requests += 1
+            self.errors += 1
+            if isinstance(err, TimeoutException):
+                self.timeouts += 1
+            # Solo los timeouts, errores de conexión y respuestas 429/5xx indican que el
+            # servidor está saturado. El resto (p.ej. un 404 o un elemento que no aparece en
+            # la página) se cuentan como error pero no reducen el ritmo
+            if self._adaptive and is_transient(err):
+                self._decrease(f"error en '{name}': {type(err).__name__}")
+
+    def _is_slow(self, name: str, latency: float) -> bool:
+        if self._latency_target is not None:
+            return latency > self._latency_target
+        return (
+            latency > _LATENCY_FACTOR * self._min_latency[name]
+            and latency > self._latency[name]
+        )
+
+    def _decrease(self, reason: str):
+        # Reducción multiplicativa, como mucho una vez por intervalo de enfriamiento
+        now = time.monotonic()
+        cooldown = max([_MIN_COOLDOWN, *self._latency.values()])
+        self._successes = 0
+        self._slow_start = False
+        if now - self._last_decrease < cooldown:
+            return
+        self._last_decrease = now
+        new_limit = max(self._min_concurrency, self._limit // 2)
+        if new_limit != self._limit:
+            logger.info(
+                f"Concurrencia reducida de {self._limit} a {new_limit} ({reason})"
+            )
+        self._limit = new_limit
+
+    def report(self):
+        if not self.requests:
+            return
+        logger.info(
+            f"Peticiones: {self.requests} ({self.errors} errores, {self.timeouts} timeouts). "
+            f"Concurrencia final: {self._limit}. "
+            f"Tiempo esperando turno: {self.waited:.1f} s."
+        )
+        for name, latency in sorted(self._latency.items()):
+            logger.info(f"  Latencia típica de '{name}': {latency:.2f} s")
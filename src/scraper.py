@@ -1,15 +1,46 @@
 import logging
 import argparse
+import os
+from functools import partial
 
-import pandas as pd
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium import webdriver
-
+from cache import PageCache
+from checkpoint import CrawlCheckpoint
 from cima import Cima
+from cima_api import CimaApiClient, api_search_params, parse_medicine_json
+from drivers import DriverManager, create_chrome_driver
+from incremental import load_previous_dataset, merge_incremental, plan_incremental
+from medicines import CIMA_URL, MedicineDetails, MedicinesSearch, parse_medicine_html
+from metrics import Metrics, PageProfiler
+from pipeline import CrawlPipeline
+from pool import OrderedProcessPool
+from retries import RetryPolicy, read_ids
+from scheduler import RequestScheduler
+from shards import merge_shards, parse_shard, shard_conflicts, shard_filters
+from waits import AdaptiveWaiter
+from writers import WRITERS, infer_format, open_writer
 
 _DEFAULT_SLEEP_TIME = 3
 _DEFAULT_SCROLLING_SLEEP_TIME = 0.5
 _DEFAULT_TIMEOUT = 20
+_DEFAULT_WORKERS = 1
+_DEFAULT_MAX_RETRIES = 2
+_DEFAULT_RETRY_DELAY = 1.0
+_DEFAULT_RETRY_MAX_DELAY = 60.0
+_DEFAULT_SEARCH_CACHE_TTL = 24
+_ENGINES = ["selenium", "http"]
+_ID_SOURCES = ["browser", "api"]
+# Nº de elementos de la lista inicial de resultados
+_DEFAULT_NUM_MEDICINES = 25
+_DEFAULT_QUEUE_SIZE = 100
+_DEFAULT_PARSE_WORKERS = 1
+_DEFAULT_CHECKPOINT_INTERVAL = 50
+_DEFAULT_CHECKPOINT_MIN_SECONDS = 30
+_DEFAULT_CHUNK_SIZE = 500
+_DEFAULT_RECYCLE_PAGES = 1000
+_PAGE_LOAD_STRATEGIES = ["normal", "eager", "none"]
+_BLOCKABLE_RESOURCES = ["images", "fonts", "css"]
+_PROFILERS = ["cprofile", "pyinstrument"]
+_DEFAULT_PROFILE_DIR = "perfiles"
 
 logger = logging.getLogger(__name__)
 
@@ -41,19 +72,39 @@ def parser_args():
         "-o",
         type=str,
         required=True,
-        help="Nombre del archivo final (en formato .csv).",
+        help="Nombre del archivo final (en formato .csv, .jsonl, .parquet o .sqlite).",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=list(WRITERS),
+        default=None,
+        help="Formato del archivo final. Por defecto se deduce de la extensión de --out\
+            (csv si no es ninguna de las anteriores). 'jsonl' y 'parquet' guardan las\
+            listas y los formatos con su estructura en lugar de como texto; 'sqlite' genera\
+            una base de datos normalizada con una tabla por cada lista e índices por\
+            principio activo, código ATC, código nacional y laboratorio.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=_DEFAULT_CHUNK_SIZE,
+        help="Número de medicamentos que se acumulan en memoria antes de añadirlos al\
+            archivo final.",
     )
     parser.add_argument(
         "--sleep-time",
         type=float,
         default=_DEFAULT_SLEEP_TIME,
-        help="Tiempo de sleep por defecto.",
+        help="Tiempo de sleep por defecto. Es el tiempo máximo de las esperas a que la web\
+            se actualice (búsqueda, filtros, scroll), que terminan en cuanto la página\
+            está lista.",
     )
     parser.add_argument(
         "--scroll-sleep-time",
         type=float,
         default=_DEFAULT_SCROLLING_SLEEP_TIME,
-        help="Tiempo de sleep para el scrolling de resultados.",
+        help="Tiempo máximo de espera a que se carguen más resultados tras cada scroll.",
     )
     parser.add_argument(
         "--timeout",
@@ -61,6 +112,305 @@ def parser_args():
         default=_DEFAULT_TIMEOUT,
         help="Tiempo de timeout por defecto.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=_DEFAULT_WORKERS,
+        help="Número de workers que scrapearán las páginas de detalle en paralelo\
+            (navegadores con --engine selenium, peticiones concurrentes con --engine http).",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=_DEFAULT_MAX_RETRIES,
+        help="Número de reintentos por medicamento. Los medicamentos que fallan no se\
+            reintentan en el momento sino al terminar la pasada principal, por rondas y con\
+            una espera exponencial (con jitter) entre intentos.",
+    )
+    parser.add_argument(
+        "--retry-delay",
+        type=float,
+        default=_DEFAULT_RETRY_DELAY,
+        help="Espera base (en segundos) antes del primer reintento de un medicamento. Se\
+            duplica en cada reintento.",
+    )
+    parser.add_argument(
+        "--retry-max-delay",
+        type=float,
+        default=_DEFAULT_RETRY_MAX_DELAY,
+        help="Espera máxima (en segundos) entre dos intentos de un medicamento.",
+    )
+    parser.add_argument(
+        "--dead-letter",
+        type=str,
+        default=None,
+        help="Fichero (json lines) en el que se guardan los medicamentos que han fallado\
+            en todos los intentos, con el tipo de error (timeout, elemento_ausente,\
+            parseo, red, no_disponible u otro). Los que el servidor rechaza (4xx salvo 429,\
+            p.ej. un número de registro que no existe) no se reintentan. Por defecto\
+            '<out sin extensión>.fallidos.jsonl'.",
+    )
+    parser.add_argument(
+        "--ids-from",
+        type=str,
+        default=None,
+        help="Scrapea los números de registro de un fichero en lugar de los de la búsqueda:\
+            un fichero de fallidos (--dead-letter) o un fichero de texto con uno por línea.\
+            Por defecto se scrapean todos.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="Número máximo de peticiones por segundo a la web de CIMA, entre todos los\
+            workers. Por defecto no se limita.",
+    )
+    parser.add_argument(
+        "--burst",
+        type=int,
+        default=1,
+        help="Número de peticiones que se pueden hacer seguidas por encima de --rate.",
+    )
+    parser.add_argument(
+        "--latency-target",
+        type=float,
+        default=None,
+        help="Latencia máxima (en segundos) de una petición antes de reducir la concurrencia.\
+            Por defecto se reduce cuando la latencia se dispara respecto a la habitual.",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=_ENGINES,
+        default="selenium",
+        help="Motor con el que se obtienen las páginas de detalle de cada medicamento.\
+            'selenium' navega a cada página con Chrome; 'http' consulta directamente la\
+            API REST que utiliza la propia página de detalle, sin navegador (la API no\
+            incluye las características, que quedan vacías).",
+    )
+    parser.add_argument(
+        "--id-source",
+        type=str,
+        choices=_ID_SOURCES,
+        default="browser",
+        help="Origen de la lista de números de registro de la búsqueda. 'browser' hace\
+            scroll por la lista de resultados de la web; 'api' recorre el listado paginado\
+            de la API REST, sin navegador (con --engine http no se abre Chrome). La API solo\
+            busca por nombre, no aplica los filtros por defecto de la web y solo admite\
+            los filtros de receta, seguimiento adicional, huérfano, biosimilar,\
+            comercializado y autorizado.",
+    )
+    parser.add_argument(
+        "--chromedriver",
+        type=str,
+        default=None,
+        help="Ruta del ejecutable de chromedriver. Por defecto se descarga la primera vez\
+            y su ruta se guarda para las siguientes ejecuciones.",
+    )
+    parser.add_argument(
+        "--page-load-strategy",
+        type=str,
+        choices=_PAGE_LOAD_STRATEGIES,
+        default="eager",
+        help="Estrategia de carga de páginas de Chrome. Con 'eager' no se espera a que\
+            terminen de cargar imágenes, hojas de estilo, etc.",
+    )
+    parser.add_argument(
+        "--block-resources",
+        type=str,
+        default="images,fonts",
+        help="Recursos que no se descargan en el navegador, separados por comas\
+            (images, fonts, css) o 'none' para no bloquear ninguno.",
+    )
+    parser.add_argument(
+        "--recycle-pages",
+        type=int,
+        default=_DEFAULT_RECYCLE_PAGES,
+        help="Nº de páginas de detalle tras las que se sustituye cada navegador por uno\
+            nuevo, para que no se degrade en scrapings largos. 0 para no sustituirlos.",
+    )
+    parser.add_argument(
+        "--recycle-rss",
+        type=float,
+        default=None,
+        help="Memoria máxima (en MB) de cada navegador antes de sustituirlo por uno nuevo\
+            (requiere psutil).",
+    )
+    parser.add_argument(
+        "--cima-url",
+        type=str,
+        default=CIMA_URL,
+        help="URL base de la web de CIMA (útil para apuntar a un servidor local de pruebas).",
+    )
+    parser.add_argument(
+        "--parser",
+        type=str,
+        choices=MedicineDetails.PARSERS,
+        default="bs4",
+        help="Librería utilizada para parsear el html de las páginas de detalle\
+            (solo con --engine selenium). 'lxml' y 'selectolax' son más rápidas pero\
+            requieren instalar el paquete correspondiente.",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=_DEFAULT_PARSE_WORKERS,
+        help="Número de procesos dedicados a parsear las páginas de detalle. Con más de\
+            uno, el parseo se solapa con la descarga de las siguientes páginas.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        default=False,
+        help="Activa el pipeline asíncrono: los medicamentos se obtienen, parsean y\
+            escriben en el fichero de salida a medida que se encuentran en la lista.",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=_DEFAULT_QUEUE_SIZE,
+        help="Tamaño máximo de las colas entre etapas del pipeline asíncrono.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directorio de la caché en disco de las páginas de detalle. Si se especifica,\
+            las páginas ya descargadas se leen de la caché en lugar de la web.",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        help="Antigüedad máxima (en horas) de las páginas de la caché. Por defecto no caducan.",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=float,
+        default=None,
+        help="Tamaño máximo (en MB) de la caché. Al superarlo se eliminan las páginas\
+            usadas hace más tiempo.",
+    )
+    parser.add_argument(
+        "--search-cache-ttl",
+        type=float,
+        default=_DEFAULT_SEARCH_CACHE_TTL,
+        help="Antigüedad máxima (en horas) de los resultados de búsqueda guardados en la\
+            caché (--cache-dir). Una búsqueda repetida con los mismos filtros reutiliza sus\
+            números de registro sin aplicar los filtros ni hacer scroll. 0 para no\
+            reutilizarlos.",
+    )
+    parser.add_argument(
+        "--reparse-from-cache",
+        action="store_true",
+        default=False,
+        help="Genera el fichero de salida únicamente a partir de las páginas guardadas en\
+            la caché (--cache-dir), sin navegador ni acceso a la web.",
+    )
+    parser.add_argument(
+        "--previous",
+        type=str,
+        default=None,
+        help="Dataset (.csv) de una ejecución anterior. Si se especifica, solo se descargan\
+            los medicamentos nuevos (y los seleccionados para actualizar), y el resultado se\
+            combina con el dataset anterior.",
+    )
+    parser.add_argument(
+        "--refresh-fraction",
+        type=float,
+        default=0.0,
+        help="Fracción (entre 0 y 1) de los medicamentos ya conocidos que se vuelven a\
+            descargar, elegidos al azar, en el modo incremental.",
+    )
+    parser.add_argument(
+        "--refresh-older-than",
+        type=float,
+        default=None,
+        help="En el modo incremental, vuelve a descargar los medicamentos cuya página en la\
+            caché (--cache-dir) tenga más de los días indicados.",
+    )
+    parser.add_argument(
+        "--changelog",
+        type=str,
+        default=None,
+        help="Fichero .csv con los cambios detectados en el modo incremental. Por defecto\
+            '<out>_cambios.csv'.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        default=None,
+        help="Scrapea solo una parte del catálogo, con el formato I/N (shard I de N, con N\
+            potencia de 2), para repartir el scraping entre varias máquinas. Cada shard\
+            activa un filtro de cada par de filtros complementarios (comercializado,\
+            receta, seguimiento adicional...) y desactiva el otro, aunque la web lo active\
+            por defecto, de forma que los shards no se solapan.",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Combina las salidas de varios shards en un único fichero (--out), descartando\
+            los medicamentos repetidos, sin hacer scraping.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="Fichero en el que se guarda periódicamente el progreso del scraping para\
+            poder reanudarlo si se interrumpe. Por defecto '<out>.checkpoint'.",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=_DEFAULT_CHECKPOINT_INTERVAL,
+        help="Número de medicamentos scrapeados entre dos guardados del checkpoint.",
+    )
+    parser.add_argument(
+        "--checkpoint-min-seconds",
+        type=float,
+        default=_DEFAULT_CHECKPOINT_MIN_SECONDS,
+        help="Tiempo mínimo (en segundos) entre dos guardados del checkpoint, para que\
+            con --checkpoint-interval pequeños no se escriba a disco continuamente. Con 0\
+            se guarda exactamente cada --checkpoint-interval medicamentos.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Reanuda el scraping desde el checkpoint de una ejecución anterior con los\
+            mismos parámetros de búsqueda, sin volver a descargar los medicamentos ya\
+            completados.",
+    )
+    parser.add_argument(
+        "--metrics-out",
+        type=str,
+        default=None,
+        help="Fichero en el que guardar al final las métricas de tiempos por etapa\
+            (navegación, espera, page_source, parseo, escritura...) y contadores: resumen\
+            json si la extensión es .json y formato de texto de Prometheus en otro caso.",
+    )
+    parser.add_argument(
+        "--profile-pages",
+        type=int,
+        default=None,
+        help="Perfila 1 de cada N páginas de detalle (por defecto, ninguna).",
+    )
+    parser.add_argument(
+        "--profiler",
+        type=str,
+        default="cprofile",
+        choices=_PROFILERS,
+        help="Perfilador de --profile-pages. 'pyinstrument' requiere instalar el paquete\
+            pyinstrument.",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=str,
+        default=_DEFAULT_PROFILE_DIR,
+        help="Directorio en el que se guardan los perfiles de --profile-pages.",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -84,23 +434,83 @@ def parser_args():
             help="Indica si seleccionar el " + v,
         )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.reparse_from_cache and not args.cache_dir:
+        parser.error("--reparse-from-cache requiere especificar --cache-dir")
+    if args.refresh_older_than is not None and not args.cache_dir:
+        parser.error("--refresh-older-than requiere especificar --cache-dir")
+    if args.checkpoint_interval < 1:
+        parser.error("--checkpoint-interval debe ser al menos 1")
+    if args.checkpoint_min_seconds < 0:
+        parser.error("--checkpoint-min-seconds no puede ser negativo")
+    if args.shard:
+        try:
+            index, total = parse_shard(args.shard)
+        except ValueError as err:
+            parser.error(str(err))
+        conflicts = shard_conflicts(get_search_filters(args), total)
+        if conflicts:
+            parser.error(
+                f"Los filtros {', '.join(conflicts)} no se pueden combinar con --shard {args.shard}"
+            )
+        # El shard se traduce en filtros de la búsqueda, como si se hubiesen indicado a mano
+        for f in shard_filters(index, total):
+            setattr(args, f, True)
+    args.format = args.format or infer_format(args.out)
+    if args.previous and args.format != "csv":
+        parser.error("El modo incremental (--previous) solo admite el formato csv")
+    if args.ids_from:
+        if args.id_source == "api" or args.previous:
+            parser.error(
+                "--ids-from no se puede combinar con --id-source api ni --previous"
+            )
+        if not args.num_medicamentos:
+            args.num_medicamentos = -1
+    if args.id_source == "api":
+        try:
+            api_search_params(args.search, get_search_filters(args))
+        except ValueError as err:
+            parser.error(str(err))
+    if args.resume and (args.pipeline or args.previous):
+        parser.error("--resume no está disponible con --pipeline ni con --previous")
+    args.block_resources = [
+        r.strip()
+        for r in args.block_resources.split(",")
+        if r.strip() and r.strip() != "none"
+    ]
+    unknown = [r for r in args.block_resources if r not in _BLOCKABLE_RESOURCES]
+    if unknown:
+        parser.error(
+            f"Recursos desconocidos en --block-resources: {', '.join(unknown)}"
+        )
+    return args
 
 
-def initialize_driver() -> webdriver:
-    chrome_options = webdriver.ChromeOptions()
-    chrome_options.add_argument("--headless")  # No interface
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument(
-        "--user-agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) \
-        AppleWebKit/537.36 (KHTML, like Gecko) Chrome/95.0.4638.69 Safari/537.36'"
-    )
-    driver = webdriver.Chrome(
-        executable_path=ChromeDriverManager().install(), options=chrome_options
+def open_driver_manager(args) -> DriverManager:
+    # Todos los navegadores (el principal y los de los workers) se crean y se cierran a
+    # través del DriverManager, que los sustituye periódicamente en scrapings largos
+    return DriverManager(
+        partial(
+            create_chrome_driver,
+            driver_path=args.chromedriver,
+            block_resources=args.block_resources,
+            page_load_strategy=args.page_load_strategy,
+        ),
+        max_pages=args.recycle_pages or None,
+        max_rss=(
+            int(args.recycle_rss * 1024 * 1024)
+            if args.recycle_rss is not None
+            else None
+        ),
     )
-    return driver
+
+
+def open_metrics(args) -> Metrics:
+    # Registro de métricas compartido por todos los componentes del scraping
+    profiler = None
+    if args.profile_pages:
+        profiler = PageProfiler(args.profile_pages, args.profile_dir, args.profiler)
+    return Metrics(profiler=profiler)
 
 
 def select_items(data: dict, keys_to_select: list):
@@ -119,6 +529,217 @@ def filterout_false_values(data: dict):
     return filtered_data
 
 
+def get_search_filters(args) -> list:
+    search_filters = select_items(
+        data=vars(args), keys_to_select=Cima._FILTROS_BUSQUEDA.keys()
+    )
+    return list(filterout_false_values(search_filters).keys())
+
+
+def first_ids(ids: list, num_medicines: int) -> list:
+    # Origen de los números de registro a partir de una lista ya conocida (--ids-from)
+    return ids if num_medicines == -1 else ids[:num_medicines]
+
+
+def open_retry_policy(args) -> RetryPolicy:
+    return RetryPolicy(
+        base_delay=args.retry_delay,
+        max_delay=args.retry_max_delay,
+        dead_letter_path=args.dead_letter
+        or f"{os.path.splitext(args.out)[0]}.fallidos.jsonl",
+    )
+
+
+def open_cache(args) -> PageCache:
+    if not args.cache_dir:
+        return None
+    return PageCache(
+        args.cache_dir,
+        ttl=args.cache_ttl * 3600 if args.cache_ttl is not None else None,
+        # El modo incremental necesita la lista actual de la búsqueda para detectar altas y
+        # bajas, así que no reutiliza la de ejecuciones anteriores
+        search_ttl=0 if args.previous else args.search_cache_ttl * 3600,
+        max_size=(
+            int(args.cache_max_size * 1024 * 1024)
+            if args.cache_max_size is not None
+            else None
+        ),
+    )
+
+
+def open_checkpoint(args, search_filters: list) -> CrawlCheckpoint:
+    # Solo se puede reanudar un checkpoint generado con la misma búsqueda
+    checkpoint = CrawlCheckpoint(
+        args.checkpoint or f"{args.out}.checkpoint",
+        fingerprint={
+            "search": args.search,
+            "num_medicamentos": args.num_medicamentos,
+            "remove_default_filters": args.remove_default_filters,
+            "filtros": sorted(search_filters),
+            **({"ids_from": args.ids_from} if args.ids_from else {}),
+        },
+        interval=args.checkpoint_interval,
+        min_seconds=args.checkpoint_min_seconds,
+    )
+    if args.resume:
+        if not checkpoint.load():
+            logger.warning(
+                "No se ha encontrado ningún checkpoint. Se empieza desde el principio."
+            )
+    else:
+        checkpoint.remove()
+    return checkpoint
+
+
+def reparse_from_cache(args, cache: PageCache, metrics: Metrics = None) -> int:
+    # Las páginas se guardan en la caché en el formato del motor que las descargó
+    if args.engine == "http":
+        formato, parse = "json", parse_medicine_json
+    else:
+        formato, parse = "html", partial(parse_medicine_html, parser=args.parser)
+    logger.info(f"Parseando {len(cache)} páginas de la caché {args.cache_dir}...")
+
+    def parse_all(pages):
+        for m, document in pages:
+            try:
+                yield m, parse(document), None
+            except Exception as err:
+                yield m, None, err
+
+    pool = (
+        OrderedProcessPool(parse, args.parse_workers)
+        if args.parse_workers > 1
+        else None
+    )
+    try:
+        if pool is not None:
+            results = pool.imap(cache.items(formato))
+        else:
+            results = parse_all(cache.items(formato))
+        with open_writer(args.out, args.format, args.chunk_size, metrics) as writer:
+            for m, med_data, err in results:
+                if err is not None:
+                    logger.error(
+                        f"Id medicamento: {m} - Error al parsear la página.\n"
+                        f"Detalles del error:\n'{err}'"
+                    )
+                    continue
+                writer.write(med_data)
+    finally:
+        if pool is not None:
+            pool.close()
+    return writer.rows_written
+
+
+def run_incremental(
+    args,
+    search: MedicinesSearch,
+    engine: CimaApiClient,
+    cache: PageCache,
+    drivers: DriverManager,
+    metrics: Metrics,
+    id_source=None,
+):
+    previous = load_previous_dataset(args.previous)
+    logger.info(f"Dataset anterior: {len(previous)} medicamentos ({args.previous})")
+    # Para detectar altas y bajas hace falta la lista completa de la búsqueda
+    if id_source is not None:
+        current_ids = list(id_source(args.num_medicamentos or -1))
+    else:
+        current_ids = search.get_medicines_id_numbers(
+            args.num_medicamentos or -1, args.scroll_sleep_time
+        )
+    formato = "json" if engine is not None else "html"
+    plan = plan_incremental(
+        current_ids,
+        previous,
+        refresh_fraction=args.refresh_fraction,
+        refresh_older_than=(
+            args.refresh_older_than * 24 * 3600
+            if args.refresh_older_than is not None
+            else None
+        ),
+        cache=cache,
+        formato=formato,
+    )
+    logger.info(f"Modo incremental: {plan}")
+    if cache is not None:
+        # Las páginas a actualizar no se pueden leer de la caché
+        for m in plan.refresh:
+            cache.delete(m, formato)
+    fetched = search.scrape_medicines_by_id_numbers(
+        plan.to_fetch,
+        workers=args.workers,
+        driver_factory=drivers.new_driver,
+        max_retries=args.max_retries,
+        engine=engine,
+        parse_workers=args.parse_workers,
+    )
+    medicines_table, changelog = merge_incremental(current_ids, previous, fetched, plan)
+    with metrics.timer("escritura"):
+        medicines_table.to_csv(args.out, index=True)
+    logger.info(f"Datos guardados en {args.out}")
+    changelog_path = args.changelog or f"{os.path.splitext(args.out)[0]}_cambios.csv"
+    changelog.to_csv(changelog_path, index=False)
+    logger.info(f"Registro de cambios guardado en {changelog_path}")
+
+
+def build_pipeline(
+    args,
+    engine: CimaApiClient,
+    writer,
+    cache: PageCache,
+    waiter: AdaptiveWaiter,
+    scheduler: RequestScheduler,
+    drivers: DriverManager,
+    metrics: Metrics,
+    retry_policy: RetryPolicy,
+) -> CrawlPipeline:
+    # Las páginas que no se pueden parsear se quitan de la caché antes de reintentarlas
+    formato = "json" if engine is not None else "html"
+    invalidate = partial(cache.delete, formato=formato) if cache is not None else None
+    if engine is not None:
+        # Con el motor http todos los workers comparten el mismo cliente
+        return CrawlPipeline(
+            fetcher_factory=lambda: engine,
+            fetch=lambda client, m: client.get_medicine_json(m),
+            parse=parse_medicine_json,
+            writer=writer,
+            workers=args.workers,
+            queue_size=args.queue_size,
+            max_retries=args.max_retries,
+            parse_workers=args.parse_workers,
+            metrics=metrics,
+            retry_policy=retry_policy,
+            invalidate=invalidate,
+        )
+    return CrawlPipeline(
+        fetcher_factory=lambda: MedicinesSearch(
+            drivers.new_driver(),
+            sleep_time=args.sleep_time,
+            timeout=args.timeout,
+            base_url=args.cima_url,
+            cache=cache,
+            waiter=waiter,
+            scheduler=scheduler,
+            driver_manager=drivers,
+            metrics=metrics,
+            retry_policy=retry_policy,
+        ),
+        fetch=lambda search, m: search.get_medicine_html_by_id_number(m),
+        parse=partial(parse_medicine_html, parser=args.parser),
+        writer=writer,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        max_retries=args.max_retries,
+        close_fetcher=lambda search: search.quit(),
+        parse_workers=args.parse_workers,
+        metrics=metrics,
+        retry_policy=retry_policy,
+        invalidate=invalidate,
+    )
+
+
 def main():
     args = parser_args()
     logging.basicConfig(
@@ -126,28 +747,168 @@ def main():
         format="%(asctime)s [%(levelname)s] -- %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
+    if args.merge_shards:
+        merge_shards(args.merge_shards, args.out, args.chunk_size)
+        return
+    drivers = open_driver_manager(args)
+    engine = None
+    listing = None
+    id_source = None
+    retry_policy = None
+    cache = open_cache(args)
+    metrics = open_metrics(args)
+    ids_from = None
+    if args.ids_from:
+        # Se leen antes de crear el fichero de fallidos, que puede ser el mismo
+        ids_from = read_ids(args.ids_from)
+        logger.info(f"{len(ids_from)} números de registro leídos de {args.ids_from}")
+    # Compartido por todos los drivers para medir el tiempo dedicado a esperar a la web
+    waiter = AdaptiveWaiter()
+    # Todas las peticiones a la web pasan por el mismo planificador: la concurrencia real se
+    # ajusta entre 1 y --workers según la latencia y los errores
+    scheduler = RequestScheduler(
+        rate=args.rate,
+        burst=args.burst,
+        max_concurrency=args.workers,
+        latency_target=args.latency_target,
+        metrics=metrics,
+    )
     try:
-        driver = initialize_driver()
-        cima_webpage = Cima(driver, args.sleep_time, args.timeout)
-        search_filters = select_items(
-            data=vars(args), keys_to_select=Cima._FILTROS_BUSQUEDA.keys()
-        )
-        search = cima_webpage.search_medicines(
-            search=args.search,
-            remove_default_filters=args.remove_default_filters,
-            search_filters=list(filterout_false_values(search_filters).keys()),
-        )
-        medicines_data = search.scrape_medicines(
-            num_medicines=args.num_medicamentos,
-            scroll_sleep_time=args.scroll_sleep_time,
-        )
-        medicines_table = pd.DataFrame.from_records(
-            medicines_data, index="Número de registro"
-        )
-        medicines_table.to_csv(args.out, index=True)
-        logger.info(f"Datos guardados en {args.out}")
+        if args.reparse_from_cache:
+            num_written = reparse_from_cache(args, cache, metrics)
+            logger.info(f"{num_written} medicamentos guardados en {args.out}")
+            return
+        # Después del reparseo, que no descarga nada y no debe tocar el fichero de
+        # fallidos de la ejecución anterior
+        retry_policy = open_retry_policy(args)
+        if args.engine == "http":
+            engine = CimaApiClient(
+                args.cima_url,
+                timeout=args.timeout,
+                pool_size=args.workers,
+                cache=cache,
+                scheduler=scheduler,
+                metrics=metrics,
+                retry_policy=retry_policy,
+                max_retries=args.max_retries,
+            )
+        search_filters = get_search_filters(args)
+        if ids_from is not None:
+            id_source = partial(first_ids, ids_from)
+        elif args.id_source == "api":
+            listing = engine or CimaApiClient(
+                args.cima_url,
+                timeout=args.timeout,
+                scheduler=scheduler,
+                metrics=metrics,
+                retry_policy=retry_policy,
+                max_retries=args.max_retries,
+            )
+            id_source = partial(
+                listing.iter_medicines_id_numbers,
+                api_search_params(args.search, search_filters),
+            )
+        if id_source is not None:
+            # La lista de resultados no se obtiene de la web, así que no hace falta hacer la
+            # búsqueda. Con el motor http tampoco se necesita navegador para los detalles
+            search = MedicinesSearch(
+                drivers.new_driver() if engine is None else None,
+                sleep_time=args.sleep_time,
+                timeout=args.timeout,
+                base_url=args.cima_url,
+                parser=args.parser,
+                cache=cache,
+                waiter=waiter,
+                scheduler=scheduler,
+                driver_manager=drivers,
+                metrics=metrics,
+                retry_policy=retry_policy,
+            )
+        else:
+            cima_webpage = Cima(
+                drivers.new_driver(),
+                args.sleep_time,
+                args.timeout,
+                base_url=args.cima_url,
+                parser=args.parser,
+                cache=cache,
+                waiter=waiter,
+                scheduler=scheduler,
+                driver_manager=drivers,
+                metrics=metrics,
+                retry_policy=retry_policy,
+            )
+            search = cima_webpage.search_medicines(
+                search=args.search,
+                remove_default_filters=args.remove_default_filters,
+                search_filters=search_filters,
+            )
+        if args.previous:
+            run_incremental(args, search, engine, cache, drivers, metrics, id_source)
+        elif args.pipeline:
+            if id_source is not None:
+                ids = id_source(args.num_medicamentos or _DEFAULT_NUM_MEDICINES)
+            else:
+                ids = search.iter_medicines_id_numbers(
+                    search.resolve_num_medicines(args.num_medicamentos),
+                    args.scroll_sleep_time or args.sleep_time,
+                )
+            pipeline = build_pipeline(
+                args,
+                engine,
+                open_writer(args.out, args.format, args.chunk_size, metrics),
+                cache,
+                waiter,
+                scheduler,
+                drivers,
+                metrics,
+                retry_policy,
+            )
+            num_written = pipeline.run(ids)
+            logger.info(f"{num_written} medicamentos guardados en {args.out}")
+        else:
+            checkpoint = open_checkpoint(args, search_filters)
+            num_medicines = args.num_medicamentos
+            if id_source is not None and not num_medicines:
+                # La lista inicial de la web no existe en la API: sus primeros elementos
+                num_medicines = _DEFAULT_NUM_MEDICINES
+            with open_writer(args.out, args.format, args.chunk_size, metrics) as writer:
+                # Cada fila se añade al fichero de salida en cuanto se obtiene, en bloques de
+                # --chunk-size, sin esperar a que termine el scraping
+                search.scrape_medicines(
+                    num_medicines=num_medicines,
+                    scroll_sleep_time=args.scroll_sleep_time,
+                    workers=args.workers,
+                    driver_factory=drivers.new_driver,
+                    max_retries=args.max_retries,
+                    engine=engine,
+                    parse_workers=args.parse_workers,
+                    checkpoint=checkpoint,
+                    id_source=id_source,
+                    on_result=lambda med_id_number, row: writer.write(row),
+                )
+            logger.info(f"{writer.rows_written} medicamentos guardados en {args.out}")
+            if checkpoint.interrupted:
+                # El scraping no se ha completado: se conserva el checkpoint para --resume
+                checkpoint.close()
+            else:
+                checkpoint.remove()
     finally:
-        driver.quit()
+        waiter.report()
+        scheduler.report()
+        metrics.report()
+        if args.metrics_out:
+            metrics.export(args.metrics_out)
+        metrics.close()
+        if retry_policy is not None:
+            retry_policy.close()
+        if engine is not None:
+            engine.close()
+        if listing is not None and listing is not engine:
+            listing.close()
+        drivers.close()
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,654 @@
+import argparse
+import json
+import logging
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+from cache import PageCache, SearchSession, search_key
+from cima import Cima
+from cima_api import CimaApiClient, api_search_params, parse_medicine_json
+from drivers import DriverManager, create_chrome_driver
+from medicines import CIMA_URL, MedicineDetails, MedicinesSearch, parse_medicine_html
+from metrics import Metrics
+from pool import WarmPool, WorkerPool
+from retries import RetryPolicy
+from scheduler import RequestScheduler
+from waits import AdaptiveWaiter
+
+logger = logging.getLogger(__name__)
+
+_ENGINES = ["selenium", "http"]
+_DEFAULT_SLEEP_TIME = 3
+_DEFAULT_SCROLLING_SLEEP_TIME = 0.5
+_DEFAULT_TIMEOUT = 20
+_DEFAULT_WORKERS = 2
+_DEFAULT_MAX_RETRIES = 1
+_DEFAULT_NUM_MEDICINES = 25
+_DEFAULT_PORT = 8080
+# Nº máximo de medicamentos por petición: los scrapings completos se hacen con scraper.py
+_DEFAULT_MAX_JOB_SIZE = 1000
+_DEFAULT_SEARCH_CACHE_TTL = 24
+_DEFAULT_RECYCLE_PAGES = 1000
+
+
+class NotFound(LookupError):
+    # No se ha podido obtener el medicamento pedido (el servidor responde con un 404)
+    pass
+
+
+def _should_recycle(err: Exception) -> bool:
+    # Si el error no es un simple timeout, el driver puede haber quedado en un estado
+    # inconsistente (p.ej. Chrome se ha cerrado), así que se sustituye por uno nuevo
+    return isinstance(err, WebDriverException) and not isinstance(err, TimeoutException)
+
+
+class MedicineService:
+    # API de librería para consultar medicamentos sueltos o búsquedas desde otras
+    # herramientas sin lanzar un scraping completo. Los navegadores (o el cliente http) se
+    # arrancan una sola vez y se reutilizan entre consultas, el navegador de las búsquedas
+    # se queda en la página de búsqueda, y los medicamentos descargados hace menos de
+    # 'max_age' segundos se devuelven directamente de la caché
+    def __init__(
+        self,
+        engine: str = "selenium",
+        base_url: str = CIMA_URL,
+        workers: int = _DEFAULT_WORKERS,
+        parser: str = "bs4",
+        sleep_time: float = _DEFAULT_SLEEP_TIME,
+        scroll_sleep_time: float = _DEFAULT_SCROLLING_SLEEP_TIME,
+        timeout: float = _DEFAULT_TIMEOUT,
+        max_retries: int = _DEFAULT_MAX_RETRIES,
+        max_age: Optional[float] = None,
+        cache: PageCache = None,
+        drivers: DriverManager = None,
+        waiter: AdaptiveWaiter = None,
+        scheduler: RequestScheduler = None,
+        metrics: Metrics = None,
+        retry_policy: RetryPolicy = None,
+    ) -> None:
+        if engine not in _ENGINES:
+            raise ValueError(f"Motor desconocido: {engine}")
+        self.engine = engine
+        self._base_url = base_url.rstrip("/")
+        self._workers = max(1, workers)
+        self._parser = parser
+        self._sleep_time = sleep_time
+        self._scroll_sleep_time = scroll_sleep_time
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._max_age = max_age
+        self._cache = cache
+        self._formato = "json" if engine == "http" else "html"
+        self._drivers = drivers
+        self.metrics = metrics or Metrics()
+        self._waiter = waiter or AdaptiveWaiter()
+        self._scheduler = scheduler or RequestScheduler(
+            max_concurrency=self._workers, metrics=self.metrics
+        )
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._client = None
+        self._pool = None
+        # Navegador de las búsquedas: solo se hace una búsqueda a la vez
+        self._cima = None
+        self._cima_driver = None
+        self._search_lock = threading.Lock()
+        # Búsquedas hechas con el motor http (con selenium las guarda Cima)
+        self._sessions = {}
+
+    def start(self) -> "MedicineService":
+        if self.engine == "http":
+            # Todas las consultas comparten el mismo cliente (y su pool de conexiones)
+            self._client = CimaApiClient(
+                self._base_url,
+                timeout=self._timeout,
+                pool_size=self._workers,
+                cache=self._cache,
+                scheduler=self._scheduler,
+                metrics=self.metrics,
+                retry_policy=self._retry_policy,
+                max_retries=self._max_retries,
+            )
+            return self
+        self._drivers = self._drivers or DriverManager(create_chrome_driver)
+        self._pool = WarmPool(
+            self._new_worker,
+            self._workers,
+            close_worker=lambda worker: worker.quit(),
+            should_recycle=_should_recycle,
+        ).start()
+        self._search_page()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+        if self._drivers is not None:
+            self._drivers.close()
+        if self._client is not None:
+            self._client.close()
+
+    def _new_worker(self) -> MedicinesSearch:
+        return MedicinesSearch(
+            self._drivers.new_driver(),
+            sleep_time=self._sleep_time,
+            timeout=self._timeout,
+            base_url=self._base_url,
+            parser=self._parser,
+            cache=self._cache,
+            waiter=self._waiter,
+            scheduler=self._scheduler,
+            driver_manager=self._drivers,
+            metrics=self.metrics,
+            retry_policy=self._retry_policy,
+        )
+
+    def _search_page(self) -> Cima:
+        if self._cima is None:
+            # El navegador de las búsquedas lo gestiona el servicio (ver search_ids): sin
+            # 'driver_manager', Cima no lo sustituye ni lo cierra por su cuenta y
+            # '_cima_driver' siempre es el que está utilizando
+            self._cima_driver = self._drivers.new_driver()
+            self._cima = Cima(
+                self._cima_driver,
+                self._sleep_time,
+                self._timeout,
+                base_url=self._base_url,
+                parser=self._parser,
+                cache=self._cache,
+                waiter=self._waiter,
+                scheduler=self._scheduler,
+                metrics=self.metrics,
+                retry_policy=self._retry_policy,
+            )
+            self._cima.open_search_page()
+        return self._cima
+
+    def get_medicine(self, med_id_number, max_age: Optional[float] = None) -> dict:
+        rows, failed = self.scrape([med_id_number], max_age)
+        if failed:
+            raise NotFound(f"No se ha podido obtener el medicamento {med_id_number}")
+        return rows[0]
+
+    def get_medicines(self, meds_id_numbers: list, max_age: Optional[float] = None):
+        return self.scrape(meds_id_numbers, max_age)[0]
+
+    def scrape(
+        self, meds_id_numbers: list, max_age: Optional[float] = None
+    ) -> Tuple[List[dict], List[str]]:
+        # Devuelve las filas de los medicamentos obtenidos, en el orden recibido, y los
+        # números de registro de los que han fallado en todos los intentos
+        meds_id_numbers = [str(m) for m in meds_id_numbers]
+        if not meds_id_numbers:
+            return [], []
+        pool = WorkerPool(
+            worker_factory=lambda: self,
+            num_workers=min(self._workers, len(meds_id_numbers)),
+            max_retries=self._max_retries,
+            metrics=self.metrics,
+            retry_policy=self._retry_policy,
+        )
+        results = pool.map(
+            partial(MedicineService._scrape_one, max_age=max_age), meds_id_numbers
+        )
+        rows = [row for row in results if row is not None]
+        failed = [m for m, row in zip(meds_id_numbers, results) if row is None]
+        return rows, failed
+
+    def _scrape_one(self, med_id_number: str, max_age: Optional[float]) -> dict:
+        content = self._fresh(med_id_number, max_age)
+        if content is not None:
+            self.metrics.inc("cache_hits_total")
+        else:
+            content = self._fetch(med_id_number)
+        try:
+            with self.metrics.timer("parseo"):
+                if self.engine == "http":
+                    return parse_medicine_json(content)
+                return parse_medicine_html(content, self._parser)
+        except Exception:
+            # Al reintentarlo se vuelve a descargar en lugar de leerse de la caché
+            if self._cache is not None:
+                self._cache.delete(med_id_number, self._formato)
+            raise
+
+    def _fresh(self, med_id_number: str, max_age: Optional[float]) -> Optional[str]:
+        # Contenido de la caché si se descargó hace menos de 'max_age' segundos. Si es más
+        # antiguo se quita de la caché para que se vuelva a descargar
+        if self._cache is None:
+            return None
+        max_age = self._max_age if max_age is None else max_age
+        age = self._cache.age(med_id_number, self._formato)
+        if age is None:
+            return None
+        if max_age is not None and age > max_age:
+            self._cache.delete(med_id_number, self._formato)
+            return None
+        return self._cache.get(med_id_number, self._formato)
+
+    def _fetch(self, med_id_number: str) -> str:
+        if self._client is not None:
+            return self._client.get_medicine_json(med_id_number)
+        # Cada página se descarga con uno de los navegadores ya arrancados
+        with self._pool.worker() as worker:
+            return worker.get_medicine_html_by_id_number(med_id_number)
+
+    def search_ids(
+        self,
+        search: str = "*",
+        filters: list = None,
+        remove_default_filters: bool = False,
+        num_medicines: int = None,
+    ) -> List[str]:
+        # Números de registro de una búsqueda, con el mismo criterio que --num-medicamentos.
+        # Las búsquedas repetidas se obtienen de la caché de búsquedas (ver SearchSession)
+        filters = list(filters or [])
+        with self._search_lock:
+            if self._client is not None:
+                return self._search_ids_api(search, filters, num_medicines)
+            try:
+                results = self._search_page().search_medicines(
+                    search, filters, remove_default_filters
+                )
+                return results.get_medicines_id_numbers(
+                    num_medicines, self._scroll_sleep_time
+                )
+            except WebDriverException as err:
+                if _should_recycle(err):
+                    # La siguiente búsqueda abre un navegador nuevo
+                    self._drivers.quit(self._cima_driver)
+                    self._cima = None
+                raise
+            except ValueError as err:
+                logger.info(str(err))
+                return []
+
+    def _search_ids_api(
+        self, search: str, filters: list, num_medicines: int
+    ) -> List[str]:
+        # La API no aplica los filtros por defecto de la web
+        params = api_search_params(search, filters)
+        num_medicines = num_medicines or _DEFAULT_NUM_MEDICINES
+        key = search_key(f"{self._base_url}/cima/rest", search, filters, False)
+        session = self._sessions.get(key)
+        if session is None:
+            session = SearchSession.load(key, self._cache)
+            self._sessions[key] = session
+        meds_id_numbers = session.ids_for(num_medicines)
+        if meds_id_numbers is None:
+            meds_id_numbers = list(
+                self._client.iter_medicines_id_numbers(params, num_medicines)
+            )
+            session.update(
+                meds_id_numbers,
+                complete=num_medicines == -1 or len(meds_id_numbers) < num_medicines,
+            )
+        return meds_id_numbers
+
+    def search(
+        self,
+        search: str = "*",
+        filters: list = None,
+        remove_default_filters: bool = False,
+        num_medicines: int = None,
+        max_age: Optional[float] = None,
+    ) -> List[dict]:
+        meds_id_numbers = self.search_ids(
+            search, filters, remove_default_filters, num_medicines
+        )
+        return self.get_medicines(meds_id_numbers, max_age)
+
+    def status(self) -> dict:
+        return {
+            "estado": "ok",
+            "motor": self.engine,
+            "workers": self._workers,
+            "cache": len(self._cache) if self._cache is not None else None,
+        }
+
+
+class MedicineServer:
+    # Servidor HTTP local (json) sobre un MedicineService:
+    #   GET  /medicamento?nregistro=...&max_age=...  fila de un medicamento
+    #   POST /medicamentos {"nregistros": [...], "max_age": ...}
+    #   POST /busqueda {"busqueda": ..., "filtros": [...], "sin_filtros_por_defecto": ...,
+    #                   "num_medicamentos": ..., "max_age": ...}
+    #   GET  /salud y /metricas (formato Prometheus)
+    # Las peticiones se atienden en paralelo, cada una en su hilo
+    def __init__(
+        self,
+        service: MedicineService,
+        host: str = "127.0.0.1",
+        port: int = _DEFAULT_PORT,
+        max_job_size: int = _DEFAULT_MAX_JOB_SIZE,
+    ) -> None:
+        self.service = service
+        self._max_job_size = max_job_size
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MedicineServer":
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, name="servicio", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        if self._thread is not None:
+            self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handler(self):
+        server = self
+        service = self.service
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _send(self, status: int, body: str, content_type: str):
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_json(self, status: int, data):
+                self._send(
+                    status,
+                    json.dumps(data, ensure_ascii=False, default=str),
+                    "application/json",
+                )
+
+            def _error(self, status: int, message: str):
+                self._send_json(status, {"error": message})
+
+            def _run(self, job: Callable):
+                try:
+                    with service.metrics.timer("servicio"):
+                        data = job()
+                except ValueError as err:
+                    return self._error(400, str(err))
+                except NotFound as err:
+                    return self._error(404, str(err))
+                except Exception as err:
+                    logger.exception("Error al atender la petición")
+                    return self._error(500, f"{type(err).__name__}: {err}")
+                self._send_json(200, data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == "/salud":
+                    return self._send_json(200, service.status())
+                if url.path == "/metricas":
+                    return self._send(
+                        200, service.metrics.to_prometheus(), "text/plain"
+                    )
+                if url.path == "/medicamento":
+                    nregistro = query.get("nregistro", [""])[0]
+                    if not nregistro:
+                        return self._error(400, "Falta el parámetro 'nregistro'")
+                    max_age = query.get("max_age", [None])[0]
+                    return self._run(
+                        lambda: service.get_medicine(nregistro, _float_or_none(max_age))
+                    )
+                self._error(404, "No encontrado")
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                    if not isinstance(body, dict):
+                        raise ValueError("se esperaba un objeto json")
+                except ValueError as err:
+                    return self._error(400, f"Cuerpo de la petición inválido: {err}")
+                if url.path == "/medicamentos":
+                    return self._run(lambda: server._medicines_job(body))
+                if url.path == "/busqueda":
+                    return self._run(lambda: server._search_job(body))
+                self._error(404, "No encontrado")
+
+        return Handler
+
+    def _check_size(self, num: int):
+        if num == -1 or num > self._max_job_size:
+            raise ValueError(
+                f"Como mucho se admiten {self._max_job_size} medicamentos por petición."
+                " Para scrapings completos utilizar scraper.py"
+            )
+
+    def _medicines_job(self, body: dict) -> dict:
+        meds_id_numbers = body.get("nregistros")
+        if not isinstance(meds_id_numbers, list):
+            raise ValueError("'nregistros' tiene que ser una lista")
+        self._check_size(len(meds_id_numbers))
+        rows, failed = self.service.scrape(
+            meds_id_numbers, _float_or_none(body.get("max_age"))
+        )
+        return {"medicamentos": rows, "fallidos": failed}
+
+    def _search_job(self, body: dict) -> dict:
+        num_medicines = body.get("num_medicamentos")
+        if num_medicines is not None:
+            num_medicines = int(num_medicines)
+            self._check_size(num_medicines)
+        filters = body.get("filtros") or []
+        unknown = [f for f in filters if f not in Cima._FILTROS_BUSQUEDA]
+        if unknown:
+            raise ValueError(f"Filtros desconocidos: {', '.join(unknown)}")
+        meds_id_numbers = self.service.search_ids(
+            body.get("busqueda") or "*",
+            filters,
+            bool(body.get("sin_filtros_por_defecto")),
+            num_medicines,
+        )
+        rows, failed = self.service.scrape(
+            meds_id_numbers, _float_or_none(body.get("max_age"))
+        )
+        return {
+            "nregistros": meds_id_numbers,
+            "medicamentos": rows,
+            "fallidos": failed,
+        }
+
+
+def _float_or_none(value) -> Optional[float]:
+    return float(value) if value not in (None, "") else None
+
+
+def parser_args():
+    parser = argparse.ArgumentParser(
+        description="Servicio local que mantiene arrancados los navegadores (o el cliente\
+            http) y atiende consultas de medicamentos y búsquedas por HTTP, devolviendo de\
+            la caché los medicamentos descargados recientemente."
+    )
+    parser.add_argument(
+        "--host", type=str, default="127.0.0.1", help="Dirección del servidor."
+    )
+    parser.add_argument(
+        "--port", type=int, default=_DEFAULT_PORT, help="Puerto del servidor."
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=_ENGINES,
+        default="selenium",
+        help="Motor con el que se obtienen las páginas de detalle (ver scraper.py).",
+    )
+    parser.add_argument(
+        "--cima-url",
+        type=str,
+        default=CIMA_URL,
+        help="URL base de la web de CIMA (útil para apuntar a un servidor local de pruebas).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=_DEFAULT_WORKERS,
+        help="Navegadores arrancados para las páginas de detalle (peticiones concurrentes\
+            con --engine http).",
+    )
+    parser.add_argument(
+        "--parser",
+        type=str,
+        choices=MedicineDetails.PARSERS,
+        default="bs4",
+        help="Librería utilizada para parsear el html de las páginas de detalle.",
+    )
+    parser.add_argument(
+        "--sleep-time",
+        type=float,
+        default=_DEFAULT_SLEEP_TIME,
+        help="Tiempo máximo de las esperas a que la web se actualice (búsqueda, filtros).",
+    )
+    parser.add_argument(
+        "--scroll-sleep-time",
+        type=float,
+        default=_DEFAULT_SCROLLING_SLEEP_TIME,
+        help="Tiempo máximo de espera a que se carguen más resultados tras cada scroll.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=_DEFAULT_TIMEOUT,
+        help="Tiempo de timeout por defecto.",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=_DEFAULT_MAX_RETRIES,
+        help="Número de reintentos por medicamento en cada petición.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directorio de la caché en disco de las páginas de detalle (la misma que\
+            utiliza scraper.py).",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=None,
+        help="Antigüedad máxima (en horas) de los medicamentos que se devuelven de la\
+            caché; los más antiguos se vuelven a descargar. Cada petición lo puede cambiar\
+            con 'max_age' (en segundos). Por defecto se devuelven siempre de la caché.",
+    )
+    parser.add_argument(
+        "--search-cache-ttl",
+        type=float,
+        default=_DEFAULT_SEARCH_CACHE_TTL,
+        help="Antigüedad máxima (en horas) de los resultados de búsqueda guardados en la\
+            caché.",
+    )
+    parser.add_argument(
+        "--max-job-size",
+        type=int,
+        default=_DEFAULT_MAX_JOB_SIZE,
+        help="Nº máximo de medicamentos por petición.",
+    )
+    parser.add_argument(
+        "--chromedriver",
+        type=str,
+        default=None,
+        help="Ruta del ejecutable de chromedriver.",
+    )
+    parser.add_argument(
+        "--recycle-pages",
+        type=int,
+        default=_DEFAULT_RECYCLE_PAGES,
+        help="Nº de páginas de detalle tras las que se sustituye cada navegador por uno\
+            nuevo. 0 para no sustituirlos.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        default=False,
+        help="Activar para mostrar mensajes de debugging (Verbose logging).",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parser_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s [%(levelname)s] -- %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    cache = None
+    if args.cache_dir:
+        cache = PageCache(args.cache_dir, search_ttl=args.search_cache_ttl * 3600)
+    drivers = None
+    if args.engine == "selenium":
+        drivers = DriverManager(
+            partial(
+                create_chrome_driver,
+                driver_path=args.chromedriver,
+                block_resources=["images", "fonts"],
+            ),
+            max_pages=args.recycle_pages or None,
+        )
+    service = MedicineService(
+        engine=args.engine,
+        base_url=args.cima_url,
+        workers=args.workers,
+        parser=args.parser,
+        sleep_time=args.sleep_time,
+        scroll_sleep_time=args.scroll_sleep_time,
+        timeout=args.timeout,
+        max_retries=args.max_retries,
+        max_age=args.max_age * 3600 if args.max_age is not None else None,
+        cache=cache,
+        drivers=drivers,
+    )
+    server = None
+    try:
+        service.start()
+        server = MedicineServer(
+            service, args.host, args.port, max_job_size=args.max_job_size
+        )
+        logger.info(f"Servicio disponible en {server.url} (Ctrl+C para terminar)")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.stop()
+        service.close()
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+from itertools import product
+from typing import Dict, Iterator, List, Tuple
+
+import pandas as pd
+
+from writers import infer_format, iter_sqlite_rows, open_writer
+
+logger = logging.getLogger(__name__)
+
+_INDEX = "Número de registro"
+
+# Pares de filtros complementarios de la búsqueda: cada medicamento cumple exactamente uno de
+# los dos, así que combinándolos se obtienen particiones disjuntas del catálogo. Los primeros
+# también están disponibles en el listado de la API (--id-source api)
+_PARES_FILTROS = [
+    ("filtroComercializadoSi", "filtroComercializadoNo"),
+    ("filtroRecetaSi", "filtroRecetaNo"),
+    ("filtroTrianguloSi", "filtroTrianguloNo"),
+    ("filtroHuerfanoSi", "filtroHuerfanoNo"),
+    ("filtroBiosimilarSi", "filtroBiosimilarNo"),
+    ("filtroImpParalelasSi", "filtroImpParalelasNo"),
+]
+
+MAX_SHARDS = 2 ** len(_PARES_FILTROS)
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    # Formato "I/N": shard I (empezando en 0) de un total de N
+    try:
+        index, total = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard '{shard}' no válido. El formato es I/N, p.ej. 0/8")
+    if total < 1 or total > MAX_SHARDS or total & (total - 1):
+        raise ValueError(
+            f"El nº de shards debe ser una potencia de 2 entre 1 y {MAX_SHARDS}"
+        )
+    if not 0 <= index < total:
+        raise ValueError(f"El shard debe estar entre 0 y {total - 1}")
+    return index, total
+
+
+def shard_filters(index: int, total: int) -> List[str]:
+    # Con N = 2^k shards se combinan los k primeros pares de filtros
+    num_pares = total.bit_length() - 1
+    combinaciones = list(product(*_PARES_FILTROS[:num_pares]))
+    return list(combinaciones[index])
+
+
+def filter_state(filters: List[str]) -> Dict[str, bool]:
+    # Estado de los checkbox para una búsqueda con los filtros indicados. En la web, activar
+    # solo uno de los dos filtros de un par restringe la búsqueda, pero activar los dos no
+    # filtra nada: el otro filtro del par se desactiva siempre, aunque la página lo active
+    # por defecto (p.ej. filtroComercializadoSi), salvo que también se haya pedido
+    state = {}
+    for par in _PARES_FILTROS:
+        for f, otro in (par, par[::-1]):
+            if f in filters and otro not in filters:
+                state[otro] = False
+    state.update(dict.fromkeys(filters, True))
+    return state
+
+
+def shard_conflicts(filters: List[str], total: int) -> List[str]:
+    # Filtros seleccionados por el usuario que pertenecen a los pares usados por los shards
+    num_pares = total.bit_length() - 1
+    usados = {f for par in _PARES_FILTROS[:num_pares] for f in par}
+    return [f for f in filters if f in usados]
+
+
+def _iter_rows(path: str, formato: str) -> Iterator[dict]:
+    if formato == "csv":
+        # Se lee como texto para reescribir las celdas exactamente igual
+        for chunk in pd.read_csv(
+            path, dtype=str, keep_default_na=False, chunksize=10000
+        ):
+            yield from chunk.to_dict("records")
+    elif formato == "jsonl":
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    elif formato == "sqlite":
+        yield from iter_sqlite_rows(path)
+    else:
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(path)
+        for i in range(parquet.num_row_groups):
+            yield from parquet.read_row_group(i).to_pylist()
+
+
+def merge_shards(paths: List[str], out: str, chunk_size: int = 500) -> int:
+    # Combina las salidas de varios shards en un único dataset, en el mismo formato, sin
+    # repetir medicamentos que aparezcan en más de un shard
+    formatos = {infer_format(path) for path in paths}
+    formato = infer_format(out)
+    if formatos != {formato}:
+        raise ValueError(
+            f"Todos los ficheros deben tener el mismo formato que la salida ({formato})"
+        )
+    seen = set()
+    duplicates = 0
+    with open_writer(out, formato, chunk_size) as writer:
+        for path in paths:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No existe la salida del shard {path}")
+            n_before = len(seen)
+            for row in _iter_rows(path, formato):
+                m = str(row[_INDEX])
+                if m in seen:
+                    duplicates += 1
+                    continue
+                seen.add(m)
+                writer.write(row)
+            logger.info(f"{path}: {len(seen) - n_before} medicamentos")
+    logger.info(
+        f"{writer.rows_written} medicamentos combinados en {out} "
+        f"({duplicates} duplicados descartados)"
+    )
+    return writer.rows_written
@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    StaleElementReferenceException,
+    TimeoutException,
+)
+
+logger = logging.getLogger(__name__)
+
+# Intervalos (en segundos) entre dos comprobaciones de una condición
+_MIN_POLL = 0.02
+_MAX_POLL = 0.5
+_BACKOFF = 1.5
+# Peso de la última medida en la media móvil de la latencia de cada condición
+_EWMA_ALPHA = 0.2
+# Fracción de la latencia típica que se espera sin comprobar la condición
+_EXPECTED_FRACTION = 0.8
+
+_IGNORED_EXCEPTIONS = (NoSuchElementException, StaleElementReferenceException)
+
+# La página ha terminado de cargar y no hay peticiones AJAX (jQuery) en curso
+_NETWORK_IDLE_SCRIPT = (
+    "return document.readyState === 'complete' && "
+    "(typeof jQuery === 'undefined' || jQuery.active === 0);"
+)
+
+
+def network_idle(driver) -> bool:
+    return bool(driver.execute_script(_NETWORK_IDLE_SCRIPT))
+
+
+def count_elements(driver, css_selector: str) -> int:
+    # Se cuenta en el navegador, sin transferir cada elemento por el protocolo de WebDriver
+    return driver.execute_script(
+        "return document.querySelectorAll(arguments[0]).length;", css_selector
+    )
+
+
+def num_elements_greater_than(css_selector: str, num: int) -> Callable:
+    def condition(driver):
+        return count_elements(driver, css_selector) > num
+
+    return condition
+
+
+class _LatencyStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.timeouts = 0
+        self.total = 0.0
+        self.ewma = None
+
+
+class AdaptiveWaiter:
+    # Sustituye a los sleep fijos: comprueba una condición concreta del DOM (o de la red)
+    # hasta que se cumple, con un intervalo entre comprobaciones que crece exponencialmente
+    # y que parte de la latencia típica observada para esa misma condición durante la
+    # ejecución. El tiempo máximo de espera (p.ej. --sleep-time) es solo un límite superior.
+    # Una misma instancia se puede compartir entre varios drivers/hilos y acumula el tiempo
+    # dedicado a esperar para poder compararlo con el tiempo total de ejecución
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._started = time.monotonic()
+
+    def until(
+        self,
+        driver,
+        name: str,
+        condition: Callable,
+        max_wait: float,
+        raise_on_timeout: bool = False,
+    ) -> bool:
+        start = time.monotonic()
+        # Si la condición no se cumple a la primera, se espera directamente hasta poco antes
+        # de la latencia típica y a partir de ahí se comprueba con un intervalo creciente
+        delay = self._expected_latency(name) * _EXPECTED_FRACTION
+        poll = _MIN_POLL
+        met = False
+        while True:
+            try:
+                met = bool(condition(driver))
+            except _IGNORED_EXCEPTIONS:
+                met = False
+            elapsed = time.monotonic() - start
+            if met or elapsed >= max_wait:
+                break
+            if delay > elapsed:
+                time.sleep(min(delay, max_wait) - elapsed)
+                continue
+            time.sleep(min(poll, max_wait - elapsed))
+            poll = min(poll * _BACKOFF, _MAX_POLL)
+        self._record(name, time.monotonic() - start, met)
+        if not met:
+            logger.debug(f"Espera '{name}' agotada tras {max_wait:.2f} s")
+            if raise_on_timeout:
+                raise TimeoutException(
+                    f"La condición '{name}' no se ha cumplido en {max_wait} s"
+                )
+        return met
+
+    def _expected_latency(self, name: str) -> float:
+        with self._lock:
+            stats = self._stats.get(name)
+            return stats.ewma if stats is not None and stats.ewma is not None else 0.0
+
+    def _record(self, name: str, elapsed: float, met: bool):
+        with self._lock:
+            stats = self._stats.setdefault(name, _LatencyStats())
+            stats.count += 1
+            stats.total += elapsed
+            if not met:
+                stats.timeouts += 1
+            elif stats.ewma is None:
+                stats.ewma = elapsed
+            else:
+                stats.ewma = _EWMA_ALPHA * elapsed + (1 - _EWMA_ALPHA) * stats.ewma
+
+    @property
+    def total_wait(self) -> float:
+        with self._lock:
+            return sum(stats.total for stats in self._stats.values())
+
+    def report(self, elapsed: Optional[float] = None):
+        # Tiempo esperando frente al tiempo total. Con varios workers las esperas se solapan,
+        # por lo que el tiempo de espera acumulado puede superar al tiempo total
+        elapsed = elapsed if elapsed is not None else time.monotonic() - self._started
+        waited = self.total_wait
+        logger.info(
+            f"Tiempo total: {elapsed:.1f} s. Esperando: {waited:.1f} s "
+            f"({100 * waited / elapsed if elapsed else 0:.0f}%). "
+            f"Trabajando: {max(elapsed - waited, 0):.1f} s."
+        )
+        with self._lock:
+            for name, stats in sorted(self._stats.items()):
+                logger.info(
+                    f"  Espera '{name}': {stats.count} veces, {stats.total:.1f} s en total, "
+                    f"latencia típica {stats.ewma or 0:.2f} s, {stats.timeouts} agotadas"
+                )
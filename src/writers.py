@@ -0,0 +1,483 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Iterator, List
+
+import pandas as pd
+
+from metrics import Metrics
+from records import MedicineColumns
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_CHUNK_SIZE = 500
+
+
+class ChunkedWriter:
+    # Escritura incremental del fichero de salida: las filas se acumulan en bloques de
+    # 'chunk_size' y cada bloque se añade al final del fichero, de forma que la memoria
+    # utilizada no depende del nº total de medicamentos
+    def __init__(
+        self, path: str, chunk_size: int = _DEFAULT_CHUNK_SIZE, metrics: Metrics = None
+    ) -> None:
+        self._path = path
+        self._chunk_size = max(1, chunk_size)
+        self._metrics = metrics or Metrics()
+        self._chunk = []
+        self.rows_written = 0
+        # Las filas pueden llegar desde varios hilos a la vez (p.ej. los workers del
+        # scraping): cada bloque se escribe desde un solo hilo
+        self._lock = threading.RLock()
+
+    def write(self, row: dict):
+        with self._lock:
+            self._chunk.append(row)
+            if len(self._chunk) >= self._chunk_size:
+                self.flush()
+
+    def write_all(self, rows):
+        if isinstance(rows, MedicineColumns):
+            # Las filas ya están por columnas: cada bloque se escribe directamente a partir
+            # de ellas, sin volver a construir un diccionario por fila
+            self.flush()
+            for start in range(0, len(rows), self._chunk_size):
+                self._write(rows.slice(start, start + self._chunk_size))
+            return
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        with self._lock:
+            if not self._chunk:
+                return
+            # El bloque se vacía antes de escribirlo: si la escritura falla, el error no
+            # se repite al cerrar el writer con las mismas filas
+            chunk, self._chunk = self._chunk, []
+            self._write(chunk)
+
+    def _write(self, rows):
+        with self._metrics.timer("escritura"):
+            if isinstance(rows, MedicineColumns):
+                self._write_columns(rows)
+            else:
+                self._write_chunk(rows)
+        self._metrics.inc("rows_written_total", len(rows))
+        self.rows_written += len(rows)
+        logger.debug(f"Escritos {self.rows_written} medicamentos en {self._path}")
+
+    def _write_chunk(self, rows: List[dict]):
+        raise NotImplementedError
+
+    def _write_columns(self, columns: MedicineColumns):
+        self._write_chunk(list(columns))
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvWriter(ChunkedWriter):
+    def __init__(
+        self, path: str, chunk_size: int = _DEFAULT_CHUNK_SIZE, metrics: Metrics = None
+    ) -> None:
+        super().__init__(path, chunk_size, metrics)
+        self._header_written = False
+
+    def _write_chunk(self, rows: List[dict]):
+        self._write_frame(pd.DataFrame.from_records(rows))
+
+    def _write_columns(self, columns: MedicineColumns):
+        self._write_frame(columns.to_pandas())
+
+    def _write_frame(self, frame: pd.DataFrame):
+        # Se añade el bloque al final del fichero; la cabecera solo se escribe la primera vez.
+        # La primera columna ("Número de registro") hace de índice, igual que en el CSV completo
+        frame.to_csv(
+            self._path,
+            mode="a" if self._header_written else "w",
+            header=not self._header_written,
+            index=False,
+        )
+        self._header_written = True
+
+
+class JsonLinesWriter(ChunkedWriter):
+    # Un objeto json por línea. Las listas y los formatos se guardan con su estructura
+    def __init__(
+        self, path: str, chunk_size: int = _DEFAULT_CHUNK_SIZE, metrics: Metrics = None
+    ) -> None:
+        super().__init__(path, chunk_size, metrics)
+        self._file = open(path, "w", encoding="utf-8")
+
+    def _write_chunk(self, rows: List[dict]):
+        self._file.write(
+            "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+        )
+        self._file.flush()
+
+    def close(self):
+        super().close()
+        self._file.close()
+
+
+# Columnas de fecha, con el formato "dd/mm/aaaa" con el que se muestran en la página
+_COLUMNAS_FECHA = ["Fecha autorización", "Fecha suspensión"]
+
+
+def _parquet_schema():
+    import pyarrow as pa
+
+    lista = pa.list_(pa.string())
+    return pa.schema(
+        [
+            ("Número de registro", pa.string()),
+            ("Medicamento", pa.string()),
+            ("Laboratorio", pa.string()),
+            ("Autorizado", pa.bool_()),
+            ("Fecha autorización", pa.date32()),
+            ("Suspendido", pa.bool_()),
+            ("Fecha suspensión", pa.date32()),
+            ("Comercializado", pa.bool_()),
+            ("Vías administración", lista),
+            ("Dosis", lista),
+            ("Formas farmacéuticas", lista),
+            ("Principios activos", lista),
+            ("Excipientes", lista),
+            ("Características", lista),
+            ("Códigos ATC", lista),
+            (
+                "Formatos",
+                pa.list_(
+                    pa.struct(
+                        [("Titulo", pa.string()), ("Codigo Nacional", pa.string())]
+                    )
+                ),
+            ),
+        ]
+    )
+
+
+def _parse_fecha(fecha):
+    if not fecha:
+        return None
+    if isinstance(fecha, date):
+        # Filas leídas de otro fichero parquet
+        return fecha
+    return datetime.strptime(fecha, "%d/%m/%Y").date()
+
+
+class ParquetWriter(ChunkedWriter):
+    # Parquet con tipos nativos: booleanos, fechas, listas de texto y lista de structs para
+    # los formatos. Cada bloque se escribe como un row group del fichero
+    def __init__(
+        self, path: str, chunk_size: int = _DEFAULT_CHUNK_SIZE, metrics: Metrics = None
+    ) -> None:
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError(
+                "El formato 'parquet' requiere instalar el paquete pyarrow (pip install pyarrow)"
+            )
+        super().__init__(path, chunk_size, metrics)
+        self._schema = _parquet_schema()
+        self._writer = pq.ParquetWriter(path, self._schema, compression="zstd")
+
+    def _write_chunk(self, rows: List[dict]):
+        import pyarrow as pa
+
+        rows = [
+            {
+                **row,
+                **{col: _parse_fecha(row.get(col)) for col in _COLUMNAS_FECHA},
+            }
+            for row in rows
+        ]
+        self._writer.write_table(pa.Table.from_pylist(rows, schema=self._schema))
+
+    def _write_columns(self, columns: MedicineColumns):
+        self._writer.write_table(
+            columns.to_arrow(
+                self._schema, {col: _parse_fecha for col in _COLUMNAS_FECHA}
+            )
+        )
+
+    def close(self):
+        super().close()
+        self._writer.close()
+
+
+# Tablas hijas de la base de datos sqlite: columna de listas -> (tabla, campo)
+_TABLAS_LISTAS = {
+    "Vías administración": ("vias_administracion", "via"),
+    "Dosis": ("dosis", "dosis"),
+    "Formas farmacéuticas": ("formas_farmaceuticas", "forma"),
+    "Principios activos": ("principios_activos", "nombre"),
+    "Excipientes": ("excipientes", "nombre"),
+    "Características": ("caracteristicas", "caracteristica"),
+}
+_SQL_MEDICAMENTOS = """
+    nregistro TEXT PRIMARY KEY,
+    medicamento TEXT,
+    laboratorio TEXT,
+    autorizado INTEGER,
+    fecha_autorizacion TEXT,
+    suspendido INTEGER,
+    fecha_suspension TEXT,
+    comercializado INTEGER
+"""
+_SQL_HIJA = """
+    nregistro TEXT NOT NULL REFERENCES medicamentos (nregistro),
+    posicion INTEGER NOT NULL,
+    {campos},
+    PRIMARY KEY (nregistro, posicion)
+"""
+# Índices de las búsquedas habituales (medicamentos por principio activo, código ATC,
+# código nacional o laboratorio). Se crean al cerrar, después de la carga, que es bastante
+# más rápido que mantenerlos actualizados en cada inserción
+_INDICES = {
+    "idx_medicamentos_laboratorio": "medicamentos (laboratorio)",
+    "idx_principios_activos_nombre": "principios_activos (nombre)",
+    "idx_excipientes_nombre": "excipientes (nombre)",
+    "idx_codigos_atc_codigo": "codigos_atc (codigo)",
+    "idx_formatos_codigo_nacional": "formatos (codigo_nacional)",
+}
+
+
+@lru_cache(maxsize=None)
+def _fecha_iso(fecha):
+    # Hay pocas fechas distintas y strptime es lento: cada una se convierte una sola vez
+    fecha = _parse_fecha(fecha)
+    return fecha.isoformat() if fecha is not None else None
+
+
+def _bool_sql(value):
+    return None if value is None else int(bool(value))
+
+
+def _split_atc(atc: str):
+    # "N02BE01 - PARACETAMOL" -> ("N02BE01", "PARACETAMOL")
+    codigo, _, descripcion = atc.partition(" - ")
+    return codigo.strip(), descripcion.strip() or None
+
+
+class SqliteWriter(ChunkedWriter):
+    # Base de datos sqlite normalizada: una tabla 'medicamentos' con el nº de registro como
+    # clave y una tabla hija por cada columna de listas (principios activos, excipientes,
+    # códigos ATC, formatos...), con una fila por elemento. Así las consultas del tipo
+    # "medicamentos con el principio activo X" usan un índice en lugar de recorrer el CSV
+    # entero y separar las listas. Cada bloque se inserta en una transacción
+    def __init__(
+        self, path: str, chunk_size: int = _DEFAULT_CHUNK_SIZE, metrics: Metrics = None
+    ) -> None:
+        super().__init__(path, chunk_size, metrics)
+        if os.path.exists(path):
+            os.remove(path)
+        # La escritura se hace desde hilos distintos del que crea el writer (pero nunca
+        # desde dos a la vez)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # El fichero se genera entero en cada ejecución: si el proceso se interrumpe se
+        # vuelve a generar, así que no hace falta esperar a que cada bloque llegue al disco
+        self._conn.execute("PRAGMA synchronous = OFF")
+        self._ids = set()
+        with self._conn:
+            self._create_tables()
+
+    def _create_tables(self):
+        self._conn.execute(f"CREATE TABLE medicamentos ({_SQL_MEDICAMENTOS})")
+        for tabla, campo in _TABLAS_LISTAS.values():
+            self._conn.execute(
+                f"CREATE TABLE {tabla} ({_SQL_HIJA.format(campos=f'{campo} TEXT')})"
+            )
+        self._conn.execute(
+            "CREATE TABLE codigos_atc"
+            f" ({_SQL_HIJA.format(campos='codigo TEXT, descripcion TEXT')})"
+        )
+        self._conn.execute(
+            "CREATE TABLE formatos"
+            f" ({_SQL_HIJA.format(campos='titulo TEXT, codigo_nacional TEXT')})"
+        )
+
+    def _write_chunk(self, rows: List[dict]):
+        # Si un medicamento se escribe dos veces, la última versión sustituye a la anterior,
+        # tanto dentro del mismo bloque como en bloques distintos
+        latest = {}
+        for row in rows:
+            m = str(row["Número de registro"])
+            latest.pop(m, None)
+            latest[m] = row
+        medicamentos = []
+        listas = {col: [] for col in _TABLAS_LISTAS}
+        atcs = []
+        formatos = []
+        for row in latest.values():
+            m = str(row["Número de registro"])
+            medicamentos.append(
+                (
+                    m,
+                    row.get("Medicamento"),
+                    row.get("Laboratorio"),
+                    _bool_sql(row.get("Autorizado")),
+                    _fecha_iso(row.get("Fecha autorización")),
+                    _bool_sql(row.get("Suspendido")),
+                    _fecha_iso(row.get("Fecha suspensión")),
+                    _bool_sql(row.get("Comercializado")),
+                )
+            )
+            for col, values in listas.items():
+                values.extend((m, i, v) for i, v in enumerate(row.get(col) or ()))
+            atcs.extend(
+                (m, i, *_split_atc(atc))
+                for i, atc in enumerate(row.get("Códigos ATC") or ())
+            )
+            formatos.extend(
+                (m, i, f.get("Titulo"), f.get("Codigo Nacional"))
+                for i, f in enumerate(row.get("Formatos") or ())
+            )
+        repeated = [(m[0],) for m in medicamentos if m[0] in self._ids]
+        with self._conn:
+            if repeated:
+                self._delete(repeated)
+            self._conn.executemany(
+                "INSERT INTO medicamentos VALUES (?, ?, ?, ?, ?, ?, ?, ?)", medicamentos
+            )
+            for col, values in listas.items():
+                self._conn.executemany(
+                    f"INSERT INTO {_TABLAS_LISTAS[col][0]} VALUES (?, ?, ?)", values
+                )
+            self._conn.executemany("INSERT INTO codigos_atc VALUES (?, ?, ?, ?)", atcs)
+            self._conn.executemany("INSERT INTO formatos VALUES (?, ?, ?, ?)", formatos)
+        self._ids.update(latest)
+
+    def _delete(self, ids: List[tuple]):
+        for tabla in ["medicamentos", "codigos_atc", "formatos"] + [
+            tabla for tabla, _ in _TABLAS_LISTAS.values()
+        ]:
+            self._conn.executemany(f"DELETE FROM {tabla} WHERE nregistro = ?", ids)
+
+    def close(self):
+        super().close()
+        with self._conn:
+            for nombre, columnas in _INDICES.items():
+                self._conn.execute(f"CREATE INDEX {nombre} ON {columnas}")
+        # Estadísticas para que el planificador de consultas elija bien los índices
+        self._conn.execute("ANALYZE")
+        self._conn.close()
+
+
+def iter_sqlite_rows(path: str, batch_size: int = 500) -> Iterator[dict]:
+    # Filas de una base de datos generada por SqliteWriter, con el mismo formato que las
+    # del scraping (en el orden en el que se escribieron)
+    conn = sqlite3.connect(path)
+    try:
+        last = 0
+        while True:
+            medicamentos = conn.execute(
+                "SELECT rowid, * FROM medicamentos WHERE rowid > ? ORDER BY rowid"
+                " LIMIT ?",
+                (last, batch_size),
+            ).fetchall()
+            if not medicamentos:
+                return
+            last = medicamentos[-1][0]
+            ids = [m[1] for m in medicamentos]
+            listas = {
+                col: _read_children(conn, tabla, campo, ids)
+                for col, (tabla, campo) in _TABLAS_LISTAS.items()
+            }
+            atcs = _read_children(
+                conn, "codigos_atc", "codigo || coalesce(' - ' || descripcion, '')", ids
+            )
+            formatos = _read_children(conn, "formatos", "titulo, codigo_nacional", ids)
+            for m in medicamentos:
+                (
+                    _,
+                    nregistro,
+                    medicamento,
+                    laboratorio,
+                    autorizado,
+                    fecha_autorizacion,
+                    suspendido,
+                    fecha_suspension,
+                    comercializado,
+                ) = m
+                yield {
+                    "Número de registro": nregistro,
+                    "Medicamento": medicamento,
+                    "Laboratorio": laboratorio,
+                    "Autorizado": _bool_row(autorizado),
+                    "Fecha autorización": _fecha_row(fecha_autorizacion),
+                    "Suspendido": _bool_row(suspendido),
+                    "Fecha suspensión": _fecha_row(fecha_suspension),
+                    "Comercializado": _bool_row(comercializado),
+                    **{
+                        col: values.get(nregistro, []) for col, values in listas.items()
+                    },
+                    "Códigos ATC": atcs.get(nregistro, []),
+                    "Formatos": [
+                        {"Titulo": titulo, "Codigo Nacional": cn}
+                        for titulo, cn in formatos.get(nregistro, [])
+                    ],
+                }
+    finally:
+        conn.close()
+
+
+def _read_children(conn, tabla: str, campos: str, ids: List[str]) -> dict:
+    placeholders = ", ".join("?" * len(ids))
+    children = {}
+    for nregistro, *values in conn.execute(
+        f"SELECT nregistro, {campos} FROM {tabla} WHERE nregistro IN ({placeholders})"
+        " ORDER BY nregistro, posicion",
+        ids,
+    ):
+        children.setdefault(nregistro, []).append(
+            values[0] if len(values) == 1 else tuple(values)
+        )
+    return children
+
+
+def _bool_row(value):
+    return None if value is None else bool(value)
+
+
+def _fecha_row(fecha):
+    # Las fechas se guardan en formato ISO para poder ordenarlas y compararlas en sql
+    return date.fromisoformat(fecha).strftime("%d/%m/%Y") if fecha else None
+
+
+WRITERS = {
+    "csv": CsvWriter,
+    "jsonl": JsonLinesWriter,
+    "parquet": ParquetWriter,
+    "sqlite": SqliteWriter,
+}
+
+
+def infer_format(path: str) -> str:
+    # Formato según la extensión del fichero de salida; por defecto csv
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension == "json":
+        return "jsonl"
+    if extension in ("db", "sqlite3"):
+        return "sqlite"
+    return extension if extension in WRITERS else "csv"
+
+
+def open_writer(
+    path: str,
+    formato: str = None,
+    chunk_size: int = _DEFAULT_CHUNK_SIZE,
+    metrics: Metrics = None,
+) -> ChunkedWriter:
+    return WRITERS[formato or infer_format(path)](
+        path, chunk_size=chunk_size, metrics=metrics
+    )
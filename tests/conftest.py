@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Los módulos del scraper están en src/ (igual que en benchmarks/)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
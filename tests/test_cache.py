@@ -0,0 +1,45 @@
+import os
+import random
+
+from cache import PageCache
+
+
+def _page(n: int) -> str:
+    # Contenido poco comprimible, para que cada entrada ocupe en disco lo mismo
+    rng = random.Random(n)
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(2000))
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = PageCache(str(tmp_path), max_size=10**9)
+    cache.put("0", _page(0))
+    size = os.path.getsize(next((tmp_path / "objects").rglob("*.gz")))
+    cache.close()
+
+    cache = PageCache(str(tmp_path), max_size=int(size * 3.5))
+    for n in range(1, 3):
+        cache.put(str(n), _page(n))
+    # "0" se usa más recientemente que "1"
+    assert cache.get("0") is not None
+    cache.put("3", _page(3))
+    cache.put("4", _page(4))
+    assert cache.get("1") is None
+    assert cache.get("2") is None
+    assert [cache.get(str(n)) is not None for n in (0, 3, 4)] == [True, True, True]
+    assert len(list((tmp_path / "objects").rglob("*.gz"))) == 3
+    cache.close()
+
+
+def test_cache_size_is_not_recomputed_on_every_put(tmp_path):
+    cache = PageCache(str(tmp_path), max_size=10**9)
+    queries = []
+    cache._db.set_trace_callback(queries.append)
+    for n in range(20):
+        cache.put(str(n), _page(n))
+    # Sustituir o eliminar una entrada actualiza el total sin volver a calcularlo
+    cache.put("0", _page(100))
+    cache.delete("1")
+    assert sum("SUM(size)" in q for q in queries) == 1
+    (total,) = cache._db.execute("SELECT SUM(size) FROM paginas").fetchone()
+    assert cache._size == total
+    cache.close()
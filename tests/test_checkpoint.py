@@ -0,0 +1,43 @@
+from checkpoint import CrawlCheckpoint
+
+
+def _row(nregistro):
+    return {"Número de registro": nregistro, "Medicamento": f"MEDICAMENTO {nregistro}"}
+
+
+def test_checkpoint_saved_every_interval_without_min_seconds(tmp_path):
+    path = str(tmp_path / "out.checkpoint")
+    checkpoint = CrawlCheckpoint(path, interval=2, min_seconds=0)
+    checkpoint.start(["1", "2", "3"])
+    checkpoint.record("1", _row("1"))
+    checkpoint.record("2", _row("2"))
+    checkpoint.record("3", _row("3"))
+    # Sin cerrar el checkpoint (p.ej. el proceso muere): solo cuenta lo guardado
+    resumed = CrawlCheckpoint(path)
+    assert resumed.load()
+    assert resumed.completed == {"1", "2"}
+    assert list(resumed.rows().column("Número de registro")) == ["1", "2"]
+
+
+def test_checkpoint_min_seconds_delays_saves(tmp_path):
+    path = str(tmp_path / "out.checkpoint")
+    checkpoint = CrawlCheckpoint(path, interval=1, min_seconds=3600)
+    checkpoint.start(["1", "2"])
+    checkpoint.record("1", _row("1"))
+    resumed = CrawlCheckpoint(path)
+    assert resumed.load()
+    assert resumed.completed == set()
+
+
+def test_checkpoint_counts_rows_of_repeated_ids(tmp_path):
+    path = str(tmp_path / "out.checkpoint")
+    checkpoint = CrawlCheckpoint(path, interval=100)
+    checkpoint.start(["1", "2", "1", "3"])
+    for nregistro in ["1", "2", "1", "3"]:
+        checkpoint.record(nregistro, _row(nregistro))
+    checkpoint.close()
+    resumed = CrawlCheckpoint(path)
+    assert resumed.load()
+    assert resumed.rows_committed == 4
+    # La última fila no se pierde al reanudar
+    assert list(resumed.rows().column("Número de registro")) == ["1", "2", "1", "3"]
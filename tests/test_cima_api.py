@@ -0,0 +1,38 @@
+import pytest
+import requests
+
+from cima_api import CimaApiClient, MedicineJsonDetails
+from medicines import MedicineDetails
+from stub_server import PageStore, StubCimaServer
+
+
+@pytest.fixture
+def server():
+    server = StubCimaServer(PageStore(None, None, 12)).start()
+    yield server
+    server.stop()
+
+
+def test_json_rows_match_html_rows(server):
+    client = CimaApiClient(server.url, timeout=5)
+    try:
+        for med_id_number in server.store.ids:
+            html = requests.get(
+                f"{server.url}/cima/publico/detalle.html",
+                params={"nregistro": med_id_number},
+                timeout=5,
+            ).text
+            assert (
+                client.scrape_medicine_by_id_number(med_id_number)
+                == MedicineDetails(html).scrape_data()
+            )
+    finally:
+        client.close()
+
+
+def test_revoked_medicine_is_not_authorized():
+    row = MedicineJsonDetails(
+        '{"nregistro": "1", "estado": {"aut": 1044057600000, "rev": 1146700800000}}'
+    ).scrape_data()
+    assert row["Autorizado"] is False
+    assert row["Fecha autorización"] is None
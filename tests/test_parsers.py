@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import pytest
+
+from medicines import MedicineDetails
+
+# Páginas de detalle con la estructura de CIMA y casos que los parsers tratan de forma
+# distinta: comentarios, entidades, tags anidadas, listas anidadas y espacios
+_PAGES = sorted((Path(__file__).parent / "pages").glob("*.html"))
+
+
+def _parse(path: Path, parser: str) -> dict:
+    return MedicineDetails(path.read_text(encoding="utf-8"), parser).scrape_data()
+
+
+@pytest.mark.parametrize("parser", ["lxml", "selectolax"])
+@pytest.mark.parametrize("path", _PAGES, ids=[p.stem for p in _PAGES])
+def test_parsers_give_the_same_row_as_bs4(path, parser):
+    pytest.importorskip(parser)
+    assert _parse(path, parser) == _parse(path, "bs4")
+
+
+def test_bs4_row():
+    row = _parse(Path(__file__).parent / "pages" / "61234.html", "bs4")
+    assert row["Número de registro"] == " 61234 "
+    assert row["Medicamento"] == "IBUPROFENO CINFA\xa0600 mg COMPRIMIDOS RECUBIERTOS"
+    assert row["Laboratorio"] == "Laboratorios Cinfa, S.A. & Cía – Pamplona"
+    assert row["Fecha suspensión"] == "30/06/2021"
+    assert row["Comercializado"] is False
+    assert row["Vías administración"] == ["VÍA ORAL"]
+    assert row["Principios activos"] == ["IBUPROFENO (600 mg)"]
+    assert row["Excipientes"][0] == "LACTOSA  MONOHIDRATO"
+    assert row["Formatos"] == [
+        {
+            "Titulo": "IBUPROFENO CINFA 600 mg, 40 comprimidos <blister>",
+            "Codigo Nacional": "712345",
+        },
+        {
+            "Titulo": "IBUPROFENO CINFA 600 mg, 500 comprimidos (envase clínico)",
+            "Codigo Nacional": "712346",
+        },
+    ]
@@ -0,0 +1,54 @@
+import threading
+
+from pool import ReorderBuffer
+
+
+def test_reorder_buffer_emits_in_input_order():
+    emitted = []
+    buffer = ReorderBuffer(
+        ["a", "b", "c", "d"], lambda item, value: emitted.append(item)
+    )
+    buffer.put("c", 3)
+    buffer.put("b", 2)
+    assert emitted == []
+    buffer.put("a", 1)
+    assert emitted == ["a", "b", "c"]
+    buffer.put("d", 4)
+    assert emitted == ["a", "b", "c", "d"]
+
+
+def test_reorder_buffer_skips_discarded_items():
+    emitted = []
+    buffer = ReorderBuffer(["a", "b", "c"], lambda item, value: emitted.append(item))
+    buffer.put("b", 2)
+    buffer.put("c", 3)
+    buffer.discard("a")
+    # Un descartado no retiene a los siguientes
+    assert emitted == ["b", "c"]
+    assert buffer.emitted == 2
+
+
+def test_reorder_buffer_flush_delivers_what_is_left():
+    emitted = []
+    buffer = ReorderBuffer(["a", "b", "c"], lambda item, value: emitted.append(item))
+    buffer.put("c", 3)
+    buffer.flush()
+    assert emitted == ["c"]
+
+
+def test_reorder_buffer_from_several_threads():
+    items = [str(n) for n in range(500)]
+    emitted = []
+    buffer = ReorderBuffer(items, lambda item, value: emitted.append(item))
+    threads = [
+        threading.Thread(
+            target=lambda part: [buffer.put(item, item) for item in reversed(part)],
+            args=(items[start::4],),
+        )
+        for start in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert emitted == items
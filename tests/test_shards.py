@@ -0,0 +1,60 @@
+from itertools import product
+
+import pytest
+
+from shards import (
+    MAX_SHARDS,
+    _PARES_FILTROS,
+    filter_state,
+    parse_shard,
+    shard_conflicts,
+    shard_filters,
+)
+
+# Estado por defecto de los filtros en la página de búsqueda (igual que el servidor local
+# de benchmarks/stub_server.py)
+_DEFAULT_STATE = {"filtroAutorizado": True, "filtroComercializadoSi": True}
+
+
+def _matches(medicine: dict, checked: dict) -> bool:
+    # Igual que la web: con solo uno de los filtros de un par activado se muestran los
+    # medicamentos que lo cumplen; con los dos o ninguno, todos
+    for si, no in _PARES_FILTROS:
+        if checked.get(si) and not checked.get(no) and not medicine[si]:
+            return False
+        if checked.get(no) and not checked.get(si) and medicine[si]:
+            return False
+    return True
+
+
+@pytest.mark.parametrize("total", [2, 4, 8, MAX_SHARDS])
+def test_shards_are_disjoint_and_cover_the_catalog(total):
+    states = [
+        {**_DEFAULT_STATE, **filter_state(shard_filters(index, total))}
+        for index in range(total)
+    ]
+    for values in product([True, False], repeat=len(_PARES_FILTROS)):
+        medicine = {si: value for (si, _), value in zip(_PARES_FILTROS, values)}
+        assert sum(_matches(medicine, state) for state in states) == 1
+
+
+def test_filter_state_unchecks_the_other_filter_of_each_pair():
+    assert filter_state(["filtroComercializadoNo"]) == {
+        "filtroComercializadoSi": False,
+        "filtroComercializadoNo": True,
+    }
+    # Si se piden los dos filtros del par, se activan los dos
+    assert filter_state(["filtroRecetaSi", "filtroRecetaNo"]) == {
+        "filtroRecetaSi": True,
+        "filtroRecetaNo": True,
+    }
+    assert filter_state(["filtroAutorizado"]) == {"filtroAutorizado": True}
+
+
+def test_parse_shard_and_conflicts():
+    assert parse_shard("3/4") == (3, 4)
+    with pytest.raises(ValueError):
+        parse_shard("1/3")
+    assert shard_conflicts(["filtroRecetaNo", "filtroHuerfanoSi"], 4) == [
+        "filtroRecetaNo"
+    ]
@@ -0,0 +1,49 @@
+from writers import SqliteWriter, iter_sqlite_rows
+
+
+def _row(nregistro, medicamento, principios):
+    return {
+        "Número de registro": nregistro,
+        "Medicamento": medicamento,
+        "Laboratorio": "LABORATORIO",
+        "Autorizado": True,
+        "Fecha autorización": "01/02/2003",
+        "Suspendido": False,
+        "Fecha suspensión": None,
+        "Comercializado": True,
+        "Vías administración": ["ORAL"],
+        "Dosis": ["1 g"],
+        "Formas farmacéuticas": ["COMPRIMIDO"],
+        "Principios activos": principios,
+        "Excipientes": [],
+        "Características": [],
+        "Códigos ATC": ["N02BE01 - PARACETAMOL"],
+        "Formatos": [{"Titulo": "20 comprimidos", "Codigo Nacional": "123456"}],
+    }
+
+
+def test_sqlite_writer_repeated_id_in_same_chunk(tmp_path):
+    path = str(tmp_path / "medicamentos.db")
+    with SqliteWriter(path, chunk_size=10) as writer:
+        writer.write(_row("1", "A", ["PARACETAMOL"]))
+        writer.write(_row("2", "B", ["IBUPROFENO"]))
+        writer.write(_row("1", "A2", ["PARACETAMOL", "CAFEINA"]))
+    rows = {row["Número de registro"]: row for row in iter_sqlite_rows(path)}
+    assert sorted(rows) == ["1", "2"]
+    # Se queda la última versión, con sus tablas hijas
+    assert rows["1"]["Medicamento"] == "A2"
+    assert rows["1"]["Principios activos"] == ["PARACETAMOL", "CAFEINA"]
+    assert rows["1"]["Formatos"] == [
+        {"Titulo": "20 comprimidos", "Codigo Nacional": "123456"}
+    ]
+
+
+def test_sqlite_writer_repeated_id_in_later_chunk(tmp_path):
+    path = str(tmp_path / "medicamentos.db")
+    with SqliteWriter(path, chunk_size=1) as writer:
+        writer.write(_row("1", "A", ["PARACETAMOL"]))
+        writer.write(_row("1", "A2", ["IBUPROFENO"]))
+    rows = list(iter_sqlite_rows(path))
+    assert len(rows) == 1
+    assert rows[0]["Medicamento"] == "A2"
+    assert rows[0]["Principios activos"] == ["IBUPROFENO"]